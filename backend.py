@@ -1,9 +1,74 @@
-from fastapi import FastAPI
-from pydantic import BaseModel
-from typing import List
+"""
+Game server: many thin clients in front of one service instead of one Streamlit process per player.
+
+    POST /worlds                           create a world for a theme (FullGraph), returns its session id
+    GET  /worlds/{session_id}              creation status, round and balance report
+    POST /worlds/{session_id}/open         load a saved world again, e.g. after a restart of the server
+    POST /worlds/{session_id}/turns        play a turn (LoopGraph), returns the narration
+    POST /worlds/{session_id}/turns/stream play a turn, the narration streamed as server-sent events
+    GET  /worlds/{session_id}/characters   character sheets, optionally /characters/{name}
+    GET  /worlds/{session_id}/rounds/{n}   messages of round n, archived rounds included
+    DELETE /worlds/{session_id}            close the world, its save stays and can be opened again
+    GET  /metrics                          node spans in the Prometheus text format
+
+Creation and turns run on a bounded SessionWorkerPool: the jobs of one session run one after another in
+the order they were sent (a turn sent during creation waits for it), different sessions run in parallel.
+Worlds nobody used for FRPG_IDLE_SECONDS are closed like with DELETE when the next world is created or opened.
+
+    uvicorn backend:app --workers 1
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import os
+import threading
+import time
+from typing import List, Optional
+
+from fastapi import FastAPI, HTTPException, Path
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+
+from creation_graph import FullGraph
+from instrumentation import prometheus_text
+from loop_graph import LoopGraph
+from save_journal import GameJournal, open_game
+from sessions import registry
+from worker_pool import PoolFull, SessionWorkerPool
 
 app = FastAPI()
 
+# Journaled saves of the created worlds, one folder per session, see save_journal.py
+saves_folder = "./data/saves"
+
+pool = SessionWorkerPool(
+    max_workers=int(os.getenv("FRPG_WORKERS", "8")),
+    max_pending=int(os.getenv("FRPG_MAX_PENDING", "256")),
+)
+
+idle_seconds = float(os.getenv("FRPG_IDLE_SECONDS", "3600"))
+
+# Session ids name the session's folders on disk, e.g. the save and the checkpoints
+session_id_pattern = r"^[A-Za-z0-9_-]{1,64}$"
+
+
+class World:
+    """The graphs of one session and how far its creation got."""
+
+    def __init__(self, session):
+        self.session = session
+        self.full_graph = FullGraph(session=session)
+        self.loop_graph = LoopGraph(session=session)
+        self.status = "creating"  # "ready" or "failed" once the creation job ran, "closed" once closed
+        self.error = None
+        self.last_used = time.monotonic()
+
+
+worlds = {}
+worlds_lock = threading.Lock()
+
+
 class PostContent(BaseModel):
     narrative: str
     characters: List[str]
@@ -11,7 +76,275 @@ class PostContent(BaseModel):
     previous_image_url: str
     previous_image_style: str
 
+
+class WorldRequest(BaseModel):
+    theme: str
+    session_id: Optional[str] = Field(default=None, pattern=session_id_pattern)
+
+
+class TurnRequest(BaseModel):
+    content: str
+
+
+def get_world(session_id):
+    with worlds_lock:
+        world = worlds.get(session_id)
+    if world is None:
+        raise HTTPException(status_code=404, detail=f"World couldn't be found: {session_id}")
+    world.last_used = time.monotonic()
+    return world
+
+
+def submit(session_id, fn, *args):
+    try:
+        return pool.submit(session_id, fn, *args)
+    except PoolFull as error:
+        raise HTTPException(status_code=503, detail=f"Server is busy: {error}", headers={"Retry-After": "5"})
+
+
+def schedule(world, fn, *args):
+    return submit(world.session.session_id, fn, world, *args)
+
+
+def assign_main_character(game):
+    # Same convention as the Streamlit client: the last created character is the player's
+    game.main_character = list(game.characters.keys())[-1]
+    for name, character in game.characters.items():
+        character.character_type = "player" if name == game.main_character else "npc"
+        game.touch(name)
+
+
+def create_world(world, theme):
+    session = world.session
+    session.journal = GameJournal(f"{saves_folder}/{session.session_id}")
+
+    try:
+        world.full_graph.create(theme)
+        assign_main_character(session.game)
+        session.journal.snapshot(session.game)
+    except Exception as error:
+        world.status, world.error = "failed", f"{type(error).__name__}: {error}"
+        raise
+
+    world.status = "ready"
+
+
+def load_world(session_id):
+    """Runs on a worker behind the session's other jobs, e.g. the close job of its previous world."""
+    with worlds_lock:
+        if (world := worlds.get(session_id)) is not None:
+            return world
+
+    try:
+        # The RAG memory and the loop checkpoints are found by the session id, the game comes from the journal
+        session = registry.create(session_id)
+    except KeyError as error:
+        raise HTTPException(status_code=409, detail=str(error))
+
+    try:
+        world = World(session)
+        open_game(f"{saves_folder}/{session_id}", session)
+    except Exception:
+        session.close()
+        registry.remove(session_id)
+        raise
+    world.status = "ready"
+
+    with worlds_lock:
+        worlds[session_id] = world
+    return world
+
+
+def close_world(world):
+    """Runs on a worker behind the session's other jobs, so nothing of the world is in use anymore."""
+    world.status = "closed"
+    pending = world.loop_graph.pending_summary
+    if isinstance(pending, concurrent.futures.Future):
+        # The summary job still writes to the RAG memory
+        concurrent.futures.wait([pending])
+    world.session.close()
+
+    # Only now the session id can be created or opened again, on the same files
+    registry.remove(world.session.session_id)
+
+
+def remove_world(world):
+    """Takes the world out of the server and closes it once its queued jobs ran."""
+    session_id = world.session.session_id
+    with worlds_lock:
+        if worlds.get(session_id) is not world:
+            return
+        del worlds[session_id]
+
+    try:
+        schedule(world, close_world)
+    except HTTPException:
+        # Still open, a later DELETE or eviction tries again
+        with worlds_lock:
+            worlds.setdefault(session_id, world)
+        raise
+
+
+def evict_idle():
+    now = time.monotonic()
+    with worlds_lock:
+        idle = [world for world in worlds.values()
+                if world.status != "creating" and now - world.last_used > idle_seconds]
+
+    for world in idle:
+        try:
+            remove_world(world)
+        except HTTPException:
+            return
+
+
+def check_ready(world):
+    if world.status != "ready":
+        raise HTTPException(status_code=409, detail=f"World is not playable: {world.error or world.status}")
+
+
+def play_turn(world, content):
+    check_ready(world)
+    narration = "".join(world.loop_graph.stream_narration(content))
+    return {"round": world.session.round, "narration": narration}
+
+
+def stream_turn(world, content, emit):
+    """Runs on a worker, emit hands every event over to the event loop of the request."""
+    try:
+        check_ready(world)
+        for chunk in world.loop_graph.stream_narration(content):
+            emit("token", {"text": chunk})
+        emit("done", {"round": world.session.round})
+    except HTTPException as error:
+        emit("error", {"status": error.status_code, "detail": error.detail})
+    except Exception as error:
+        emit("error", {"status": 500, "detail": f"{type(error).__name__}: {error}"})
+
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/worlds", status_code=202)
+def create(request: WorldRequest):
+    evict_idle()
+
+    try:
+        session = registry.create(request.session_id)
+    except KeyError as error:
+        raise HTTPException(status_code=409, detail=str(error))
+
+    world = World(session)
+    try:
+        schedule(world, create_world, request.theme)
+    except HTTPException:
+        # Nothing runs for a refused world, the id is free for the retry
+        registry.remove(session.session_id)
+        session.close()
+        raise
+
+    with worlds_lock:
+        worlds[session.session_id] = world
+    return {"session_id": session.session_id, "status": world.status}
+
+
+@app.post("/worlds/{session_id}/open")
+async def open_world(session_id: str = Path(pattern=session_id_pattern)):
+    if not os.path.exists(f"{saves_folder}/{session_id}/{GameJournal.snapshot_file}"):
+        raise HTTPException(status_code=404, detail=f"Save couldn't be found: {session_id}")
+
+    evict_idle()
+    with worlds_lock:
+        opened = session_id in worlds
+
+    if not opened:
+        await asyncio.wrap_future(submit(session_id, load_world, session_id))
+
+    return world_status(session_id)
+
+
+@app.get("/worlds/{session_id}")
+def world_status(session_id: str):
+    world = get_world(session_id)
+    game = world.session.game
+    return {
+        "session_id": session_id,
+        "status": world.status,
+        "error": world.error,
+        "round": world.session.round,
+        "queued": pool.queued(session_id),
+        "main_character": getattr(game, "main_character", None) if world.status == "ready" else None,
+        "balance_report": world.session.balance_report,
+    }
+
+
+@app.post("/worlds/{session_id}/turns")
+async def turn(session_id: str, request: TurnRequest):
+    world = get_world(session_id)
+    return await asyncio.wrap_future(schedule(world, play_turn, request.content))
+
+
+@app.post("/worlds/{session_id}/turns/stream")
+async def turn_stream(session_id: str, request: TurnRequest):
+    world = get_world(session_id)
+
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def emit(event, data):
+        loop.call_soon_threadsafe(events.put_nowait, (event, data))
+
+    # The turn is queued before the response starts, a full pool is answered with 503 right away
+    schedule(world, stream_turn, request.content, emit)
+
+    async def body():
+        while True:
+            event, data = await events.get()
+            yield sse(event, data)
+            if event in ("done", "error"):
+                return
+
+    return StreamingResponse(body(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/worlds/{session_id}/characters")
+def characters(session_id: str):
+    game = get_world(session_id).session.game
+    # A copy of the values, a running turn may add characters meanwhile
+    return [character.to_dict() for character in list(game.characters.values())]
+
+
+@app.get("/worlds/{session_id}/characters/{name}")
+def character(session_id: str, name: str):
+    game = get_world(session_id).session.game
+    found = game.characters.get(name.lower())
+    if found is None:
+        raise HTTPException(status_code=404, detail=f"Character couldn't be found: {name}")
+    return found.to_dict()
+
+
+@app.get("/worlds/{session_id}/rounds/{round_no}")
+def round_messages(session_id: str, round_no: int):
+    world = get_world(session_id)
+    messages = world.loop_graph.round_messages(round_no)
+    if not messages:
+        raise HTTPException(status_code=404, detail=f"Round couldn't be found: {round_no}")
+    return [{"type": message.type, "content": message.content} for message in messages]
+
+
+@app.delete("/worlds/{session_id}")
+def delete_world(session_id: str):
+    remove_world(get_world(session_id))
+    return {"session_id": session_id, "status": "closed"}
+
+
 @app.post("/generate")
 async def generate(content: PostContent):
     # Şu an sadece gelen veriyi döndürüyoruz
-    return {"message": "Post received successfully", "data": content}
\ No newline at end of file
+    return {"message": "Post received successfully", "data": content}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    # Node spans aggregated per graph and node, in the Prometheus text format
+    return PlainTextResponse(prometheus_text(), media_type="text/plain; version=0.0.4")
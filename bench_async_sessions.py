@@ -0,0 +1,92 @@
+"""
+Concurrent-session throughput of LoopGraph, sync vs async.
+
+Every LLM is replaced by fake_llm.FakeChatModel, which answers after a fixed latency, and the embedding model
+by a deterministic fake, so the numbers only reflect graph execution and how well waiting on the model
+overlaps across sessions.
+
+    python bench_async_sessions.py --sessions 16 --rounds 3 --latency 0.2
+"""
+
+import argparse
+import asyncio
+import tempfile
+import time
+
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+import loop_graph
+from loop_graph import LoopGraph
+from embedding_cache import CachedEmbeddings
+from fake_llm import FakeChatModel
+from sessions import registry
+from static_objects import load_game
+
+
+def install_stand_ins(latency):
+    model = FakeChatModel(latency=latency)
+    embeddings = CachedEmbeddings(DeterministicFakeEmbedding(size=384), cache_path=None)
+
+    loop_graph.get_llm = lambda: model
+    loop_graph.get_tooler_llm = lambda: model
+    loop_graph.get_summarizer_llm = lambda: model
+    loop_graph.get_llm_with_tools = lambda: model.bind_tools(loop_graph.tools)
+    loop_graph.get_embedding_model = lambda: embeddings
+
+
+def new_graphs(count, folder, prefix):
+    graphs = []
+    for i in range(count):
+        session = registry.create(f"{prefix}-{i}", rag_folder=f"{folder}/{prefix}-{i}",
+                                   checkpoint_path=f"{folder}/{prefix}-{i}.sqlite")
+        load_game("game_1.pkl", session.game)
+        graph = LoopGraph(session=session)
+        # Character based splitter so the benchmark does not need tiktoken's encoding download
+        graph._splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=400)
+        graphs.append(graph)
+    return graphs
+
+
+def run_sync(graphs, rounds):
+    for graph in graphs:
+        for round_no in range(rounds):
+            graph.invoke(f"I look around. ({round_no})")
+
+
+async def run_async(graphs, rounds):
+
+    async def play(graph):
+        for round_no in range(rounds):
+            await graph.ainvoke(f"I look around. ({round_no})")
+
+    await asyncio.gather(*(play(graph) for graph in graphs))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=16)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.2)
+    args = parser.parse_args()
+
+    install_stand_ins(args.latency)
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        turns = args.sessions * args.rounds
+
+        graphs = new_graphs(args.sessions, folder, "sync")
+        start = time.perf_counter()
+        run_sync(graphs, args.rounds)
+        sync_time = time.perf_counter() - start
+
+        graphs = new_graphs(args.sessions, folder, "async")
+        start = time.perf_counter()
+        asyncio.run(run_async(graphs, args.rounds))
+        async_time = time.perf_counter() - start
+
+    print(f"{args.sessions} sessions x {args.rounds} rounds, {args.latency:.3f} s per LLM call")
+    print(f"sync : {sync_time:7.2f} s  {turns / sync_time:7.2f} turns/s")
+    print(f"async: {async_time:7.2f} s  {turns / async_time:7.2f} turns/s  ({sync_time / async_time:.1f}x)")
@@ -0,0 +1,98 @@
+"""
+Soak benchmark of the loop graph's checkpointer: RSS and disk usage over a long campaign.
+
+Plays --rounds turns of LoopGraph on the fake LLM (no latency) with the SQLite checkpointer and with
+MemorySaver, each in its own process, and prints RSS, checkpoint storage and turn time every --every rounds.
+--restart-at N starts the SQLite run over from its files after round N, like a restarted server, and checks
+that the round and summary counters go on where they were.
+
+    python bench_checkpointer.py --rounds 1000 --every 100 --restart-at 500
+"""
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def rss_mib():
+    # Current RSS on Linux, the peak elsewhere
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def disk_mib(path):
+    return sum(os.path.getsize(path + suffix) for suffix in ("", "-wal", "-shm") if os.path.exists(path + suffix)) / 2**20
+
+
+def soak(saver, rounds, every, folder, restart_at = 0):
+
+    os.environ["FRPG_FAKE_LLM"] = "1"
+    os.environ["FRPG_FAKE_LLM_LATENCY"] = "0"
+
+    from langgraph.checkpoint.memory import MemorySaver
+
+    from loop_graph import LoopGraph
+    from sessions import registry
+    from static_objects import load_game
+
+    def start_session():
+        session = registry.create(f"soak-{saver}", rag_folder=f"{folder}/index", checkpoint_path=f"{folder}/checkpoints.sqlite")
+        load_game("game_1.pkl", session.game)
+        return session, LoopGraph(session=session, checkpointer=MemorySaver() if saver == "memory" else None)
+
+    session, loop = start_session()
+
+    print(f"{saver}:")
+    print(f"{'round':>7}{'rss MiB':>10}{'disk MiB':>10}{'checkpoints':>13}{'ms/turn':>10}")
+
+    start = time.perf_counter()
+    for round_no in range(1, rounds + 1):
+        loop.invoke(f"I keep exploring. ({round_no})")
+
+        if round_no % every == 0:
+            elapsed = time.perf_counter() - start
+            checkpoints = sum(1 for _ in loop.graph.checkpointer.list(loop.config))
+            disk = disk_mib(session.checkpoint_path) if saver == "sqlite" else 0.0
+            print(f"{round_no:>7}{rss_mib():>10.1f}{disk:>10.2f}{checkpoints:>13}{elapsed / every * 1000:>10.1f}", flush=True)
+            start = time.perf_counter()
+
+        if round_no == restart_at and saver == "sqlite":
+            if loop.pending_summary is not None:
+                loop.pending_summary.result()
+            before = loop.counters()
+            session.close()
+            registry.remove(session.session_id)
+
+            session, loop = start_session()
+            after = loop.counters()
+            print(f"restarted after round {round_no}: {before} -> {after}", flush=True)
+            if after["round"] != before["round"] or after["summary_calls"] != before["summary_calls"]:
+                raise SystemExit("the counters didn't survive the restart")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=1000)
+    parser.add_argument("--every", type=int, default=100)
+    parser.add_argument("--saver", choices=["sqlite", "memory", "both"], default="both")
+    parser.add_argument("--restart-at", type=int, default=0, help="restart the SQLite run after this round, 0 for never")
+    args = parser.parse_args()
+
+    if args.saver == "both":
+        for saver in ("sqlite", "memory"):
+            subprocess.run([sys.executable, __file__, "--rounds", str(args.rounds), "--every", str(args.every), "--saver", saver,
+                            "--restart-at", str(args.restart_at)], check=True)
+    else:
+        with tempfile.TemporaryDirectory() as folder:
+            soak(args.saver, args.rounds, args.every, folder, args.restart_at)
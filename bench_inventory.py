@@ -0,0 +1,141 @@
+"""
+Inventory tool application on NPCs with large inventories, dict model vs typed model.
+
+The dict baseline is the previous implementation of the inventory tools (a list of item dicts scanned by
+name on every call). The typed model runs the real tools of game_functions on Character objects. Both
+apply the same seeded mix of item replacements, additions and deletions.
+
+    python bench_inventory.py --characters 8 --items 2000 --ops 20000
+"""
+
+import argparse
+import random
+import time
+
+import game_functions
+from character_model import characters_from_dicts, characters_to_dicts
+from sessions import registry, use_session
+
+
+def dict_add_or_change_item(characters, character_name, is_weapon, item_name, details, stats, value):
+    if is_weapon:
+        template = {"name": item_name, "details": details, "stats": stats, "value": value}
+    else:
+        template = {"name": item_name, "details": details, "value": value}
+
+    inventory = characters[character_name.lower()]["inventory"]
+
+    for idx, item in enumerate(inventory):
+        if item.get("name") == item_name:
+            inventory[idx] = template
+            break
+    else:
+        inventory.append(template)
+
+
+def dict_delete_item(characters, character_name, item_name):
+    inventory = characters[character_name.lower()]["inventory"]
+
+    for idx, item in enumerate(inventory):
+        if item.get("name") == item_name:
+            del inventory[idx]
+            break
+    else:
+        raise ValueError(f"{item_name} isn't in the inventory.")
+
+
+def make_characters(count, items):
+    characters = {}
+    for i in range(count):
+        name = f"npc {i}"
+        inventory = []
+        for j in range(items):
+            item = {"name": f"item {j}", "details": f"Item number {j} of {name}.", "value": j % 50}
+            if j % 3 == 0:
+                item = {"name": item["name"], "details": item["details"], "stats": {"damage": j % 20}, "value": item["value"]}
+            inventory.append(item)
+        characters[name] = {"name": name, "details": f"{name} of the benchmark.", "stats": {"power": 3}, "money": 100, "inventory": inventory}
+    return characters
+
+
+def make_ops(characters, count, seed):
+    """A replay-able list of (kind, character, item name) operations, always valid at the time they run."""
+
+    rng = random.Random(seed)
+    names = {name: [item["name"] for item in character["inventory"]] for name, character in characters.items()}
+    next_id = {name: len(items) for name, items in names.items()}
+
+    ops = []
+    for _ in range(count):
+        name = rng.choice(list(names))
+        roll = rng.random()
+        if roll < 0.6 and names[name]:
+            ops.append(("change", name, rng.choice(names[name])))
+        elif roll < 0.8 or not names[name]:
+            item_name = f"item {next_id[name]}"
+            next_id[name] += 1
+            names[name].append(item_name)
+            ops.append(("change", name, item_name))
+        else:
+            item_name = names[name].pop(rng.randrange(len(names[name])))
+            ops.append(("delete", name, item_name))
+    return ops
+
+
+def run_dict(characters, ops):
+    for kind, name, item_name in ops:
+        if kind == "change":
+            dict_add_or_change_item(characters, name, True, item_name, "Changed.", {"damage": 1}, 10)
+        else:
+            dict_delete_item(characters, name, item_name)
+
+
+def run_typed(session, ops):
+    add = game_functions.add_or_change_item_to_character_inventory.func
+    delete = game_functions.delete_item_from_character_inventory.func
+    with use_session(session):
+        for kind, name, item_name in ops:
+            if kind == "change":
+                add(name, True, item_name, "Changed.", {"damage": 1}, 10)
+            else:
+                delete(name, item_name)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--characters", type=int, default=8)
+    parser.add_argument("--items", type=int, default=2000)
+    parser.add_argument("--ops", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    source = make_characters(args.characters, args.items)
+    ops = make_ops(source, args.ops, args.seed)
+
+    characters = make_characters(args.characters, args.items)
+    start = time.perf_counter()
+    run_dict(characters, ops)
+    dict_time = time.perf_counter() - start
+
+    session = registry.create("bench-inventory")
+    fresh = make_characters(args.characters, args.items)
+    start = time.perf_counter()
+    session.game.characters = characters_from_dicts(fresh)
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    run_typed(session, ops)
+    typed_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    dumped = characters_to_dicts(session.game.characters)
+    dump_time = time.perf_counter() - start
+
+    assert dumped == characters, "typed and dict models ended in different states"
+
+    total_items = sum(len(character["inventory"]) for character in characters.values())
+    print(f"{args.characters} characters x {args.items} items, {args.ops} tool calls")
+    print(f"dict  : {dict_time:7.3f} s  {args.ops / dict_time:10.0f} calls/s")
+    print(f"typed : {typed_time:7.3f} s  {args.ops / typed_time:10.0f} calls/s  ({dict_time / typed_time:.1f}x)")
+    print(f"round trip of {total_items} items: from dicts {load_time * 1000:.1f} ms, to dicts {dump_time * 1000:.1f} ms")
@@ -0,0 +1,135 @@
+"""
+Recall@3, memory and query latency of the RAG store's index types on synthetic campaign text.
+
+Builds a PersistentRAGStore per index type (see rag_store.index_types) from --chunks generated chunks
+of play history, then searches it with --queries sentences taken from random chunks. Recall@3 is
+measured against exact brute-force search over the same vectors.
+
+The default embeddings are a deterministic bag of words (one random unit vector per word, summed), so
+the benchmark runs offline and chunks that share names and places end up close together like with a
+sentence model. --embeddings minilm uses the game's MiniLM model instead.
+
+    python bench_rag_index.py --chunks 20000 --queries 500
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+from langchain_core.documents import Document
+
+names = ["Thoren", "Marla", "Zara", "Eldric", "Nyssa", "Borin", "Ilyas", "Sefa", "Kaelen", "Morwen", "Tamsin", "Oduya"]
+places = ["the harbor", "the old mill", "Blackfen marsh", "the silver mine", "the temple ruins", "the king's road", "the tavern", "the watchtower"]
+items = ["a rusty key", "a silver blade", "a sealed letter", "healing herbs", "a map of the north", "a cursed amulet", "forty gold coins", "a lantern"]
+actions = ["meets", "argues with", "follows", "hides from", "trades with", "fights", "questions", "rescues"]
+events = ["a storm breaks over", "guards search", "smoke rises from", "wolves howl near", "a crowd gathers at", "strangers camp at"]
+
+
+class WordEmbeddings:
+    """Sum of one seeded random unit vector per word, normalized. Offline stand-in for a sentence model."""
+
+    def __init__(self, size = 384):
+        self.size = size
+        self.words = {}
+
+    def _word(self, word):
+        if word not in self.words:
+            seed = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), "little")
+            vector = np.random.default_rng(seed).standard_normal(self.size).astype("float32")
+            self.words[word] = vector / np.linalg.norm(vector)
+        return self.words[word]
+
+    def embed_query(self, text):
+        vector = sum(self._word(word) for word in text.lower().split())
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+def campaign_chunks(count, rng):
+    """count chunks of 3 to 5 sentences, each tagged with the round it would come from."""
+    chunks = []
+    for i in range(count):
+        sentences = []
+        for _ in range(rng.randint(3, 5)):
+            if rng.random() < 0.6:
+                sentences.append(f"{rng.choice(names)} {rng.choice(actions)} {rng.choice(names)} at {rng.choice(places)} over {rng.choice(items)}.")
+            else:
+                sentences.append(f"In round {i // 3} {rng.choice(events)} {rng.choice(places)}.")
+        chunks.append(Document(page_content=" ".join(sentences), metadata={"round no": i // 3}))
+    return chunks
+
+
+def measure(index_type, docs, embeddings, queries, truth, folder):
+    from rag_store import PersistentRAGStore
+
+    store = PersistentRAGStore(f"{folder}/{index_type}", embeddings, compact_every=len(docs) + 1, index_type=index_type)
+    store.add_documents(docs, ids=[str(i) for i in range(len(docs))])
+
+    start = time.perf_counter()
+    store.compact()
+    build = time.perf_counter() - start
+
+    hits = 0
+    latencies = []
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        found = store._vector_candidates(query, 3)
+        latencies.append(time.perf_counter() - start)
+        hits += len({int(doc_id) for _, doc_id in found} & set(expected))
+
+    latencies.sort()
+    return {
+        "type": index_type,
+        "recall": hits / (3 * len(queries)),
+        "index_mib": os.path.getsize(store._path(store.index_file)) / 2**20,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+        "build_s": build,
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--types", default="flat,sq8,ivf,ivf_sq8,pq", help="comma separated rag_store.index_types")
+    parser.add_argument("--embeddings", choices=["words", "minilm"], default="words")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    docs = campaign_chunks(args.chunks, rng)
+
+    if args.embeddings == "minilm":
+        from loop_graph import get_embedding_model
+        embeddings = get_embedding_model()
+    else:
+        embeddings = WordEmbeddings()
+
+    # One sentence of a random chunk, like a player referring back to an earlier scene
+    queries_text = [rng.choice(rng.choice(docs).page_content.split(". ")) for _ in range(args.queries)]
+    queries = np.asarray(embeddings.embed_documents(queries_text), dtype="float32")
+
+    vectors = np.asarray(embeddings.embed_documents([doc.page_content for doc in docs]), dtype="float32")
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    truth = [list(row) for row in exact.search(queries, 3)[1]]
+
+    print(f"{args.chunks} chunks, {args.queries} queries, {args.embeddings} embeddings ({vectors.shape[1]} dimensions)")
+    print(f"{'index':<10}{'recall@3':>10}{'index MiB':>11}{'p50 ms':>9}{'p95 ms':>9}{'build s':>9}")
+
+    with tempfile.TemporaryDirectory() as folder:
+        for index_type in args.types.split(","):
+            result = measure(index_type, docs, embeddings, queries, truth, folder)
+            print(f"{result['type']:<10}{result['recall']:>10.3f}{result['index_mib']:>11.2f}"
+                  f"{result['p50_ms']:>9.2f}{result['p95_ms']:>9.2f}{result['build_s']:>9.1f}", flush=True)
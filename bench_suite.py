@@ -0,0 +1,178 @@
+"""
+End-to-end benchmark of game creation (FullGraph) and play (LoopGraph) on the offline fake LLM.
+
+Every model is replaced by fake_llm.FakeChatModel (FRPG_FAKE_LLM=1), so the numbers show what the graph
+code costs on top of a fixed model latency: per-node wall time split into model wait and own work, graph
+overhead per turn, prompt sizes and memory. Run it before and after a change to catch regressions.
+
+    python bench_suite.py --rounds 10 --latency 0.05 --tokens 64
+"""
+
+import argparse
+import os
+import resource
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+
+class NodeTimer(BaseCallbackHandler):
+    """Wall time of every graph node run, from LangChain's chain callbacks."""
+
+    def __init__(self):
+        self.started = {}
+        self.durations = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id = None, metadata = None, **kwargs):
+        node = (metadata or {}).get("langgraph_node")
+        # Only the node itself, not the runnables nested inside it (a RunnableLambda node has the same name)
+        if node is not None and kwargs.get("name") == node:
+            with self.lock:
+                if self.started.get(parent_run_id, (None,))[0] != node:
+                    self.started[run_id] = (node, time.perf_counter())
+
+    def _finish(self, run_id):
+        with self.lock:
+            started = self.started.pop(run_id, None)
+            if started is not None:
+                node, start = started
+                self.durations[node].append(time.perf_counter() - start)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id)
+
+
+def node_table(timer, calls):
+    """One line per node: runs, wall time, model wait, own time and prompt size."""
+
+    model_time = defaultdict(float)
+    prompt_tokens = defaultdict(list)
+    for node, seconds, input_tokens, _ in calls:
+        model_time[node] += seconds
+        prompt_tokens[node].append(input_tokens)
+
+    lines = [f"{'node':<20}{'runs':>6}{'total ms':>11}{'mean ms':>10}{'model ms':>11}{'own ms':>9}{'prompt tok':>12}"]
+    for node in sorted(set(timer.durations) | set(model_time), key=lambda name: -sum(timer.durations.get(name, [0]))):
+        durations = timer.durations.get(node, [])
+        total = sum(durations)
+        tokens = prompt_tokens.get(node)
+        lines.append(
+            f"{node:<20}{len(durations):>6}{total * 1000:>11.1f}{(total / len(durations) if durations else 0) * 1000:>10.1f}"
+            f"{model_time[node] * 1000:>11.1f}{max(total - model_time[node], 0) * 1000:>9.1f}"
+            f"{(f'{statistics.mean(tokens):.0f}/{max(tokens)}' if tokens else '-'):>12}"
+        )
+    return "\n".join(lines)
+
+
+def run_creation(session, theme, timer, model):
+    from creation_graph import FullGraph, creation_inputs
+    from static_objects import new_game
+
+    full_graph = FullGraph(session=session)
+    full_graph.config = {**full_graph.config, "callbacks": [*full_graph.config["callbacks"], timer]}
+
+    model.reset_calls()
+    start = time.perf_counter()
+
+    new_game(session.game)
+    for inputs in creation_inputs(theme, session.game):
+        graph, inputs = full_graph.graph_for(inputs)
+        graph.invoke(inputs, full_graph.config)
+
+    wall = time.perf_counter() - start
+
+    start = time.perf_counter()
+    full_graph.check_balance(fights=10_000)
+    balance = time.perf_counter() - start
+
+    return wall, balance, model.calls
+
+
+# Nodes whose model calls run on the summary executor, next to the turn instead of inside it
+background_nodes = {"schedule_summary", "merge_summary", "background"}
+
+
+def run_play(session, rounds, timer, model):
+    from loop_graph import LoopGraph
+
+    loop = LoopGraph(session=session)
+    loop.config = {**loop.config, "callbacks": [*loop.config["callbacks"], timer]}
+
+    model.reset_calls()
+    turns = []
+    for round_no in range(rounds):
+        before = len(model.calls)
+        start = time.perf_counter()
+        loop.invoke(f"I look around and talk to the others. ({round_no})")
+        wall = time.perf_counter() - start
+
+        # Summaries run in the background, only the model wait of the turn's own nodes counts against it
+        waited = sum(seconds for node, seconds, _, _ in model.calls[before:] if node not in background_nodes)
+        turns.append((wall, wall - waited))
+
+    if loop.pending_summary is not None:
+        loop.pending_summary.result()
+
+    return turns, model.calls, loop.summary_calls
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per fake model call")
+    parser.add_argument("--tokens", type=int, default=64, help="completion tokens of a fake text answer")
+    parser.add_argument("--theme", default="medieval dynasty")
+    args = parser.parse_args()
+
+    os.environ["FRPG_FAKE_LLM"] = "1"
+    os.environ["FRPG_FAKE_LLM_LATENCY"] = str(args.latency)
+    os.environ["FRPG_FAKE_LLM_TOKENS"] = str(args.tokens)
+
+    tracemalloc.start()
+
+    from fake_llm import fake_chat_model
+    from sessions import registry
+
+    model = fake_chat_model()
+
+    with tempfile.TemporaryDirectory() as folder:
+        session = registry.create("bench-suite", rag_folder=f"{folder}/index", checkpoint_path=f"{folder}/checkpoints.sqlite")
+
+        creation_timer = NodeTimer()
+        creation_wall, balance_time, creation_calls = run_creation(session, args.theme, creation_timer, model)
+        creation_model = sum(seconds for _, seconds, _, _ in creation_calls)
+
+        play_timer = NodeTimer()
+        turns, play_calls, summary_calls = run_play(session, args.rounds, play_timer, model)
+
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kB on Linux
+
+    print(f"fake model: {args.latency * 1000:.0f} ms per call, {args.tokens} completion tokens")
+    print()
+    print(f"creation: {creation_wall:.2f} s, {len(creation_calls)} model calls waiting {creation_model:.2f} s, "
+          f"graph overhead {creation_wall - creation_model:.2f} s, balance check {balance_time:.2f} s, "
+          f"{len(session.game.characters)} characters")
+    print(node_table(creation_timer, creation_calls))
+    print()
+
+    walls = sorted(wall for wall, _ in turns)
+    overheads = sorted(overhead for _, overhead in turns)
+    p95 = walls[min(len(walls) - 1, int(len(walls) * 0.95))]
+    print(f"play: {args.rounds} rounds, turn p50 {statistics.median(walls) * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms, "
+          f"graph overhead p50 {statistics.median(overheads) * 1000:.1f} ms, max {overheads[-1] * 1000:.1f} ms")
+    print(node_table(play_timer, play_calls))
+    print(f"summaries: {summary_calls} summarizer calls, {summary_calls / args.rounds:.2f} per round")
+    print()
+    print(f"memory: python heap {current / 2**20:.1f} MiB (peak {peak / 2**20:.1f} MiB), max RSS {max_rss:.0f} MiB")
@@ -0,0 +1,175 @@
+"""
+Typed game state for characters and their inventories.
+
+Characters used to be plain dicts holding a list of item dicts, so every inventory change scanned the list
+and every caller reached in with string keys. Character and Item are __slots__ classes and the inventory
+is indexed by item name, so looking up, replacing and deleting an item are O(1) and insertion order is kept.
+
+to_dict/from_dict convert from and to the original dict shape, which is still what the prompts show and
+what old saves contain. repr() of both types is the repr of that dict, so str(game.characters) reads exactly
+as it did before.
+"""
+
+# Keys of the original character dict, in their original order. Anything else is kept in Character.extra.
+character_keys = ("name", "details", "stats", "money", "inventory", "hp", "character_type")
+
+default_hp = 100
+
+
+class Item:
+
+    __slots__ = ("name", "details", "value", "stats")
+
+    def __init__(self, name, details = "", value = 0, stats = None):
+        self.name = name
+        self.details = details
+        self.value = value
+        self.stats = stats  # None for regular items, a dict for weapons
+
+    @property
+    def is_weapon(self):
+        return self.stats is not None
+
+    def to_dict(self):
+        item = {"name": self.name, "details": self.details}
+        if self.stats is not None:
+            item["stats"] = self.stats
+        item["value"] = self.value
+        return item
+
+    @classmethod
+    def from_dict(cls, item):
+        return cls(item.get("name"), item.get("details", ""), item.get("value", 0), item.get("stats"))
+
+    def __eq__(self, other):
+        if not isinstance(other, Item):
+            return NotImplemented
+        return (self.name, self.details, self.value, self.stats) == (other.name, other.details, other.value, other.stats)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def __reduce__(self):
+        return (Item.from_dict, (self.to_dict(),))
+
+
+class Inventory:
+    """Items of one character indexed by name. Iterating yields the items in the order they were added."""
+
+    __slots__ = ("_items",)
+
+    def __init__(self, items = ()):
+        self._items = {}
+        for item in items:
+            self.put(item)
+
+    def put(self, item):
+        """Adds item, or replaces the item with the same name in place. Returns True when it replaced one."""
+        replaced = item.name in self._items
+        self._items[item.name] = item
+        return replaced
+
+    def remove(self, name):
+        """Removes and returns the item called name, raises KeyError when there is none."""
+        return self._items.pop(name)
+
+    def get(self, name, default = None):
+        return self._items.get(name, default)
+
+    def names(self):
+        return list(self._items)
+
+    def __contains__(self, name):
+        return name in self._items
+
+    def __iter__(self):
+        return iter(self._items.values())
+
+    def __len__(self):
+        return len(self._items)
+
+    def __eq__(self, other):
+        if not isinstance(other, Inventory):
+            return NotImplemented
+        return list(self._items.values()) == list(other._items.values())
+
+    def to_list(self):
+        return [item.to_dict() for item in self._items.values()]
+
+    @classmethod
+    def from_list(cls, items):
+        return cls(Item.from_dict(item) for item in items or ())
+
+    def __repr__(self):
+        return repr(self.to_list())
+
+    def __reduce__(self):
+        return (Inventory.from_list, (self.to_list(),))
+
+
+class Character:
+
+    __slots__ = ("name", "details", "stats", "money", "inventory", "hp", "character_type", "extra")
+
+    def __init__(self, name, details = "", stats = None, money = 0, inventory = None, hp = None, character_type = None, extra = None):
+        self.name = name
+        self.details = details
+        self.stats = stats if stats is not None else {}
+        self.money = money
+        self.inventory = inventory if inventory is not None else Inventory()
+        self.hp = hp  # None until the character is first healed or damaged, see current_hp
+        self.character_type = character_type
+        self.extra = extra if extra is not None else {}
+
+    @property
+    def current_hp(self):
+        return default_hp if self.hp is None else self.hp
+
+    def to_dict(self):
+        character = {
+            "name": self.name,
+            "details": self.details,
+            "stats": self.stats,
+            "money": self.money,
+            "inventory": self.inventory.to_list(),
+        }
+        if self.hp is not None:
+            character["hp"] = self.hp
+        if self.character_type is not None:
+            character["character_type"] = self.character_type
+        character.update(self.extra)
+        return character
+
+    @classmethod
+    def from_dict(cls, character):
+        return cls(
+            character.get("name"),
+            character.get("details", ""),
+            character.get("stats"),
+            character.get("money", 0),
+            Inventory.from_list(character.get("inventory")),
+            character.get("hp"),
+            character.get("character_type"),
+            {key: value for key, value in character.items() if key not in character_keys},
+        )
+
+    def __eq__(self, other):
+        if not isinstance(other, Character):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def __reduce__(self):
+        # Saves store the dict shape, so adding a field later does not break existing pickles
+        return (Character.from_dict, (self.to_dict(),))
+
+
+def characters_from_dicts(characters):
+    """Converts a characters dict of an old save (name -> dict) to Character objects. Characters that already are one are kept."""
+    return {name: character if isinstance(character, Character) else Character.from_dict(character) for name, character in characters.items()}
+
+
+def characters_to_dicts(characters):
+    return {name: character.to_dict() for name, character in characters.items()}
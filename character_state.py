@@ -0,0 +1,145 @@
+import copy
+import json
+
+# Long descriptions are the bulk of the character data but rarely matter turn to turn
+character_details_chars = 160
+item_details_chars = 80
+
+
+def shorten(text, limit):
+    text = str(text)
+    return text if len(text) <= limit else text[:limit - 3] + "..."
+
+
+def compact_item(item):
+    compact = {"name": item.name, "value": item.value}
+    if item.stats:
+        compact["stats"] = dict(item.stats)
+    compact["details"] = shorten(item.details, item_details_chars)
+    return compact
+
+
+def compact_character(character):
+    compact = {"name": character.name, "stats": copy.deepcopy(character.stats), "money": character.money}
+    if character.hp is not None:
+        compact["hp"] = character.hp
+    if character.character_type is not None:
+        compact["character_type"] = character.character_type
+    compact.update(copy.deepcopy(character.extra))
+    compact["details"] = shorten(character.details, character_details_chars)
+    compact["inventory"] = [compact_item(item) for item in character.inventory]
+    return compact
+
+
+def to_json(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def diff_character(name, old, new):
+    """Lines describing how the compact character old became new."""
+
+    if old is None:
+        return [f"+ new character {name}: {to_json(new)}"]
+    if new is None:
+        return [f"- {name} left the game"]
+
+    lines = []
+    for key in sorted(set(old) | set(new)):
+        if key == "inventory" or old.get(key) == new.get(key):
+            continue
+        lines.append(f"{name}.{key}: {to_json(old.get(key))} -> {to_json(new.get(key))}")
+
+    old_items = {item["name"]: item for item in old.get("inventory", [])}
+    new_items = {item["name"]: item for item in new.get("inventory", [])}
+
+    for item_name, item in new_items.items():
+        if item_name not in old_items:
+            lines.append(f"{name} gained {to_json(item)}")
+        elif old_items[item_name] != item:
+            lines.append(f"{name} item changed {to_json(item)}")
+
+    for item_name in old_items:
+        if item_name not in new_items:
+            lines.append(f"{name} lost {item_name}")
+
+    return lines
+
+
+class CharacterStateEncoder:
+    """
+    Encodes game.characters for the prompts as a compact snapshot plus the changes since that snapshot.
+
+    The snapshot stays byte-identical across turns (it lives in the cached part of the GM prompt) and is
+    only rebuilt once the accumulated changes get longer than rebase_ratio of the snapshot. Every other
+    turn the prompt carries just the short list of changes. Only characters marked dirty through
+    GameContext.touch are re-encoded.
+    """
+
+    def __init__(self, rebase_ratio = 0.25):
+        self.rebase_ratio = rebase_ratio
+
+        self.snapshot = None
+        self.snapshot_text = ""
+        self.snapshot_versions = {}
+
+        self.current = {}
+        self.current_versions = {}
+
+        self.delta_text = ""
+        self.rebased = False
+
+        self.characters_id = None
+
+    def _refresh(self, game):
+        """Re-encodes the characters whose version changed since the last call."""
+
+        if id(game.characters) != self.characters_id:
+            # A new or loaded game replaced the whole characters dict, start over
+            self.characters_id = id(game.characters)
+            self.current = {}
+            self.current_versions = {}
+            self.snapshot = None
+
+        names = set(game.characters)
+        for name in list(self.current):
+            if name not in names:
+                del self.current[name]
+                del self.current_versions[name]
+
+        for name, character in game.characters.items():
+            version = game.version_of(name)
+            if name not in self.current or self.current_versions[name] != version:
+                self.current[name] = compact_character(character)
+                self.current_versions[name] = version
+
+    def _rebase(self):
+        self.snapshot = dict(self.current)
+        self.snapshot_versions = dict(self.current_versions)
+        self.snapshot_text = "\n".join(f"{name}: {to_json(character)}" for name, character in self.snapshot.items())
+        self.delta_text = "No changes."
+        self.rebased = True
+
+    def update(self, game):
+        """Returns (snapshot text, changes since the snapshot) for the current state of game."""
+
+        self._refresh(game)
+        self.rebased = False
+
+        if self.snapshot is None:
+            self._rebase()
+            return self.snapshot_text, self.delta_text
+
+        lines = []
+        for name in list(self.snapshot) + [name for name in self.current if name not in self.snapshot]:
+            if self.snapshot_versions.get(name) == self.current_versions.get(name) and name in self.current:
+                continue
+            lines.extend(diff_character(name, self.snapshot.get(name), self.current.get(name)))
+
+        delta_text = "\n".join(lines) if lines else "No changes."
+
+        if len(delta_text) > self.rebase_ratio * len(self.snapshot_text):
+            self._rebase()
+        else:
+            self.delta_text = delta_text
+
+        return self.snapshot_text, self.delta_text
@@ -1,22 +1,29 @@
 from typing import Annotated, Literal
+from functools import lru_cache
 
 from typing_extensions import TypedDict
 
 from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
-from langgraph.prebuilt import ToolNode, tools_condition
-from langchain.chat_models import init_chat_model
-from langchain_ollama.chat_models import ChatOllama
-from langchain_groq import ChatGroq
+from langgraph.prebuilt import ToolNode
+from langgraph.types import Send
 from langchain_core.messages import HumanMessage,SystemMessage,AIMessage
-from langchain.prompts import ChatPromptTemplate
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableLambda
 
 from pydantic import BaseModel,Field
 
-from static_objects import game
-from game_functions import add_or_change_character,add_or_change_item_to_character_inventory,define_rules,define_story
+from sessions import current_session
+from static_objects import generate_tasks,new_game
+from game_functions import tool_batch,add_or_change_character,add_or_change_item_to_character_inventory,define_rules,define_story
+from encounter_sim import balance_report
+from fake_llm import fake_chat_model
+from instrumentation import annotate
 
+import asyncio
+import json
+import operator
 import os
 
 class State(TypedDict):
@@ -26,12 +33,19 @@ class State(TypedDict):
         current_task:str
         current_schema_no:int
 
-llm = ChatGroq(
-   groq_api_key=os.getenv("GROQ_API_KEY"),
-    model="qwen/qwen3-32b",  # veya Groq'un desteklediği başka bir model
-    reasoning_effort="default",
-    reasoning_format="hidden"
-)
+@lru_cache(maxsize=None)
+def get_llm():
+    if (fake := fake_chat_model()) is not None:
+        return fake
+
+    from langchain_groq import ChatGroq
+
+    return ChatGroq(
+        groq_api_key=os.getenv("GROQ_API_KEY"),
+        model="qwen/qwen3-32b",  # veya Groq'un desteklediği başka bir model
+        reasoning_effort="default",
+        reasoning_format="hidden"
+    )
 
 #llm = ChatOllama(model = "llama3.2:3b")
 
@@ -45,7 +59,9 @@ tools = [
 
 # llm = init_chat_model("google_genai:gemini-2.0-flash")
 
-llm_with_tools = llm.bind_tools(tools)
+@lru_cache(maxsize=None)
+def get_llm_with_tools():
+    return get_llm().bind_tools(tools)
 
 class Feedback(BaseModel):
 
@@ -57,28 +73,43 @@ class Feedback(BaseModel):
         description="You are an evaluator for an FRPG game. The user will send you a prompt regarding the requested format and an output for that format, and you will check if the produced output fits the format. Were the requests met? Are there blank fields that should not be blank? Don't be too harsh!",
     )
 
-evaluator = llm.with_structured_output(Feedback)
+@lru_cache(maxsize=None)
+def get_evaluator():
+    return get_llm().with_structured_output(Feedback)
 
-def chatbot(state: State):
-    print("chatbot stage")
+def chatbot_messages(state: State):
     if state.get("feedback"):
         state["messages"].append("The format is wrong because: "+state.get("feedback")+", please correct it.")
-        message = llm_with_tools.invoke(state["messages"])
-    
-    else:  
-        
-        message = llm_with_tools.invoke(state["messages"])
+
+    return state["messages"]
+
+def chatbot(state: State):
+    message = get_llm_with_tools().invoke(chatbot_messages(state))
     
     return {"messages": [message]}
 
-def evaluator_stage(state:State):
-    print("evaluator stage")
+async def achatbot(state: State):
+    message = await get_llm_with_tools().ainvoke(chatbot_messages(state))
+
+    return {"messages": [message]}
+
+def evaluator_messages(state:State):
+    game = current_session().game
     schema = [game.story,game.rules,game.characters,game.characters]
     schema = schema[state["current_schema_no"]]
     human_message = "The requested task is this:" + state["current_task"]+"The output generated for this task is this:"+str(schema)+" Are there any mistakes here? If so, please specify the source of the mistake, in detail providing the exact location of the mistake. Else, Answer with yes. Note, the tools that were available in the task are not available for you, don't take tool usage into consideration."
-    response = evaluator.invoke([SystemMessage("You are an evaluator for an FRPG game. The user will send you a prompt regarding the requested format and an output for that format, and you will check if the produced output fits the format. Are there blank fields that should not be blank? Don't be too harsh the format doesn't have to exactly comply. If there isn't any blank field or structural mistake, then no problem!"),HumanMessage(human_message)])
+    return [SystemMessage("You are an evaluator for an FRPG game. The user will send you a prompt regarding the requested format and an output for that format, and you will check if the produced output fits the format. Are there blank fields that should not be blank? Don't be too harsh the format doesn't have to exactly comply. If there isn't any blank field or structural mistake, then no problem!"),HumanMessage(human_message)]
+
+def evaluator_stage(state:State):
+    response = get_evaluator().invoke(evaluator_messages(state))
     
-    print(response.format_comply_or_not,response.feedback,game.characters)
+    annotate(verdict=response.format_comply_or_not,feedback=response.feedback)
+    return {"format_comply_or_not":response.format_comply_or_not, "feedback":response.feedback}
+
+async def aevaluator_stage(state:State):
+    response = await get_evaluator().ainvoke(evaluator_messages(state))
+
+    annotate(verdict=response.format_comply_or_not,feedback=response.feedback)
     return {"format_comply_or_not":response.format_comply_or_not, "feedback":response.feedback}
 
 def route_feedback(state:State):
@@ -86,8 +117,8 @@ def route_feedback(state:State):
     return state["format_comply_or_not"]
 
 def tool_stage(state:State):
+    current_session().applied_effects.start_batch(tool_batch())
     tool_node = ToolNode(tools=tools)
-    print("tool stage")
     return tool_node
 
 def route_tools(
@@ -122,19 +153,155 @@ def prepare_prompts_node(state):
     # State'e ekle
     return {"messages": formatted_messages}
 
+item_schema_no = 3
+
+def creation_inputs(theme, game):
+    """
+    Yields the graph input for every creation task in order. It is a generator on purpose, the
+    summary of the already created parts is read from game right before each task runs.
+    """
+    temp = f"The details about my game are provided, please comply these and especially the game theme:{theme} "
+    tasks = generate_tasks(theme)
+    for i in range(len(tasks)):
+        
+        schema = {"story is: ":game.story,"rules are:":game.rules,"characters are:":game.characters} # schema is provided here so that the values inside are up to date
+
+        task = tasks[i]
+        schema_no = i
+
+        if i!=0:
+            key = list(schema.keys())[i-1]
+            temp+= (key+str(schema[key]))
+            task+=temp
+
+        yield {"messages": [{"role": "user", "content":task},],"current_task":task,"current_schema_no":schema_no}
+
+# Parallel item creation: every character gets its own branch that generates and validates only that
+# character's inventory, so creation time follows the slowest character instead of the sum of all of them.
+
+class GeneratedItem(BaseModel):
+
+    name: str = Field(description="Name of the item.")
+    details: str = Field(description="Description or explanation of the item.")
+    is_weapon: bool = Field(description="True if the item is a weapon.")
+    stats: dict = Field(default_factory=dict, description="Stats of the item as a dictionary, e.g. {'damage': 10}. Can be empty for regular items.")
+    value: int = Field(description="Value of the item in in-game currency.")
+
+class CharacterItems(BaseModel):
+
+    items: list[GeneratedItem] = Field(description="Items and weapons in the character's inventory.")
+
+class ItemState(TypedDict):
+        messages: Annotated[list, add_messages]
+        current_task:str
+        item_results: Annotated[list, operator.add]
+
+class CharacterItemState(TypedDict):
+        character:str
+        current_task:str
+
+@lru_cache(maxsize=None)
+def get_item_generator():
+    return get_llm().with_structured_output(CharacterItems)
+
+max_item_attempts = 2
+
+def fan_out_characters(state:ItemState):
+    return [Send("character_items", {"character": name, "current_task": state["current_task"]}) for name in current_session().game.characters]
+
+def character_item_messages(state:CharacterItemState, feedback = None):
+    character = current_session().game.characters[state["character"]]
+    sheet = {key: value for key, value in character.to_dict().items() if key != "inventory"}
+
+    prompt = state["current_task"]+f" Only create the items of this character now: {json.dumps(sheet)}"
+    if feedback:
+        prompt += " The previous items were wrong because: "+feedback+", please correct them."
+
+    return [system_message, HumanMessage(prompt)]
+
+def item_evaluator_messages(state:CharacterItemState, generated:CharacterItems):
+    human_message = "The requested task is this:" + state["current_task"]+f" (only for the character {state['character']}) The output generated for this task is this:"+generated.model_dump_json()+" Are there any mistakes here? If so, please specify the source of the mistake, in detail providing the exact location of the mistake. Else, Answer with yes."
+    return [SystemMessage("You are an evaluator for an FRPG game. The user will send you a prompt regarding the requested format and an output for that format, and you will check if the produced output fits the format. Are there blank fields that should not be blank? Don't be too harsh the format doesn't have to exactly comply. If there isn't any blank field or structural mistake, then no problem!"),HumanMessage(human_message)]
+
+def character_items(state:CharacterItemState):
+    feedback = None
+    for attempt in range(max_item_attempts):
+        generated = get_item_generator().invoke(character_item_messages(state,feedback))
+        response = get_evaluator().invoke(item_evaluator_messages(state,generated))
+        if response.format_comply_or_not == "comply":
+            break
+        feedback = response.feedback
+
+    annotate(character=state["character"],retries=attempt)
+
+    return {"item_results": [(state["character"], generated)]}
+
+async def acharacter_items(state:CharacterItemState):
+    feedback = None
+    for attempt in range(max_item_attempts):
+        generated = await get_item_generator().ainvoke(character_item_messages(state,feedback))
+        response = await get_evaluator().ainvoke(item_evaluator_messages(state,generated))
+        if response.format_comply_or_not == "comply":
+            break
+        feedback = response.feedback
+
+    annotate(character=state["character"],retries=attempt)
+
+    return {"item_results": [(state["character"], generated)]}
+
+def merge_items(state:ItemState):
+    lines = []
+    for character, generated in state["item_results"]:
+        for item in generated.items:
+            add_or_change_item_to_character_inventory.invoke({
+                "character_name": character,
+                "is_weapon": item.is_weapon,
+                "item_name": item.name,
+                "details": item.details,
+                "stats": item.stats,
+                "value": item.value,
+            })
+        lines.append(f"{character}: {', '.join(item.name for item in generated.items)}")
+
+    return {"messages": [AIMessage("Created the inventories:\n"+"\n".join(lines))]}
+
+class ParallelItemGraph:
+
+    def __init__(self,session = None):
+
+        self.session = session or current_session()
+
+        self.config = self.session.full_config
+
+        graph_builder = StateGraph(ItemState)
+
+        graph_builder.add_node("character_items", RunnableLambda(character_items,afunc=acharacter_items))
+        graph_builder.add_node("merge_items", merge_items)
+
+        graph_builder.add_conditional_edges(START, fan_out_characters, ["character_items"])
+        graph_builder.add_edge("character_items", "merge_items")
+        graph_builder.add_edge("merge_items", END)
+
+        self.graph = graph_builder.compile()
+
 class FullGraph:
      
-    def __init__(self):
-        
-        self.config = {"configurable": {"thread_id": "4"}, "recursion_limit":25}
+    def __init__(self,session = None,parallel_items = True):
+
+        self.session = session or current_session()
+
+        self.config = self.session.full_config
+
+        # The item task (the last creation task) fans out per character instead of one call for everyone
+        self.item_graph = ParallelItemGraph(self.session) if parallel_items else None
 
         graph_builder = StateGraph(State)
 
         graph_builder.add_node("prepare_prompts", prepare_prompts_node)
 
-        graph_builder.add_node("chatbot", chatbot)
+        graph_builder.add_node("chatbot", RunnableLambda(chatbot,afunc=achatbot))
         graph_builder.add_node("tools", tool_stage)
-        graph_builder.add_node("evaluator", evaluator_stage)
+        graph_builder.add_node("evaluator", RunnableLambda(evaluator_stage,afunc=aevaluator_stage))
 
         graph_builder.add_edge(START, "prepare_prompts")
         graph_builder.add_edge("prepare_prompts", "chatbot")
@@ -165,9 +332,75 @@ class FullGraph:
 
         self.graph = graph
 
-
-# png_data = FullGraph().graph.get_graph().draw_mermaid_png()
-
-# # PNG'yi dosyaya yaz:
-# with open("full_graph.png", "wb") as f:
-#     f.write(png_data)
\ No newline at end of file
+    def graph_for(self, inputs):
+        if self.item_graph is not None and inputs["current_schema_no"] == item_schema_no:
+            return self.item_graph.graph, {"current_task": inputs["current_task"]}
+        return self.graph, inputs
+
+    def stream_task(self, inputs, stream_mode = "values"):
+        graph, inputs = self.graph_for(inputs)
+        yield from graph.stream(inputs, self.config, stream_mode=stream_mode)
+
+    def save_progress(self, snapshot = False):
+        """Makes the finished creation task durable in the session's save journal, if it has one."""
+        journal = self.session.journal
+        if journal is None:
+            return
+        if snapshot:
+            journal.snapshot(self.session.game)
+        else:
+            journal.end_turn(self.session.game)
+
+    def check_balance(self, fights = 10_000):
+        """Simulates duels between the created characters and keeps the report on the session, see encounter_sim."""
+        try:
+            report, flagged = balance_report(self.session.game, fights)
+        except ValueError as error:
+            # Rules or stats the simulator can't read must not stop the creation
+            report, flagged = f"Balance check skipped: {error}", []
+
+        annotate(balance_flagged=flagged)
+        self.session.balance_report = report
+        return report, flagged
+
+    def create(self, theme):
+        """Runs every creation task for theme and returns the session's game."""
+        new_game(self.session.game)
+        self.session.applied_effects.clear()
+        self.save_progress(snapshot=True)
+
+        for inputs in creation_inputs(theme, self.session.game):
+            graph, inputs = self.graph_for(inputs)
+            graph.invoke(inputs, self.config)
+            self.save_progress()
+
+        self.save_progress(snapshot=True)
+        self.check_balance()
+        return self.session.game
+
+    async def acreate(self, theme):
+        new_game(self.session.game)
+        self.session.applied_effects.clear()
+        self.save_progress(snapshot=True)
+
+        for inputs in creation_inputs(theme, self.session.game):
+            graph, inputs = self.graph_for(inputs)
+            await graph.ainvoke(inputs, self.config)
+            self.save_progress()
+
+        self.save_progress(snapshot=True)
+        # Thousands of NumPy fights, keep them off the event loop
+        await asyncio.to_thread(self.check_balance)
+        return self.session.game
+
+    def render_png(self, path):
+        """Draws the graph with mermaid (needs network access) and writes it to path."""
+        png_data = self.graph.get_graph().draw_mermaid_png()
+
+        with open(path, "wb") as f:
+            f.write(png_data)
+
+
+if __name__ == "__main__":
+    # PNG'yi dosyaya yaz:
+    FullGraph().render_png("graph_png/full_graph.png")
\ No newline at end of file
@@ -0,0 +1,337 @@
+"""
+Dice expression engine.
+
+Expressions are sums of dice, numbers and character stats, e.g. "2d10 + REF + 3", "4d6kh3", "1d6! - 1".
+
+    NdS       N dice with S sides (N defaults to 1, "d%" is a d100)
+    NdSkhK    keep the K highest dice (kK is the same), NdSklK keeps the K lowest
+    NdS!      exploding dice, a die showing its maximum is rolled again and added
+    name      a stat of the character, matched case-insensitively by prefix or abbreviation (REF -> reflexes)
+
+Rolls are drawn in NumPy batches from a per-session seeded generator, so a campaign replays the same rolls
+for the same seed. Probabilities of meeting a DR come from the exact distribution (convolution of the
+per-die distributions) where it can be computed, otherwise from a vectorized Monte Carlo estimate.
+"""
+
+import hashlib
+import re
+from functools import lru_cache
+from typing import NamedTuple
+
+import numpy as np
+
+# Exploding dice stop after this many extra rolls per die, the cut off probability is at most 2^-10
+max_explosions = 10
+
+# Keep-highest/lowest distributions are enumerated exactly while outcomes x dice stays below this
+max_enumerated_values = 4_000_000
+
+monte_carlo_samples = 1_000_000
+
+token_pattern = re.compile(
+    r"\s*(?:"
+    r"(?P<dice>(?P<count>\d*)d(?P<sides>\d+|%)(?P<modifiers>(?:k[hl]?\d+|!)*))"
+    r"|(?P<number>\d+)"
+    r"|(?P<name>[a-z_][a-z_.]*)"
+    r"|(?P<op>[+-])"
+    r")",
+    re.IGNORECASE,
+)
+
+
+class DiceTerm(NamedTuple):
+    sign: int
+    count: int
+    sides: int
+    keep: str = None  # "h", "l" or None
+    keep_count: int = 0
+    explode: bool = False
+
+    def __str__(self):
+        text = f"{self.count}d{self.sides}"
+        if self.keep:
+            text += f"k{self.keep}{self.keep_count}"
+        if self.explode:
+            text += "!"
+        return text
+
+
+class ConstTerm(NamedTuple):
+    sign: int
+    value: int
+
+    def __str__(self):
+        return str(self.value)
+
+
+class StatTerm(NamedTuple):
+    sign: int
+    name: str
+
+    def __str__(self):
+        return self.name
+
+
+def _parse_dice(match):
+
+    count = int(match.group("count") or 1)
+    sides = 100 if match.group("sides") == "%" else int(match.group("sides"))
+    if count < 1 or sides < 1:
+        raise ValueError(f"Invalid dice: {match.group('dice')}")
+
+    keep, keep_count, explode = None, 0, False
+    for modifier in re.findall(r"k[hl]?\d+|!", match.group("modifiers").lower()):
+        if modifier == "!":
+            if sides < 2:
+                raise ValueError(f"A d{sides} can't explode: {match.group('dice')}")
+            explode = True
+        else:
+            keep = "l" if modifier[1] == "l" else "h"
+            keep_count = int(modifier.lstrip("khl"))
+            if not 1 <= keep_count <= count:
+                raise ValueError(f"Can't keep {keep_count} of {count} dice: {match.group('dice')}")
+
+    return count, sides, keep, keep_count, explode
+
+
+@lru_cache(maxsize=1024)
+def parse(expression):
+    """Parses expression into a tuple of terms. Raises ValueError for anything that is not a dice expression."""
+
+    terms = []
+    sign = 1
+    expect_term = True
+    position = 0
+    text = expression.strip()
+
+    while position < len(text):
+        match = token_pattern.match(text, position)
+        if match is None or match.end() == position:
+            raise ValueError(f"Can't parse dice expression at '{text[position:]}': {expression}")
+        position = match.end()
+
+        if match.group("op"):
+            if expect_term:
+                # Unary sign, e.g. "-1 + 1d20"
+                sign = -sign if match.group("op") == "-" else sign
+            else:
+                sign = -1 if match.group("op") == "-" else 1
+                expect_term = True
+            continue
+
+        if not expect_term:
+            raise ValueError(f"Missing + or - before '{match.group().strip()}': {expression}")
+
+        if match.group("dice"):
+            terms.append(DiceTerm(sign, *_parse_dice(match)))
+        elif match.group("number"):
+            terms.append(ConstTerm(sign, int(match.group("number"))))
+        else:
+            terms.append(StatTerm(sign, match.group("name")))
+
+        sign = 1
+        expect_term = False
+
+    if expect_term:
+        raise ValueError(f"Incomplete dice expression: {expression}")
+
+    return tuple(terms)
+
+
+def match_stat_name(name, names):
+    """
+    The one of names that name refers to: the exact name first (case-insensitive), then a unique prefix,
+    then a unique abbreviation (MND -> mind). None when nothing matches, ValueError when it is ambiguous.
+    """
+
+    lowered = {str(key).lower(): key for key in names}
+    name = name.lower()
+
+    if name in lowered:
+        return lowered[name]
+
+    for matches in (
+        [key for key in lowered if key.startswith(name)],
+        [key for key in lowered if key[:1] == name[:1] and re.search(".*".join(map(re.escape, name)), key)],
+    ):
+        if len(matches) == 1:
+            return lowered[matches[0]]
+        if len(matches) > 1:
+            raise ValueError(f"Stat '{name}' is ambiguous, it could be any of {matches}")
+
+    return None
+
+
+def resolve_stat(name, stats):
+    """Value of the stat called name, see match_stat_name."""
+
+    if not stats:
+        raise ValueError(f"'{name}' is not a dice or a number, stat names need a character with stats")
+
+    key = match_stat_name(name, stats)
+    if key is None:
+        raise ValueError(f"Unknown stat '{name}', the character has {list(stats)}")
+
+    return int(stats[key])
+
+
+def _roll_dice(term, size, rng):
+    """Kept dice of `size` rolls of term, shape (size, dice kept)."""
+
+    rolls = rng.integers(1, term.sides + 1, size=(size, term.count))
+
+    if term.explode:
+        live = rolls == term.sides
+        for _ in range(max_explosions):
+            if not live.any():
+                break
+            extra = rng.integers(1, term.sides + 1, size=rolls.shape)
+            rolls += np.where(live, extra, 0)
+            live &= extra == term.sides
+
+    if term.keep:
+        rolls = np.sort(rolls, axis=1)
+        rolls = rolls[:, -term.keep_count:] if term.keep == "h" else rolls[:, :term.keep_count]
+
+    return rolls
+
+
+def _die_pmf(sides, explode):
+    """(lowest value, probabilities of lowest value, lowest + 1, ...) of a single die."""
+
+    if not explode:
+        return 1, np.full(sides, 1 / sides)
+
+    # An exploding die shows k * sides + r with probability sides^-(k + 1) for r < sides. The last allowed
+    # explosion also stops on r == sides, the same cut off the sampler uses.
+    pmf = np.zeros(sides * (max_explosions + 1))
+    for k in range(max_explosions + 1):
+        stop = sides if k == max_explosions else sides - 1
+        pmf[k * sides:k * sides + stop] = (1 / sides) ** (k + 1)
+    return 1, pmf
+
+
+def _dice_pmf(term):
+    """Exact distribution of a dice term as (lowest value, probabilities), None when it is too costly."""
+
+    if term.keep:
+        if term.explode or term.sides ** term.count * term.count > max_enumerated_values:
+            return None
+        faces = np.indices((term.sides,) * term.count).reshape(term.count, -1).T + 1
+        faces = np.sort(faces, axis=1)
+        kept = faces[:, -term.keep_count:] if term.keep == "h" else faces[:, :term.keep_count]
+        counts = np.bincount(kept.sum(axis=1) - term.keep_count)
+        return term.keep_count, counts / counts.sum()
+
+    low, die = _die_pmf(term.sides, term.explode)
+    offset, pmf = 0, np.ones(1)
+    for _ in range(term.count):
+        offset += low
+        pmf = np.convolve(pmf, die)
+    return offset, pmf
+
+
+class DiceRoller:
+    """Rolls and evaluates dice expressions with its own seeded generator, one per session."""
+
+    def __init__(self, seed = None):
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        # Monte Carlo estimates draw from their own stream, asking for odds doesn't change the next rolls
+        self.estimate_rng = np.random.default_rng(None if seed is None else [seed, 1])
+
+    @classmethod
+    def for_session(cls, session_id):
+        """A roller whose seed is derived from the session id, so a campaign always gets the same rolls."""
+        return cls(int.from_bytes(hashlib.sha256(str(session_id).encode("utf-8")).digest()[:8], "big"))
+
+    def round_rng(self, round_no):
+        """A generator of its own for one round's rolls: the same for that round every time, the session's stream is untouched."""
+        return np.random.default_rng(None if self.seed is None else [self.seed, 2, round_no])
+
+    def roll(self, expression, stats = None, times = 1, rng = None):
+        """Totals of `times` independent rolls of expression as an int array."""
+
+        rng = self.rng if rng is None else rng
+
+        totals = np.zeros(times, dtype=np.int64)
+        for term in parse(expression):
+            if isinstance(term, DiceTerm):
+                totals += term.sign * _roll_dice(term, times, rng).sum(axis=1)
+            elif isinstance(term, ConstTerm):
+                totals += term.sign * term.value
+            else:
+                totals += term.sign * resolve_stat(term.name, stats)
+        return totals
+
+    def roll_detail(self, expression, stats = None, rng = None):
+        """One roll as (total, text showing every die and modifier)."""
+
+        rng = self.rng if rng is None else rng
+
+        total = 0
+        parts = []
+        for term in parse(expression):
+            if isinstance(term, DiceTerm):
+                dice = _roll_dice(term, 1, rng)[0]
+                value = int(dice.sum())
+                parts.append((term.sign, f"{term}{dice.tolist()}"))
+            elif isinstance(term, ConstTerm):
+                value = term.value
+                parts.append((term.sign, str(value)))
+            else:
+                value = resolve_stat(term.name, stats)
+                parts.append((term.sign, f"{term.name}({value})"))
+            total += term.sign * value
+
+        text = ""
+        for i, (sign, part) in enumerate(parts):
+            text += ("-" if sign < 0 else "") + part if i == 0 else (" - " if sign < 0 else " + ") + part
+
+        return total, f"{text} = {total}"
+
+    def distribution(self, expression, stats = None):
+        """Exact distribution as (values, probabilities), or None if one of the terms has no exact form."""
+
+        offset, pmf = 0, np.ones(1)
+        for term in parse(expression):
+            if isinstance(term, DiceTerm):
+                exact = _dice_pmf(term)
+                if exact is None:
+                    return None
+                low, term_pmf = exact
+                if term.sign < 0:
+                    low, term_pmf = -(low + len(term_pmf) - 1), term_pmf[::-1]
+                offset += low
+                pmf = np.convolve(pmf, term_pmf)
+            elif isinstance(term, ConstTerm):
+                offset += term.sign * term.value
+            else:
+                offset += term.sign * resolve_stat(term.name, stats)
+
+        return offset + np.arange(len(pmf)), pmf
+
+    def probabilities(self, expression, difficulties, stats = None, samples = monte_carlo_samples):
+        """
+        P(roll >= DR) for every DR in difficulties, and how it was computed ("exact" or "monte carlo").
+        The distribution is built (or sampled) once for all of them.
+        """
+
+        difficulties = np.atleast_1d(np.asarray(difficulties))
+
+        exact = self.distribution(expression, stats)
+        if exact is not None:
+            values, pmf = exact
+            # Survival function: tail[i] = P(roll >= values[i])
+            tail = np.cumsum(pmf[::-1])[::-1]
+            positions = np.searchsorted(values, difficulties)
+            result = np.where(positions < len(values), tail[np.minimum(positions, len(values) - 1)], 0.0)
+            return np.clip(result, 0.0, 1.0), "exact"
+
+        totals = np.sort(self.roll(expression, stats, samples, self.estimate_rng))
+        result = 1 - np.searchsorted(totals, difficulties, side="left") / samples
+        return result, f"monte carlo, {samples} samples"
+
+    def probability(self, expression, difficulty, stats = None, samples = monte_carlo_samples):
+        result, method = self.probabilities(expression, [difficulty], stats, samples)
+        return float(result[0]), method
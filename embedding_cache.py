@@ -0,0 +1,140 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from langchain_core.embeddings import Embeddings
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Content addressed cache in front of an embedding model.
+
+    Vectors are keyed by sha256(model name + text). Lookups go through an in-memory LRU first, then an
+    on-disk sqlite table, and only the remaining texts are sent to the wrapped model (in one batch).
+    """
+
+    def __init__(self, model, cache_path="./data/embedding_cache.sqlite", max_memory_items=4096, namespace=None):
+
+        self.model = model
+        self.namespace = namespace or getattr(model, "model_name", type(model).__name__)
+        self.max_memory_items = max_memory_items
+
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.connection = None
+        if cache_path:
+            os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+            self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+            self.connection.commit()
+
+    def key(self, text):
+        return hashlib.sha256(f"{self.namespace}\0{text}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def _lookup(self, keys):
+
+        found = {}
+        missing = []
+
+        with self.lock:
+            for key in keys:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    found[key] = self.memory[key]
+                    self.memory_hits += 1
+                else:
+                    missing.append(key)
+
+            if missing and self.connection is not None:
+                placeholders = ",".join("?" * len(missing))
+                rows = self.connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", missing
+                ).fetchall()
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype="float32").tolist()
+                    found[key] = vector
+                    self._remember(key, vector)
+                    self.disk_hits += 1
+
+        return found
+
+    def _store(self, items):
+
+        with self.lock:
+            for key, vector in items:
+                self._remember(key, vector)
+
+            if self.connection is not None:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(key, np.asarray(vector, dtype="float32").tobytes()) for key, vector in items],
+                )
+                self.connection.commit()
+
+    def embed_documents(self, texts):
+
+        keys = [self.key(text) for text in texts]
+        found = self._lookup(set(keys))
+
+        # Duplicate texts inside one batch are only embedded once
+        to_embed = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                to_embed.setdefault(key, text)
+
+        if to_embed:
+            vectors = self.model.embed_documents(list(to_embed.values()))
+            new_items = list(zip(to_embed.keys(), vectors))
+            self._store(new_items)
+            found.update(new_items)
+
+            with self.lock:
+                self.misses += len(to_embed)
+
+        return [found[key] for key in keys]
+
+    def embed_query(self, text):
+
+        key = self.key(text)
+        found = self._lookup([key])
+
+        if key in found:
+            return found[key]
+
+        vector = self.model.embed_query(text)
+        self._store([(key, vector)])
+
+        with self.lock:
+            self.misses += 1
+
+        return vector
+
+    @property
+    def hit_rate(self):
+        total = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / total if total else 0.0
+
+    def stats(self):
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "memory_items": len(self.memory),
+        }
@@ -0,0 +1,355 @@
+"""
+Offline encounter simulator for balancing generated characters.
+
+The combat part of the generated rules (initiative, attack vs. DR, damage dice, HP = base + stat) is read
+into CombatRules, every character becomes a Combatant with its best weapon, and thousands of fights are
+played at once: each array row is one fight, so every attack of a round is a handful of NumPy operations
+over all fights instead of a Python loop per fight.
+
+    python encounter_sim.py game_1.pkl --fights 10000
+"""
+
+import argparse
+import itertools
+import re
+import time
+from typing import NamedTuple
+
+import numpy as np
+
+from dice import DiceRoller, match_stat_name, parse
+
+# Sentences end at . ! ? or a line break, "vs." is not the end of one
+sentence_pattern = re.compile(r"\n+|(?<=[.!?])(?<!vs\.)\s+")
+
+# Leading dice expression of a weapon's damage text, e.g. "1d6 (stealthy strikes +2 bonus damage)" -> "1d6"
+damage_pattern = re.compile(r"^\s*(\d*d\d+(?:\s*[+-]\s*\d+(?:d\d+)?)*|\d+)\b", re.IGNORECASE)
+
+armor_keys = ("armor", "armour", "defense", "defence", "shield")
+
+
+def _sentence(text, keyword):
+    pattern = re.compile(keyword, re.IGNORECASE)
+    for sentence in sentence_pattern.split(text or ""):
+        if pattern.search(sentence):
+            return sentence
+    return ""
+
+
+def _stats_in(sentence, stat_names):
+    """Stat names mentioned in sentence, in order, written out or abbreviated (REF, BOD...)."""
+
+    found = {}
+    for name in stat_names:
+        position = sentence.lower().find(str(name).lower())
+        if position != -1:
+            found[name] = position
+
+    for match in re.finditer(r"\b[A-Z]{3,4}\b", sentence):
+        if match.group() in ("DR", "GM", "HP", "NPC"):
+            continue
+        try:
+            name = match_stat_name(match.group(), stat_names)
+        except ValueError:
+            continue
+        if name is not None and name not in found:
+            found[name] = match.start()
+
+    return [name for name, _ in sorted(found.items(), key=lambda item: item[1])]
+
+
+class CombatRules:
+    """The combat mechanics the simulator plays, by default the ones of the rule template in static_objects."""
+
+    def __init__(self, initiative_dice = "2d10", initiative_stats = (), attack_dice = "2d10", attack_stats = (),
+                 attack_bonus = 0, defense_dr = 16, hp_base = 15, hp_stats = (), unarmed_damage = "1d4"):
+        self.initiative_dice = initiative_dice
+        self.initiative_stats = list(initiative_stats)
+        self.attack_dice = attack_dice
+        self.attack_stats = list(attack_stats)
+        self.attack_bonus = attack_bonus
+        self.defense_dr = defense_dr
+        self.hp_base = hp_base
+        self.hp_stats = list(hp_stats)
+        self.unarmed_damage = unarmed_damage
+
+    @classmethod
+    def from_text(cls, text, stat_names):
+        """
+        Reads the combat rules out of the generated rules text. Whatever can't be found keeps the template's
+        default, e.g. expertise bonuses are not known per character and count as 0.
+        """
+
+        rules = cls()
+
+        initiative = _sentence(text, r"initiative")
+        if dice := re.search(r"\d*d\d+", initiative):
+            rules.initiative_dice = dice.group()
+        rules.initiative_stats = _stats_in(initiative, stat_names)[:1]
+
+        attack = _sentence(text, r"\battacks?\b")
+        if dice := re.search(r"\d*d\d+", attack):
+            rules.attack_dice = dice.group()
+        rules.attack_stats = _stats_in(attack, stat_names)
+        if dr := re.search(r"DR\W*(\d+)", attack):
+            rules.defense_dr = int(dr.group(1))
+
+        health = _sentence(text, r"hit points|\bHP\s*=|\d+\s*\+\s*\w+\s+(?:hit points|HP)")
+        if base := re.search(r"(\d+)\s*\+", health):
+            rules.hp_base = int(base.group(1))
+        rules.hp_stats = _stats_in(health, stat_names)[:1]
+
+        return rules
+
+    def describe(self):
+        initiative = " + ".join([self.initiative_dice, *self.initiative_stats])
+        attack = " + ".join([self.attack_dice, "/".join(self.attack_stats) or "0"])
+        hp = " + ".join([str(self.hp_base), *self.hp_stats])
+        return f"initiative {initiative}, attack {attack} vs DR {self.defense_dr} + armor, HP {hp}"
+
+
+class Combatant(NamedTuple):
+    name: str
+    hp: int
+    initiative_bonus: int
+    attack_bonus: int
+    defense_dr: int
+    damage: str
+
+
+def weapon_damage(item):
+    """Damage dice of a weapon as an expression the dice engine understands, None if it has none."""
+
+    for key, value in (item.stats or {}).items():
+        if "damage" not in str(key).lower():
+            continue
+        if isinstance(value, (int, float)):
+            return str(int(value))
+        if match := damage_pattern.match(str(value)):
+            expression = match.group(1).replace(" ", "")
+            try:
+                parse(expression)
+            except ValueError:
+                continue
+            return expression
+    return None
+
+
+def mean_damage(expression):
+    values, pmf = DiceRoller().distribution(expression)
+    return float((values * pmf).sum())
+
+
+def combatant_from_character(character, rules):
+
+    stats = character.stats or {}
+
+    def stat(name):
+        value = stats.get(name, 0)
+        return int(value) if isinstance(value, (int, float)) else 0
+
+    attack_stats = [name for name in rules.attack_stats if name in stats]
+    attack_bonus = max((stat(name) for name in attack_stats), default=0) + rules.attack_bonus
+
+    damages = [damage for damage in map(weapon_damage, character.inventory) if damage]
+    damage = max([rules.unarmed_damage, *damages], key=mean_damage)
+
+    armor = 0
+    for item in character.inventory:
+        for key, value in (item.stats or {}).items():
+            if str(key).lower() in armor_keys and isinstance(value, (int, float)):
+                armor += int(value)
+
+    hp = character.hp if character.hp is not None else rules.hp_base + sum(stat(name) for name in rules.hp_stats)
+
+    return Combatant(
+        name=character.name,
+        hp=max(int(hp), 1),
+        initiative_bonus=sum(stat(name) for name in rules.initiative_stats),
+        attack_bonus=attack_bonus,
+        defense_dr=rules.defense_dr + armor,
+        damage=damage,
+    )
+
+
+class EncounterResult(NamedTuple):
+    fights: int
+    win_rate_a: float
+    win_rate_b: float
+    draw_rate: float  # fights still running after max_rounds
+    rounds_a: float  # mean rounds until side A won (its time to kill), nan if it never won
+    rounds_b: float
+    survival: dict  # combatant name -> share of fights it survived
+
+    def summary(self):
+        return (
+            f"A wins {self.win_rate_a:.1%} (in {self.rounds_a:.1f} rounds), "
+            f"B wins {self.win_rate_b:.1%} (in {self.rounds_b:.1f} rounds), unfinished {self.draw_rate:.1%}"
+        )
+
+
+def simulate(team_a, team_b, rules = None, fights = 10_000, seed = None, max_rounds = 50):
+    """
+    Plays `fights` encounters of team_a against team_b (lists of Combatant). Everybody acts once per round
+    in initiative order and attacks a random standing enemy; a side loses when all its members are at 0 HP.
+    """
+
+    rules = rules or CombatRules()
+    rng = np.random.default_rng(seed)
+    roller = DiceRoller()
+
+    combatants = [*team_a, *team_b]
+    count = len(combatants)
+    rows = np.arange(fights)
+
+    team = np.array([0] * len(team_a) + [1] * len(team_b))
+    attack_bonus = np.array([c.attack_bonus for c in combatants])
+    defense = np.array([c.defense_dr for c in combatants])
+
+    # Combatants with the same damage dice share one batch of rolls
+    expressions = sorted({c.damage for c in combatants})
+    damage_index = np.array([expressions.index(c.damage) for c in combatants])
+
+    hp = np.tile(np.array([c.hp for c in combatants]), (fights, 1))
+
+    initiative = np.stack([roller.roll(f"{rules.initiative_dice} + {c.initiative_bonus}", None, fights, rng) for c in combatants], axis=1)
+    # Random fraction breaks ties
+    order = np.argsort(-(initiative + rng.random((fights, count))), axis=1)
+
+    winner = np.full(fights, -1)
+    ended = np.zeros(fights, dtype=int)
+
+    for round_no in range(1, max_rounds + 1):
+        for slot in range(count):
+
+            actor = order[:, slot]
+            active = (winner == -1) & (hp[rows, actor] > 0)
+            if not active.any():
+                continue
+
+            enemies = (team[None, :] != team[actor][:, None]) & (hp > 0)
+            target = np.where(enemies, rng.random((fights, count)), -1.0).argmax(axis=1)
+
+            attack = roller.roll(rules.attack_dice, None, fights, rng) + attack_bonus[actor]
+            hit = active & (attack >= defense[target])
+
+            damage = np.stack([roller.roll(expression, None, fights, rng) for expression in expressions])
+            damage = np.maximum(damage[damage_index[actor], rows], 0)
+
+            hp[rows[hit], target[hit]] -= damage[hit]
+
+            standing = hp > 0
+            alive_a = (standing & (team == 0)).any(axis=1)
+            alive_b = (standing & (team == 1)).any(axis=1)
+            done = (winner == -1) & ~(alive_a & alive_b)
+            winner[done] = np.where(alive_a[done], 0, 1)
+            ended[done] = round_no
+
+        if (winner != -1).all():
+            break
+
+    def mean_rounds(side):
+        won = winner == side
+        return float(ended[won].mean()) if won.any() else float("nan")
+
+    return EncounterResult(
+        fights=fights,
+        win_rate_a=float((winner == 0).mean()),
+        win_rate_b=float((winner == 1).mean()),
+        draw_rate=float((winner == -1).mean()),
+        rounds_a=mean_rounds(0),
+        rounds_b=mean_rounds(1),
+        survival={c.name: float((hp[:, i] > 0).mean()) for i, c in enumerate(combatants)},
+    )
+
+
+def duel_pairs(names, fights, min_fights, seed = 0):
+    """
+    Pairs of names to duel and the fights per duel, so that all duels together play about `fights` fights.
+    Every pair duels while that leaves min_fights per duel; beyond that a seeded sample of the pairs is
+    taken, starting with one duel for each name so nobody goes unrated.
+    """
+
+    pairs = list(itertools.combinations(names, 2))
+    if not pairs:
+        return [], fights
+    if len(pairs) * min_fights <= fights:
+        return pairs, fights // len(pairs)
+
+    rng = np.random.default_rng(seed)
+    pairs = [pairs[i] for i in rng.permutation(len(pairs))]
+    budget = max(fights // min_fights, (len(names) + 1) // 2)
+
+    chosen, rated = [], set()
+    for pair in pairs:
+        if not rated.issuperset(pair):
+            chosen.append(pair)
+            rated.update(pair)
+    chosen += [pair for pair in pairs if pair not in chosen][:max(0, budget - len(chosen))]
+    return chosen, max(1, fights // len(chosen))
+
+
+def balance_report(game, fights = 10_000, seed = 0, rules = None, low = 0.3, high = 0.7, min_fights = 1_000):
+    """
+    Duels between the characters, plus players against NPCs once character types are set. `fights` is the
+    budget of all duels together, see duel_pairs, so the check costs about the same for any party size.
+    Returns (report text, names of the characters whose average duel win rate is outside [low, high]).
+    """
+
+    characters = list(game.characters.values())
+    stat_names = sorted({name for character in characters for name in (character.stats or {})})
+    rules = rules or CombatRules.from_text(game.rules, stat_names)
+
+    combatants = {character.name: combatant_from_character(character, rules) for character in characters}
+
+    wins = {name: [] for name in combatants}
+    rounds = {name: [] for name in combatants}
+    pairs, duel_fights = duel_pairs(list(combatants), fights, min_fights, seed)
+    for name_a, name_b in pairs:
+        result = simulate([combatants[name_a]], [combatants[name_b]], rules, duel_fights, seed)
+        wins[name_a].append(result.win_rate_a)
+        wins[name_b].append(result.win_rate_b)
+        rounds[name_a].append(result.rounds_a)
+        rounds[name_b].append(result.rounds_b)
+
+    all_pairs = len(combatants) * (len(combatants) - 1) // 2
+    lines = [f"Balance check ({rules.describe()}, {len(pairs)} of {all_pairs} duels, {duel_fights} fights each):"]
+    flagged = []
+    for name, combatant in combatants.items():
+        if not wins[name]:
+            continue
+        win_rate = float(np.mean(wins[name]))
+        kill_rounds = float(np.nanmean(rounds[name])) if not np.isnan(rounds[name]).all() else float("nan")
+        line = f"- {name}: HP {combatant.hp}, attack +{combatant.attack_bonus}, damage {combatant.damage}, wins {win_rate:.0%} of duels, kills in {kill_rounds:.1f} rounds"
+        if not low <= win_rate <= high:
+            flagged.append(name)
+            line += " (overpowered)" if win_rate > high else " (underpowered)"
+        lines.append(line)
+
+    players = [combatants[c.name] for c in characters if c.character_type == "player"]
+    npcs = [combatants[c.name] for c in characters if c.character_type == "npc"]
+    if players and npcs:
+        lines.append(f"Players vs NPCs: {simulate(players, npcs, rules, fights, seed).summary()}")
+
+    return "\n".join(lines), flagged
+
+
+if __name__ == "__main__":
+
+    from static_objects import GameContext, load_game
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("save", help="A pickled game, e.g. game_1.pkl")
+    parser.add_argument("--fights", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    game = GameContext()
+    load_game(args.save, game)
+
+    start = time.perf_counter()
+    report, flagged = balance_report(game, args.fights, args.seed)
+    elapsed = time.perf_counter() - start
+
+    print(report)
+    print(f"{args.fights} duel fights in {elapsed:.2f} s")
@@ -0,0 +1,254 @@
+"""
+Deterministic offline stand-in for the Groq chat models.
+
+FakeChatModel answers after a configurable latency with a configurable number of completion tokens. It
+supports bind_tools (it calls the preferred tool, the forced tool or the first bound tool mentioned in the
+last human message, with arguments generated from the tool's JSON schema), with_structured_output (through
+the forced tool call BaseChatModel uses for it) and streaming. The same prompt always gets the same answer.
+
+Setting FRPG_FAKE_LLM=1 makes the model getters of loop_graph.py and creation_graph.py return it instead of
+ChatGroq, and the embedding getter a deterministic fake embedding, so graphs run without network access:
+
+    FRPG_FAKE_LLM=1 FRPG_FAKE_LLM_LATENCY=0.05 FRPG_FAKE_LLM_TOKENS=128 python bench_suite.py
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from typing import Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables.config import ensure_config
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from pydantic import PrivateAttr
+
+words = (
+    "the party moves through the misty forest while the old guardian watches from the ridge and a cold wind "
+    "carries the sound of distant drums toward the ruined tower where the lost relic waits in silence"
+).split()
+
+
+def fake_value(schema, defs, name, index):
+    """A deterministic value that validates against the JSON schema of one field."""
+
+    if "$ref" in schema:
+        return fake_value(defs[schema["$ref"].split("/")[-1]], defs, name, index)
+    if "default" in schema:
+        return schema["default"]
+    if "const" in schema:
+        return schema["const"]
+    if "enum" in schema:
+        return schema["enum"][0]
+    for key in ("anyOf", "oneOf", "allOf"):
+        if key in schema:
+            options = [option for option in schema[key] if option.get("type") != "null"]
+            return fake_value(options[0] if options else schema[key][0], defs, name, index)
+
+    kind = schema.get("type", "string")
+    if kind == "string":
+        return f"{name} {index}"
+    if kind == "integer":
+        return 3 + index
+    if kind == "number":
+        return 1.0
+    if kind == "boolean":
+        return False
+    if kind == "array":
+        return [fake_value(schema.get("items", {}), defs, name, i) for i in range(2)]
+    if kind == "object":
+        if "properties" in schema:
+            return fake_arguments(schema, defs, index)
+        return {"power": 3 + index, "agility": 2}
+    return None
+
+
+def fake_arguments(schema, defs = None, index = 0):
+    defs = {**(defs or {}), **schema.get("$defs", {})}
+    return {name: fake_value(field, defs, name, index) for name, field in schema.get("properties", {}).items()}
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    latency            seconds before the first token
+    seconds_per_token  additional seconds per completion token, spread over the chunks when streaming
+    completion_tokens  length of a text answer
+    tool_call_count    tool calls per answer when a tool is called, e.g. 3 characters per creation task
+    preferred_tool     called whenever it is bound, the tool controller's ResponseFormatter by default
+    """
+
+    latency: float = 0.2
+    seconds_per_token: float = 0.0
+    completion_tokens: int = 64
+    tool_call_count: int = 1
+    preferred_tool: Optional[str] = "ResponseFormatter"
+
+    # (node, seconds, input tokens, output tokens) of every call, read by the benchmarks
+    _calls: list = PrivateAttr(default_factory=list)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def _llm_type(self):
+        return "fake-chat-model"
+
+    @property
+    def calls(self):
+        with self._lock:
+            return list(self._calls)
+
+    def reset_calls(self):
+        with self._lock:
+            self._calls.clear()
+
+    def bind_tools(self, tools, tool_choice = None, **kwargs):
+        formatted = [convert_to_openai_tool(tool) for tool in tools]
+        if tool_choice is not None:
+            kwargs["tool_choice"] = tool_choice
+        return self.bind(tools=formatted, **kwargs)
+
+    def _pick_tool(self, messages, tools, tool_choice):
+        names = [tool["function"]["name"] for tool in tools]
+
+        if isinstance(tool_choice, dict):
+            return tool_choice["function"]["name"]
+        if isinstance(tool_choice, str) and tool_choice in names:
+            return tool_choice
+        if tool_choice in ("any", "required"):
+            return names[0]
+        if self.preferred_tool in names:
+            return self.preferred_tool
+
+        # Otherwise the tool the task asks for first, e.g. "store this story with define_story"
+        prompt = next((message.content for message in reversed(messages) if isinstance(message, HumanMessage)), "")
+        prompt = prompt if isinstance(prompt, str) else str(prompt)
+        mentioned = [(prompt.find(name), name) for name in names if name in prompt]
+        return min(mentioned)[1] if mentioned else None
+
+    def _reply(self, messages, kwargs):
+        prompt = "\n".join(str(message.content) for message in messages)
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+        tools = kwargs.get("tools") or []
+        tool_name = self._pick_tool(messages, tools, kwargs.get("tool_choice")) if tools else None
+
+        if tool_name is not None:
+            schema = next(tool["function"].get("parameters", {}) for tool in tools if tool["function"]["name"] == tool_name)
+            count = 1 if tool_name == self.preferred_tool or kwargs.get("tool_choice") else self.tool_call_count
+            tool_calls = [
+                {"name": tool_name, "args": fake_arguments(schema, index=i), "id": f"call_{digest[:8]}_{i}"}
+                for i in range(count)
+            ]
+            message = AIMessage(content="", tool_calls=tool_calls)
+        else:
+            rng = random.Random(digest)
+            text = " ".join(rng.choice(words) for _ in range(self.completion_tokens))
+            message = AIMessage(content=f"## **Round**\n{text}.")
+
+        input_tokens = count_tokens_approximately(messages)
+        output_tokens = count_tokens_approximately([message])
+        message.usage_metadata = {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+        return message
+
+    def _record(self, run_manager, message, seconds):
+        # Streaming calls don't get a run manager, their metadata comes from the config of the running call
+        metadata = run_manager.metadata if run_manager is not None else ensure_config().get("metadata")
+        node = (metadata or {}).get("langgraph_node", "background")
+        usage = message.usage_metadata
+        with self._lock:
+            self._calls.append((node, seconds, usage["input_tokens"], usage["output_tokens"]))
+
+    def _duration(self, message):
+        tokens = self.completion_tokens if message.content else 0
+        return self.latency + self.seconds_per_token * tokens
+
+    def _generate(self, messages, stop = None, run_manager = None, **kwargs):
+        start = time.perf_counter()
+        message = self._reply(messages, kwargs)
+        time.sleep(self._duration(message))
+        self._record(run_manager, message, time.perf_counter() - start)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages, stop = None, run_manager = None, **kwargs):
+        start = time.perf_counter()
+        message = self._reply(messages, kwargs)
+        await asyncio.sleep(self._duration(message))
+        self._record(run_manager, message, time.perf_counter() - start)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _chunks(self, message):
+        """Word by word chunks of message, the token usage rides on the last one as with real providers."""
+        if message.tool_calls:
+            yield AIMessageChunk(content="", usage_metadata=message.usage_metadata, tool_call_chunks=[
+                {"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": i}
+                for i, call in enumerate(message.tool_calls)
+            ])
+            return
+        pieces = message.content.split(" ")
+        for i, piece in enumerate(pieces):
+            if i == len(pieces) - 1:
+                yield AIMessageChunk(content=piece, usage_metadata=message.usage_metadata)
+            else:
+                yield AIMessageChunk(content=piece + " ")
+
+    def _stream(self, messages, stop = None, run_manager = None, **kwargs):
+        start = time.perf_counter()
+        message = self._reply(messages, kwargs)
+        time.sleep(self.latency)
+        # BaseChatModel reports every chunk to the callbacks as a new token
+        for chunk in self._chunks(message):
+            if chunk.content:
+                time.sleep(self.seconds_per_token)
+            yield ChatGenerationChunk(message=chunk)
+        self._record(run_manager, message, time.perf_counter() - start)
+
+    async def _astream(self, messages, stop = None, run_manager = None, **kwargs):
+        start = time.perf_counter()
+        message = self._reply(messages, kwargs)
+        await asyncio.sleep(self.latency)
+        for chunk in self._chunks(message):
+            if chunk.content:
+                await asyncio.sleep(self.seconds_per_token)
+            yield ChatGenerationChunk(message=chunk)
+        self._record(run_manager, message, time.perf_counter() - start)
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def fake_enabled():
+    return os.getenv("FRPG_FAKE_LLM", "").lower() not in ("", "0", "false", "no")
+
+
+def fake_chat_model():
+    """The shared FakeChatModel configured from the environment, or None when FRPG_FAKE_LLM is not set."""
+
+    if not fake_enabled():
+        return None
+
+    with _shared_lock:
+        if "model" not in _shared:
+            _shared["model"] = FakeChatModel(
+                latency=float(os.getenv("FRPG_FAKE_LLM_LATENCY", "0.2")),
+                seconds_per_token=float(os.getenv("FRPG_FAKE_LLM_SECONDS_PER_TOKEN", "0")),
+                completion_tokens=int(os.getenv("FRPG_FAKE_LLM_TOKENS", "64")),
+                tool_call_count=int(os.getenv("FRPG_FAKE_LLM_TOOL_CALLS", "3")),
+            )
+        return _shared["model"]
+
+
+def fake_embeddings():
+    """A deterministic embedding of MiniLM's size when FRPG_FAKE_LLM is set, otherwise None."""
+
+    if not fake_enabled():
+        return None
+
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    return DeterministicFakeEmbedding(size=384)
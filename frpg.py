@@ -7,23 +7,49 @@ from langchain_core.messages import HumanMessage,SystemMessage,AIMessage
 import streamlit as st
 
 
-from static_objects import game,generate_tasks,new_game,load_game
+from static_objects import new_game
+from sessions import registry
+from save_journal import GameJournal, open_game
+from transcript import RoundLog, CharacterViews
 
-from creation_graph import FullGraph
+from creation_graph import FullGraph,creation_inputs
 from loop_graph import LoopGraph
 import requests
 from PIL import Image
 from io import BytesIO
 import os
-import pickle
 
 from playsound import playsound
 import base64
 import threading
 import time
 
-os.environ["LANGCHAIN_TRACING_V2"]="true"
-os.environ["LANGCHAIN_API_KEY"]=os.getenv("LANGCHAIN_API_KEY")
+# Node timings are recorded locally (see instrumentation.py). LangSmith tracing needs the network and is
+# opt-in: set LANGCHAIN_TRACING_V2=true and LANGCHAIN_API_KEY in .env to turn it on.
+
+# Journaled saves of the created games, see save_journal.py
+saves_folder = "./data/saves"
+
+
+def saved_games():
+    """Names of the save folders that can be continued, newest first."""
+    if not os.path.isdir(saves_folder):
+        return []
+    names = [name for name in os.listdir(saves_folder) if os.path.exists(f"{saves_folder}/{name}/{GameJournal.snapshot_file}")]
+    return sorted(names, key=lambda name: os.path.getmtime(f"{saves_folder}/{name}"), reverse=True)
+
+
+def new_save_folder():
+    """Creates the first free save folder (game, game_1, ...). Creating it reserves it, two tabs never get the same one."""
+    os.makedirs(saves_folder, exist_ok=True)
+    i = 0
+    while True:
+        path = f'{saves_folder}/game' + (f'_{i}' if i else '')
+        try:
+            os.makedirs(path, exist_ok=False)
+            return path
+        except FileExistsError:
+            i += 1
 
         
 if "theme" not in st.session_state:
@@ -32,182 +58,214 @@ if "theme" not in st.session_state:
         st.session_state.theme = st.session_state.widget
         st.session_state.widget = ""
 
+    def resume():
+        st.session_state.resume_save = f"{saves_folder}/{st.session_state.save_choice}"
+        st.session_state.theme = None
+
 
     st.text_input('Please enter a theme for the game', key='widget', on_change=submit)
 
+    if saves := saved_games():
+        st.selectbox('Or continue a saved game', saves, key='save_choice')
+        st.button('Continue', on_click=resume)
+
 else:
-    placeholder = st.empty()  # akış için boş bir alan
+    transcript_area = st.container()  # earlier rounds, one element per message
+    placeholder = st.container()  # the round being played
+
+    # Every browser session plays its own campaign. Its save folder holds all of it: the game journal, the
+    # transcript, the RAG memory and the loop checkpoints, so a continued game picks up where it stopped.
+    if "session" not in st.session_state:
+        save = st.session_state.get("resume_save") or new_save_folder()
+        try:
+            session = registry.create(
+                os.path.basename(save), rag_folder=f"{save}/index", checkpoint_path=f"{save}/checkpoints.sqlite"
+            )
+        except KeyError:
+            # Two tabs playing one save would write to the same journal, RAG memory and checkpoints
+            st.error("This game is already open in another tab.")
+            st.stop()
+        st.session_state.created_game_save = save
+        st.session_state.session = session
 
+    session = st.session_state.session
+    game = session.game
 
 
-    def print_to_streamlit(events, full_text):
+
+    def render_message(area, role, text):
+        area.markdown(f"**{role}:** {text}")
+
+    def print_to_streamlit(events, messages):
         """
         events: LangGraph akışından gelen event listesi
-        full_text: Streamlit alanında biriken metni tutmak için
+        messages: (role, text) list of the round, the new AI messages are rendered and appended to it
         """
         previous_id = ""
-        new_msg = ""
         for event in events:
 
             if "messages" in event:
                 msg = event["messages"][-1]
 
-                if msg.id == previous_id or msg.content == "": 
+                if msg.id == previous_id or msg.content == "" or not isinstance(msg, AIMessage):
                     continue
-                
-                if isinstance(msg, AIMessage):
-                    new_msg += f"\n**AI:** {msg.content}\n"
-                    
 
-                # Güncellenen tüm metni placeholder'a yaz
+                previous_id = msg.id
+                render_message(placeholder, "AI", msg.content)
+                messages.append(("AI", msg.content))
+
+        return messages
+
+    def print_narration_to_streamlit(chunks, messages):
+        """
+        chunks: the GM's narration, streamed text chunk by text chunk
+        messages: (role, text) list of the round, the narration is appended to it
+        """
+        area = placeholder.empty()
+        new_msg = ""
+        for chunk in chunks:
+            new_msg += chunk
+            render_message(area, "AI", new_msg + "▌")
 
-        full_text+=new_msg
-        previous_id = msg.id
-        placeholder.write(full_text)
+        render_message(area, "AI", new_msg)
+        messages.append(("AI", new_msg))
 
-        return full_text,new_msg
+        return messages
 
-    def print_text_to_streamlit(text, full_text,new_text = True):
+    def print_text_to_streamlit(text, messages):
         """
-        tetx: LangGraph akışına gönderilen text
-        full_text: Streamlit alanında biriken metni tutmak için
+        text: LangGraph akışına gönderilen text
+        messages: (role, text) list of the round
         """
-        if new_text:
-            full_text += f"\n**Human:** {text}\n"
-        
-        placeholder.write(full_text)
-        
-        return full_text
+        render_message(placeholder, "Human", text)
+        messages.append(("Human", text))
 
-    def create_game(theme, graph,config,full_text,save_created=False,override_save = True):
+        return messages
 
-        new_game()
+    def render_transcript(transcript):
+        """Only the newest pages are rendered, older rounds are loaded on demand."""
 
-        temp = f"The details about my game are provided, please comply these and especially the game theme:{theme} "
-        tasks = generate_tasks(theme)
-        for i in range(len(tasks)):
-            
-            schema = {"story is: ":game.story,"rules are:":game.rules,"characters are:":game.characters} # schema is provided here so that the values inside are up to date
+        shown_pages = st.session_state.get("shown_pages", 1)
 
-            task = tasks[i]
-            schema_no = i
+        with transcript_area:
+            if transcript.pages > shown_pages and st.button("Load older rounds"):
+                shown_pages = st.session_state.shown_pages = shown_pages + 1
 
-            if i!=0:
-                key = list(schema.keys())[i-1]
-                temp+= (key+str(schema[key]))
-                task+=temp
-            events = graph.stream({"messages": [{"role": "user", "content":task},],"current_task":task,"current_schema_no":schema_no},config,stream_mode="values")
+            for messages in transcript.last_pages(shown_pages):
+                for role, text in messages:
+                    render_message(transcript_area, role, text)
 
-            full_text,new_msg = print_to_streamlit(events,full_text)
-        
+    def render_sidebar(character_views):
+        # Characters are converted again only when they changed, those are shown expanded
+        for name, view, changed in character_views.update(game):
+            st.sidebar.expander(name, expanded=changed).json(view)
 
+    def create_game(theme, full_graph_object,save = None):
 
-        name = ""
-        if save_created:
-            name = "game"
+        if save:
+            # Every tool call of the creation and of the game afterwards is journaled to the save
+            session.journal = GameJournal(save)
 
-            if not override_save:
-                i = 1
-                while os.path.exists(f'{name}.pkl'):
-                    lst = name.split("_")[0]
-                    name = lst+"_"+str(i)
-                    i+=1
+        new_game(game)
+        session.applied_effects.clear()
+        full_graph_object.save_progress(snapshot=True)
 
-            with open(f'{name}.pkl', 'wb') as f:
+        messages = []
+        for inputs in creation_inputs(theme, game):
 
-                pickle.dump(game,f)
+            events = full_graph_object.stream_task(inputs)
 
-            name = f'{name}.pkl'
+            messages = print_to_streamlit(events,messages)
 
-        return full_text,name
+            full_graph_object.save_progress()
+
+        full_graph_object.save_progress(snapshot=True)
+        full_graph_object.check_balance()
+
+        return messages
         
 
     def define_non_player(list_of_players):
 
         for i in game.characters.keys():
             if i in list_of_players:
-                game.characters[i]["character_type"] = "player"
+                game.characters[i].character_type = "player"
             else:
-                game.characters[i]["character_type"] = "npc"
+                game.characters[i].character_type = "npc"
+            game.touch(i)
 
 
-    def start_game(graph_object,config,full_text):
+    def start_game(graph_object,config):
 
         game.main_character = list(game.characters.keys())[-1]
         main_character = game.main_character
         
         define_non_player([main_character])
+
+        if session.journal is not None:
+            session.journal.snapshot(game)
         
-        return invoke_loop(graph_object,config,full_text)
+        return invoke_loop(graph_object,config)
 
     def play_audio(audio):
         playsound(audio)
 
-    def invoke_loop(graph_object,config,full_text,content = None):
-
-        graph = graph_object.graph
+    def invoke_loop(graph_object,config,content = None):
 
         content = st.session_state.input_text if not content else content
 
         st.session_state.input_text = ""
         
-        full_text = print_text_to_streamlit(content,full_text)
+        messages = print_text_to_streamlit(content,[])
 
-        events = graph.stream(
-            {"messages": [{"role": "user", "content": content}]},
-            config,
-            stream_mode="values",
-        )
-        
-        graph_object.round_counter+=1
-
-        full_text,new_msg = print_to_streamlit(events,full_text)
+        # The narration shows up as it is generated, the tool stages run after it before the turn ends
+        chunks = graph_object.stream_narration(content)
 
-        return full_text
+        return print_narration_to_streamlit(chunks,messages)
 
     if "full_graph" not in st.session_state:
 
-        full_graph = FullGraph()
-        full_config = full_graph.config
-        full_graph = full_graph.graph
+        full_graph_object = FullGraph(session=session)
+        full_config = full_graph_object.config
+        full_graph = full_graph_object.graph
         
-        loop_graph = LoopGraph()
+        loop_graph = LoopGraph(session=session)
         loop_config = loop_graph.config
         
         st.session_state.previous_image_url = None
         st.session_state.previous_image_style = None
         
-        full_text = ""
         st.session_state.input_text = ''
 
 
-        full_text,pkl = create_game(st.session_state.theme,full_graph,full_config,full_text,save_created=True,override_save=False)
-        st.session_state.created_game_pkl = pkl
-
-        if pkl !="":
-
-            load_game(pkl)
+        save = st.session_state.created_game_save
 
-        print_text_to_streamlit("",full_text,new_text=False)
-        st.sidebar.json(game.characters)
-
-        full_text = start_game(loop_graph,loop_config,full_text)
+        # The transcript is kept next to the save, only its last rounds stay in memory
+        transcript = RoundLog(f"{save}/transcript.jsonl")
 
+        if st.session_state.get("resume_save"):
+            # The game comes from the journal, the loop's messages and counters from its checkpoints
+            open_game(save, session)
+            render_transcript(transcript)
+        else:
+            transcript.add_round(create_game(st.session_state.theme,full_graph_object,save))
+            transcript.add_round(start_game(loop_graph,loop_config))
 
         st.session_state.full_graph = full_graph
         st.session_state.full_config = full_config
         st.session_state.loop_graph = loop_graph
         st.session_state.loop_config = loop_config
-        st.session_state.full_text = full_text
-        st.session_state.game = game
+        st.session_state.transcript = transcript
+        st.session_state.character_views = CharacterViews()
     else:
 
         full_graph = st.session_state.full_graph
         full_config = st.session_state.full_config
         loop_graph = st.session_state.loop_graph
         loop_config = st.session_state.loop_config
-        full_text = st.session_state.full_text
-        game = st.session_state.game
+        transcript = st.session_state.transcript
+
+        render_transcript(transcript)
 
         
 
@@ -220,6 +278,6 @@ else:
 
     if st.session_state.input_text and st.session_state.input_text!="":    
 
-        st.session_state.full_text = invoke_loop(loop_graph,loop_config,full_text)
-        st.sidebar.json(game.characters)
-        
\ No newline at end of file
+        transcript.add_round(invoke_loop(loop_graph,loop_config))
+
+    render_sidebar(st.session_state.character_views)
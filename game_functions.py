@@ -1,9 +1,72 @@
 from langchain_core.tools import InjectedToolCallId, tool
-from typing import Annotated
-from static_objects import game
-import random
+from typing import Annotated, Optional
+from sessions import current_session
+from character_model import Character, Item
+from idempotency import describe_effect, effect_key
+from encounter_sim import sentence_pattern
+import functools
+import inspect
+import re
+
+# Undecorated state changing tools by name, used to replay a save journal
+replayable_tools = {}
+
+def journaled(func):
+    """Records every successful call of a state changing tool in the session's save journal, if it has one."""
+    signature = inspect.signature(func)
+    replayable_tools[func.__name__] = func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        result = func(*args, **kwargs)
+        journal = current_session().journal
+        if journal is not None:
+            journal.record(func.__name__, dict(signature.bind(*args, **kwargs).arguments))
+        return result
+
+    return wrapper
+
+def tool_batch():
+    # The task of the running tools node: LangGraph derives it from the checkpoint and the step, so a
+    # retried or resumed step gets the same one. Outside of a graph run every call is its own batch.
+    from langgraph.config import get_config
+
+    try:
+        return get_config().get("metadata", {}).get("langgraph_checkpoint_ns") or object()
+    except RuntimeError:
+        return object()
+
+def idempotent(func):
+    """
+    Applies an effect producing tool at most once per tool batch for the same arguments and occurrence.
+    The key is derived from the session's round number, the tool name, the arguments and how many identical
+    calls came before it in the batch, so running a batch again doesn't touch the game state again while
+    two identical calls of one batch are both applied (see idempotency.DedupStore).
+    """
+    signature = inspect.signature(func)
+    op = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        session = current_session()
+        arguments = dict(signature.bind(*args, **kwargs).arguments)
+        occurrence = session.applied_effects.occurrence(tool_batch(), effect_key(session.round, op, arguments))
+        key = effect_key(session.round, op, arguments, occurrence)
+        if not session.applied_effects.claim(key):
+            return f"Skipped, this {op} call was already applied when this step ran before."
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            session.applied_effects.release(key)
+            raise
+        session.applied_effects.applied(session.round, describe_effect(op, arguments))
+        return result
+
+    return wrapper
 
 @tool
+@idempotent
+@journaled
 def add_or_change_character(
     name: Annotated[str, "Unique character name"],
     details: Annotated[str, "Character description, personality, appearance, or backstory"],
@@ -26,7 +89,7 @@ def add_or_change_character(
 
     Behavior:
         - Creates a new character entry in the global 'characters' dictionary.
-        - Initializes the character's inventory as an empty list. Populating the inventory should be done separately using other tools.
+        - Initializes the character's inventory as empty. Populating the inventory should be done separately using other tools.
         - The character's information is stored in a dictionary with the following structure:
             {
                 "name": <name>,
@@ -50,16 +113,13 @@ def add_or_change_character(
             stats={"dexterity": 9, "perception": 8, "luck": 5}
         )
     """
-    template = {
-        "name": name,
-        "details": details,
-        "stats": stats,
-        "money": money,
-        "inventory": []
-    }
-    game.characters[name.lower()] = template
+    game = current_session().game
+    game.characters[name.lower()] = Character(name, details, stats, money)
+    game.touch(name.lower())
 
 @tool
+@idempotent
+@journaled
 def add_hp(
     character_name: Annotated[str, "Name of the character who will receive healing"],
     hp_to_add: Annotated[int, "Amount of HP to restore to the character"]
@@ -92,18 +152,22 @@ def add_hp(
             hp_to_add=40
         )
     """
+    game = current_session().game
     char_key = character_name.lower()
     
     if char_key not in game.characters:
         return f"Character '{character_name}' not found."
 
-    current_hp = game.characters[char_key].get("hp", 100)  # Default to 100 if undefined
-    new_hp = current_hp + hp_to_add
-    game.characters[char_key]["hp"] = new_hp
+    character = game.characters[char_key]
+    new_hp = character.current_hp + hp_to_add  # current_hp defaults to 100 if undefined
+    character.hp = new_hp
+    game.touch(char_key)
 
     return f"{character_name} was healed for {hp_to_add} HP. Current HP: {new_hp}."
 
 @tool
+@idempotent
+@journaled
 def deal_damage(
     character_name: Annotated[str, "Name of the character who will receive damage"],
     damage_dealt: Annotated[int, "Amount of damage to apply to the character's HP"]
@@ -135,18 +199,22 @@ def deal_damage(
             damage_dealt=25
         )
     """
+    game = current_session().game
     char_key = character_name.lower()
     
     if char_key not in game.characters:
         return f"Character '{character_name}' not found."
 
-    current_hp = game.characters[char_key].get("hp", 100)  # Default to 100 if undefined
-    new_hp = max(0, current_hp - damage_dealt)
-    game.characters[char_key]["hp"] = new_hp
+    character = game.characters[char_key]
+    new_hp = max(0, character.current_hp - damage_dealt)  # current_hp defaults to 100 if undefined
+    character.hp = new_hp
+    game.touch(char_key)
 
     return f"{character_name} received {damage_dealt} damage. Remaining HP: {new_hp}."
 
 @tool
+@idempotent
+@journaled
 def add_money(
     character_name: Annotated[str, "Name of the character whose money will be increased"],
     amount_to_add: Annotated[int, "Amount of in-game currency to add to the character"]
@@ -177,11 +245,16 @@ def add_money(
             amount_to_add=200
         )
     """
+    game = current_session().game
     char_key = character_name.lower()
-    game.characters[char_key]["money"] += amount_to_add
-    return f"Success, {amount_to_add} gold added to {character_name}. New balance: {game.characters[char_key]['money']} gold."
+    character = game.characters[char_key]
+    character.money += amount_to_add
+    game.touch(char_key)
+    return f"Success, {amount_to_add} gold added to {character_name}. New balance: {character.money} gold."
 
 @tool
+@idempotent
+@journaled
 def reduce_money(
     character_name: Annotated[str, "Name of the character whose money will be reduced"],
     amount_to_reduce: Annotated[int, "Amount of in-game currency to deduct from the character"]
@@ -212,14 +285,19 @@ def reduce_money(
             amount_to_reduce=50
         )
     """
+    game = current_session().game
     char_key = character_name.lower()
-    if game.characters[char_key]["money"] < amount_to_reduce:
+    character = game.characters[char_key]
+    if character.money < amount_to_reduce:
         return "Rejected, you don't have enough money!"
     
-    game.characters[char_key]["money"] -= amount_to_reduce
+    character.money -= amount_to_reduce
+    game.touch(char_key)
     return f"Success, {amount_to_reduce} gold deducted from {character_name}."
 
 @tool
+@idempotent
+@journaled
 def add_or_change_item_to_character_inventory(
     character_name: Annotated[str, "Name of the character to receive the item"],
     is_weapon: Annotated[bool, "True if the item is a weapon, False otherwise"],
@@ -255,7 +333,7 @@ def add_or_change_item_to_character_inventory(
             - "name": item_name
             - "details": details
             - "value": value
-        - The constructed item dictionary is appended to the character's "inventory" list.
+        - The constructed item is added to the character's inventory, replacing the item with the same name if there is one.
 
     Important Notes:
         - Ensure the character exists in the global 'characters' dictionary before calling this function.
@@ -274,86 +352,176 @@ def add_or_change_item_to_character_inventory(
             value=5000
         )
     """
-    if is_weapon:
-        template = {
-            "name": item_name,
-            "details": details,
-            "stats": stats,
-            "value": value
-        }
-    else:
-        template = {
-            "name": item_name,
-            "details": details,
-            "value": value
-        }
-
-    inventory = game.characters[character_name.lower()]["inventory"]
-
-    # Replace existing item if name matches; otherwise append as new
-    for idx, item in enumerate(inventory):
-        if item.get("name") == item_name:
-            inventory[idx] = template
-            break
-    else:
-        inventory.append(template)
+    game = current_session().game
+    item = Item(item_name, details, value, stats if is_weapon else None)
+
+    # Replaces the existing item if the name matches, otherwise adds it as new
+    game.characters[character_name.lower()].inventory.put(item)
+
+    game.touch(character_name.lower())
+
+def character_stats(game, character_name):
+    if not character_name:
+        return None
+    char_key = character_name.lower()
+    if char_key not in game.characters:
+        raise KeyError(f"Character couldn't be found: {character_name}")
+    return game.characters[char_key].stats
+
+# More rolls than this in one call only fill the context with numbers
+max_rolls = 100
+
+# Used when the rules name no dice or no Difficulty Ratings
+default_check_die = "1d20"
+default_difficulties = [10, 15, 20]
+
+# A sentence about checks, not about damage or what happens at 0 HP
+check_sentence = re.compile(r"\bchecks?\b|difficulty rating", re.IGNORECASE)
+not_check_sentence = re.compile(r"damage|\bHP\b|hit points|death|initiative", re.IGNORECASE)
+
+def check_die_of(rules):
+    """The dice of ability checks in the rules text, e.g. "Ability checks use 2d10" -> "2d10"."""
+    for sentence in sentence_pattern.split(rules or ""):
+        if check_sentence.search(sentence) and not not_check_sentence.search(sentence):
+            if dice := re.search(r"\b\d*d\d+\b", sentence):
+                return dice.group()
+    return default_check_die
+
+def check_odds(session):
+    """
+    Dice for the GM prompt, computed before the GM writes the round so it doesn't guess odds: the
+    main character's chance per stat against the DRs of the rules ("DR 16"), and this round's check roll.
+    """
+    game, dice = session.game, session.dice
+    check_die = check_die_of(game.rules)
+    difficulties = sorted({int(difficulty) for difficulty in re.findall(r"\bDR\s*(\d+)", game.rules or "")})[:5] or default_difficulties
+
+    lines = [f"Checks roll {check_die} + stat against a DR ({', '.join(map(str, difficulties))})."]
+
+    main_character = game.characters.get(getattr(game, "main_character", None) or "")
+    if main_character is not None:
+        for stat, value in main_character.stats.items():
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                continue
+            expression = f"{check_die} {'-' if value < 0 else '+'} {abs(int(value))}"
+            probabilities, _ = dice.probabilities(expression, difficulties)
+            odds = ", ".join(f"DR {difficulty}: {probability:.0%}" for difficulty, probability in zip(difficulties, probabilities))
+            lines.append(f"{main_character.name} {stat} ({int(value):+}): {odds}")
+
+    # Rolled once per round, from the round's own generator: retries and re-runs of the looper see the
+    # same roll, and the rolls of roll_dice still follow the session's seed
+    if session.check_roll is None or session.check_roll[0] != session.round:
+        session.check_roll = (session.round, dice.roll_detail(check_die, rng=dice.round_rng(session.round))[1])
+
+    lines.append(f"This round's check roll, if the action needs one: {session.check_roll[1]}, add the stat and bonuses.")
+    return "\n".join(lines)
+
+@tool
+def roll_dice(
+    expression: Annotated[str, "Dice expression, e.g. '2d10 + agility + 3', '4d6kh3' or '1d6!'"] = "1d20",
+    character_name: Annotated[Optional[str], "Character whose stats are used for stat names in the expression"] = None,
+    times: Annotated[int, "Number of independent rolls"] = 1
+):
+    """
+    Rolls a dice expression, optionally with the stats of a character.
+
+    Parameters:
+        expression (str): Dice, numbers and stat names joined with + and -. Supported dice:
+            - NdS: N dice with S sides, e.g. 2d10 (d% is a d100)
+            - NdSkhK / NdSklK: keep the K highest / lowest dice, e.g. 4d6kh3
+            - NdS!: exploding dice, a die showing its maximum is rolled again and added
+            Stat names (e.g. agility, or abbreviations such as AGI) are replaced by the character's stat.
+        character_name (str): The character whose stats are used. Needed only if the expression has stat names.
+        times (int): How many independent rolls to make, at most 100.
+
+    Behavior:
+        - Rolls with the session's seeded dice, so a campaign is reproducible.
+        - For a single roll every die and modifier is shown, e.g. "2d10[7, 4] + agility(5) + 3 = 19".
+
+    Returns:
+        str: The roll with its total, or the totals of all rolls when times > 1.
+
+    Example usage:
+        roll_dice(expression="2d10 + power + 3", character_name="Kaito")
+        roll_dice(expression="1d8", times=3)
+    """
+    session = current_session()
+    stats = character_stats(session.game, character_name)
+
+    if times <= 1:
+        return session.dice.roll_detail(expression, stats)[1]
+
+    times = min(times, max_rolls)
+
+    return f"{expression}: {session.dice.roll(expression, stats, times).tolist()}"
 
 @tool
-def roll_dice(sides: int = 20, number: int = 1):
+def check_probability(
+    expression: Annotated[str, "Dice expression of the check, e.g. '2d10 + agility + 3'"],
+    difficulties: Annotated[list[int], "One or more Difficulty Ratings (DR) to meet or exceed, e.g. [12, 16, 20]"],
+    character_name: Annotated[Optional[str], "Character whose stats are used for stat names in the expression"] = None
+):
     """
-    Rolls one or more dice with a specified number of sides.
+    Calculates the probability that a dice expression meets or exceeds each given Difficulty Rating (DR).
 
-    Args:
-        sides (int): The number of faces on the die (e.g., 6 for d6, 20 for d20).
-        number (int): The number of dice to roll simultaneously.
+    Parameters:
+        expression (str): The check, in the same format as roll_dice, e.g. "2d10 + REF + 3".
+        difficulties (list[int]): The DRs to check against, e.g. [16] or [12, 16, 20, 24].
+        character_name (str): The character whose stats are used. Needed only if the expression has stat names.
+
+    Behavior:
+        - Uses the exact distribution of the roll when it can be computed, otherwise a 1,000,000 roll estimate.
+        - Nothing is rolled, the campaign's dice are not affected.
 
     Returns:
-        list: A list containing the results of each die rolled.
+        str: One line per DR with the chance of success.
 
-    Example:
-        roll_dice(20)       # Rolls a single d20
-        roll_dice(6, 2)     # Rolls two d6 dice
+    Example usage:
+        check_probability(expression="2d10 + agility + 3", difficulties=[16, 20], character_name="Luna")
     """
-    results = [random.randint(1, sides) for _ in range(number)]
-    return results
+    session = current_session()
+    stats = character_stats(session.game, character_name)
+
+    probabilities, method = session.dice.probabilities(expression, difficulties, stats)
 
-# Example usage:
-# print("d20 result:", roll_dice(20))
-# print("2d6 results:", roll_dice(6, 2))
+    lines = [f"P({expression} >= {difficulty}) = {probability:.1%}" for difficulty, probability in zip(difficulties, probabilities)]
+    return "\n".join(lines) + f"\n({method})"
 
 
 @tool
+@idempotent
+@journaled
 def delete_item_from_character_inventory(character_name: Annotated[str, "Name of the character whose inventory will be modified"],
     item_name: Annotated[str, "Name of the item to delete from the character's inventory"]):
     """
     Erases the specified item from the specified character's inventory.
     """
+    game = current_session().game
     # Check if the character exists.
     char_key = character_name.lower()
     if char_key not in game.characters:
         raise KeyError(f"Character couldn't be found: {character_name}")
 
-    inventory = game.characters[char_key].get("inventory")
-    if inventory is None:
-        raise KeyError(f"{character_name} does not have an inventory.")
-
-    # Find the item and erase it from the inventory.
-    for idx, item in enumerate(inventory):
-        if item.get("name") == item_name:
-            del inventory[idx]
-            break
-    else:
+    inventory = game.characters[char_key].inventory
+    if item_name not in inventory:
         raise ValueError(f"{item_name} isn't in the inventory. {inventory}")
 
+    inventory.remove(item_name)
+
+    game.touch(char_key)
+
 
 @tool
+@journaled
 def define_rules(rules: Annotated[str, "Game rules written in plain language to enforce gameplay compliance"]):
     "Add game rules in a string so that another LLM can read these and decide if the actions are comply with these rules."
     "Returns True if worked successfully"
+    game = current_session().game
     game.rules = rules
     return True    
 
 @tool
+@journaled
 def define_story(
     story: Annotated[str, "The narrative background of the game, written in plain language."]
 ):
@@ -362,6 +530,7 @@ def define_story(
     lore consistency, or setting details.
     """
     "Returns True if worked successfully"
+    game = current_session().game
 
     game.story = story 
     return True    
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict, deque
+
+
+def normalize_args(args):
+    """Character names are matched case-insensitively by the tools, so they are part of the key in lower case."""
+    return {key: value.strip().lower() if key == "character_name" and isinstance(value, str) else value for key, value in args.items()}
+
+
+def effect_key(round_no, op, args, occurrence = 0):
+    """
+    Deterministic key of one tool effect: the same call with the same arguments in the same round gets the
+    same key. occurrence tells identical calls of one tool batch apart, see DedupStore.occurrence.
+    """
+    payload = json.dumps([round_no, op, normalize_args(args), occurrence], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def describe_effect(op, args, max_chars = 60):
+    """Short text of a tool call for the prompts, long arguments (descriptions) are cut."""
+    shown = {key: value[:max_chars] if isinstance(value, str) else value for key, value in normalize_args(args).items()}
+    return f"{op}({json.dumps(shown, ensure_ascii=False, default=str)})"
+
+
+class DedupStore:
+    """
+    Bounded set of the effect keys that were already applied. Only the last max_keys keys are kept, which
+    covers the rounds in which a tool call can still be repeated.
+
+    A batch is one run of the tools node, its calls are counted from 0 when it starts (start_batch).
+    Running the same batch again (a retried or resumed graph step) produces the same keys and is skipped, while two identical calls inside one batch (buying the same
+    thing twice) are numbered by occurrence and both applied. Calls of earlier rounds are kept in recent
+    for the tool controller prompt, the keys can't tell a repeated narration from a new action.
+    """
+
+    def __init__(self, max_keys = 1024, max_batches = 64, max_recent = 8):
+        self.max_keys = max_keys
+        self.keys = OrderedDict()
+        self.suppressed = 0
+
+        self.max_batches = max_batches
+        self.batches = OrderedDict()  # batch -> {base key: calls seen}
+
+        self.recent = deque(maxlen=max_recent)  # (round, describe_effect text) of the applied calls
+
+        # Parallel tool calls run on ToolNode's worker threads
+        self.lock = threading.Lock()
+
+    def claim(self, key):
+        """Returns True and remembers key if it was not applied yet, False for a duplicate."""
+        with self.lock:
+            if key in self.keys:
+                self.suppressed += 1
+                return False
+
+            self.keys[key] = True
+            if len(self.keys) > self.max_keys:
+                self.keys.popitem(last=False)
+            return True
+
+    def start_batch(self, batch):
+        """
+        Forgets the calls counted in batch. Tools nodes call it on every run, a retried or resumed one too,
+        so identical tool calls are counted from the start again.
+        """
+        with self.lock:
+            self.batches.pop(batch, None)
+
+    def occurrence(self, batch, key):
+        """How many calls with key came before this one in batch (0 for the first)."""
+        with self.lock:
+            seen = self.batches.setdefault(batch, {})
+            self.batches.move_to_end(batch)
+            if len(self.batches) > self.max_batches:
+                self.batches.popitem(last=False)
+
+            count = seen.get(key, 0)
+            seen[key] = count + 1
+            return count
+
+    def applied(self, round_no, text):
+        with self.lock:
+            self.recent.append((round_no, text))
+
+    def applied_before(self, round_no):
+        """The recent calls of rounds before round_no, oldest first."""
+        with self.lock:
+            return [text for applied_round, text in self.recent if applied_round < round_no]
+
+    def release(self, key):
+        """Forgets key, used when the effect failed so a retry is not taken for a duplicate."""
+        with self.lock:
+            self.keys.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+            self.batches.clear()
+            self.recent.clear()
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
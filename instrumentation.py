@@ -0,0 +1,304 @@
+"""
+Local tracing of the graph nodes.
+
+SpanRecorder is a LangChain callback handler that is part of every session's graph config. It opens a span
+when a LoopGraph or FullGraph node starts and closes it when the node ends, collecting on the way:
+
+    wall_ms            node wall time
+    llm_ms, llm_calls  time spent waiting on chat models and how many were called
+    ttft_ms            time to the first streamed token of the node's first model call (streaming runs only)
+    prompt_tokens      token usage reported by the models
+    completion_tokens
+    retries, errors    retried runnables and failed model calls
+    rag_ms             retrieval latency, added by the code that queries the RAG store (see timed)
+
+plus whatever the node adds with annotate(). Every finished span is one line of a rotating JSONL file
+(FRPG_SPANS_PATH, ./data/spans/spans.jsonl by default) and is folded into the aggregates that
+prometheus_text() renders for the /metrics endpoint of backend.py.
+
+Nodes are told apart by LangGraph's checkpoint namespace ("looper:<task id>"), which the node and every
+runnable called inside it carry in their metadata.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+from logging.handlers import RotatingFileHandler
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+spans_path = os.getenv("FRPG_SPANS_PATH", "./data/spans/spans.jsonl")
+spans_max_bytes = 10 * 2**20
+spans_backup_count = 5
+
+# Upper bounds of the latency histograms, in seconds
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+
+    def __init__(self, buckets = latency_buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {self.count}'
+        yield f"{name}_sum{{{labels}}} {self.sum:.6f}"
+        yield f"{name}_count{{{labels}}} {self.count}"
+
+
+class Metrics:
+    """Aggregates of the finished spans per (graph, node), rendered in the Prometheus text format."""
+
+    histograms = {
+        "frpg_node_duration_seconds": ("Wall time of a graph node", "wall_ms"),
+        "frpg_node_llm_seconds": ("Time a graph node waited on chat models", "llm_ms"),
+        "frpg_node_ttft_seconds": ("Time to the first streamed token of a node's model call", "ttft_ms"),
+        "frpg_rag_seconds": ("RAG retrieval latency", "rag_ms"),
+    }
+
+    counters = {
+        "frpg_node_runs_total": ("Graph node runs", None),
+        "frpg_llm_calls_total": ("Chat model calls", "llm_calls"),
+        "frpg_prompt_tokens_total": ("Prompt tokens sent to chat models", "prompt_tokens"),
+        "frpg_completion_tokens_total": ("Completion tokens received from chat models", "completion_tokens"),
+        "frpg_retries_total": ("Retried runnables", "retries"),
+        "frpg_errors_total": ("Failed model calls and nodes", "errors"),
+        "frpg_rounds_total": ("Played rounds", "rounds"),
+        "frpg_summary_calls_total": ("Summarizer calls, one per batch of whole rounds", "summary_calls"),
+        "frpg_summarized_rounds_total": ("Rounds folded into the running summary", "summarized_rounds"),
+    }
+
+    def __init__(self):
+        self.values = defaultdict(lambda: defaultdict(float))
+        self.distributions = defaultdict(lambda: defaultdict(Histogram))
+        self.lock = threading.Lock()
+
+    def observe(self, span):
+        key = (span.get("graph") or "unknown", span["node"])
+        with self.lock:
+            for name, (_, field) in self.counters.items():
+                self.values[name][key] += 1 if field is None else span.get(field) or 0
+            for name, (_, field) in self.histograms.items():
+                if span.get(field) is not None:
+                    self.distributions[name][key].observe(span[field] / 1000)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (help_text, _) in self.counters.items():
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                for (graph, node), value in sorted(self.values[name].items()):
+                    lines.append(f'{name}{{graph="{graph}",node="{node}"}} {value:g}')
+            for name, (help_text, _) in self.histograms.items():
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+                for (graph, node), histogram in sorted(self.distributions[name].items()):
+                    lines += histogram.lines(name, f'graph="{graph}",node="{node}"')
+        return "\n".join(lines) + "\n"
+
+
+def _new_span(metadata, node):
+    return {
+        "ts": time.time(),
+        "graph": metadata.get("graph"),
+        "node": node,
+        "session": metadata.get("session_id"),
+        "thread": metadata.get("thread_id"),
+        "step": metadata.get("langgraph_step"),
+        "llm_ms": 0.0,
+        "llm_calls": 0,
+        "ttft_ms": None,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "retries": 0,
+        "errors": 0,
+        "rag_ms": None,
+    }
+
+
+class SpanRecorder(BaseCallbackHandler):
+    """Turns the callbacks of a graph run into one span per node run, see the module docstring."""
+
+    # Spans are opened and closed in the thread that runs the node, not in a callback executor
+    run_inline = True
+
+    def __init__(self, metrics = None, logger = None):
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.logger = logger
+        self.spans = {}  # checkpoint namespace -> (run id of the node, start, span)
+        self.chain_runs = {}  # run id of every runnable inside a node -> checkpoint namespace
+        self.llm_runs = {}  # model run id -> [namespace, start, token seen, metadata]
+        self.lock = threading.Lock()
+
+    def on_chain_start(self, serialized, inputs, *, run_id, metadata = None, **kwargs):
+        metadata = metadata or {}
+        namespace = metadata.get("langgraph_checkpoint_ns")
+        if namespace is None:
+            return
+
+        node = metadata.get("langgraph_node")
+        with self.lock:
+            self.chain_runs[run_id] = namespace
+            # The node itself opens the span, not the runnables inside it; a RunnableLambda node starts
+            # twice with the same name
+            if kwargs.get("name") == node and namespace not in self.spans:
+                self.spans[namespace] = (run_id, time.perf_counter(), _new_span(metadata, node))
+
+    def _finish(self, run_id, error = None):
+        with self.lock:
+            namespace = self.chain_runs.pop(run_id, None)
+            if namespace is None or self.spans.get(namespace, (None,))[0] != run_id:
+                return
+            _, start, span = self.spans.pop(namespace)
+
+        span["wall_ms"] = (time.perf_counter() - start) * 1000
+        if error is not None:
+            span["errors"] += 1
+            span["error"] = f"{type(error).__name__}: {error}"
+        self.emit(span)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id, error)
+
+    def on_retry(self, retry_state, *, run_id, **kwargs):
+        with self.lock:
+            if (open_span := self.spans.get(self.chain_runs.get(run_id))) is not None:
+                open_span[2]["retries"] += 1
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata = None, **kwargs):
+        metadata = metadata or {}
+        with self.lock:
+            self.llm_runs[run_id] = [metadata.get("langgraph_checkpoint_ns"), time.perf_counter(), False, metadata]
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        with self.lock:
+            run = self.llm_runs.get(run_id)
+            if run is None or run[2]:
+                return
+            run[2] = True
+            if (open_span := self.spans.get(run[0])) is not None and open_span[2]["ttft_ms"] is None:
+                open_span[2]["ttft_ms"] = (time.perf_counter() - run[1]) * 1000
+
+    def _llm_finished(self, run_id, response = None, error = None):
+        with self.lock:
+            run = self.llm_runs.pop(run_id, None)
+        if run is None:
+            return
+        namespace, start, _, metadata = run
+
+        usage = {}
+        for generations in getattr(response, "generations", None) or []:
+            for generation in generations:
+                for key, value in (getattr(getattr(generation, "message", None), "usage_metadata", None) or {}).items():
+                    if isinstance(value, int):
+                        usage[key] = usage.get(key, 0) + value
+
+        with self.lock:
+            open_span = self.spans.get(namespace)
+            # A call that outlived its node, e.g. the summary running in the background, is a span of its own
+            span = open_span[2] if open_span is not None else _new_span(metadata, f"{metadata.get('langgraph_node', 'unknown')}:background")
+            span["llm_ms"] += (time.perf_counter() - start) * 1000
+            span["llm_calls"] += 1
+            span["prompt_tokens"] += usage.get("input_tokens", 0)
+            span["completion_tokens"] += usage.get("output_tokens", 0)
+            if error is not None:
+                span["errors"] += 1
+
+        if open_span is None:
+            span["wall_ms"] = span["llm_ms"]
+            self.emit(span)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._llm_finished(run_id, response=response)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._llm_finished(run_id, error=error)
+
+    def add(self, metadata, **fields):
+        """Adds fields to the open span of the node with this metadata, numbers are summed."""
+        with self.lock:
+            open_span = self.spans.get((metadata or {}).get("langgraph_checkpoint_ns"))
+            if open_span is None:
+                return
+            span = open_span[2]
+            for key, value in fields.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool) and isinstance(span.get(key), (int, float)):
+                    span[key] += value
+                else:
+                    span[key] = value
+
+    def emit(self, span):
+        self.metrics.observe(span)
+        if self.logger is not None:
+            self.logger.info(json.dumps(span, ensure_ascii=False, default=str))
+
+
+def _spans_logger(path):
+    logger = logging.getLogger("frpg.spans")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        handler = RotatingFileHandler(path, maxBytes=spans_max_bytes, backupCount=spans_backup_count, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+    return logger
+
+
+@lru_cache(maxsize=None)
+def get_span_recorder():
+    """The process wide recorder, shared by the configs of every session."""
+    return SpanRecorder(Metrics(), _spans_logger(spans_path))
+
+
+def _node_metadata():
+    # Inside a node the runnable config of the current run is available, outside of one there is no span
+    from langgraph.config import get_config
+
+    try:
+        return get_config().get("metadata")
+    except RuntimeError:
+        return None
+
+
+def annotate(**fields):
+    """Adds fields to the span of the node that is running, a no-op outside of a graph run."""
+    metadata = _node_metadata()
+    if metadata is not None:
+        get_span_recorder().add(metadata, **fields)
+
+
+@contextmanager
+def timed(field):
+    """Adds the milliseconds spent in the block to field (e.g. "rag_ms") of the running node's span."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        annotate(**{field: (time.perf_counter() - start) * 1000})
+
+
+def prometheus_text():
+    return get_span_recorder().metrics.render()
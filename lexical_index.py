@@ -0,0 +1,74 @@
+import math
+import re
+from collections import Counter, defaultdict
+
+# Words of any script (the games are written in English and Turkish), numbers included
+word_pattern = re.compile(r"\w+", re.UNICODE)
+
+
+def terms(text, weight = 1.0):
+    """Lowercased word counts of text, scaled by weight."""
+    counts = Counter(word_pattern.findall(text.lower()))
+    return Counter({term: count * weight for term, count in counts.items()}) if weight != 1.0 else counts
+
+
+class LexicalIndex:
+    """
+    Incrementally maintained inverted index scored with BM25.
+
+    Catches what the sentence embeddings are weak at: proper nouns such as NPC, place and item names
+    match exactly here. Adding a document only touches the postings of its own terms and a search only
+    reads the postings of the query terms, so neither depends on the size of the whole index.
+    """
+
+    def __init__(self, k1 = 1.2, b = 0.75):
+        self.k1 = k1
+        self.b = b
+
+        self.postings = defaultdict(dict)  # term -> {doc id: term frequency}
+        self.lengths = {}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def add(self, doc_id, text):
+
+        if doc_id in self.lengths:
+            return
+
+        counts = terms(text)
+        for term, count in counts.items():
+            self.postings[term][doc_id] = count
+
+        length = sum(counts.values())
+        self.lengths[doc_id] = length
+        self.total_length += length
+
+    def search(self, query, k = 20):
+        """
+        The k best (doc id, score) pairs for query, a text or a Counter of term weights (see terms), e.g.
+        the player's input plus the previous round at a lower weight.
+        """
+
+        if isinstance(query, str):
+            query = terms(query)
+
+        if not self.lengths:
+            return []
+
+        count = len(self.lengths)
+        average_length = self.total_length / count
+
+        scores = defaultdict(float)
+        for term, weight in query.items():
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, frequency in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[doc_id] / average_length)
+                scores[doc_id] += weight * idf * frequency * (self.k1 + 1) / (frequency + norm)
+
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
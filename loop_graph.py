@@ -1,30 +1,32 @@
 from typing import Annotated, Literal
+from functools import lru_cache
 
 from typing_extensions import TypedDict
 
-from langgraph.checkpoint.memory import MemorySaver
-from langchain_community.vectorstores import FAISS
-from langchain_huggingface import HuggingFaceEmbeddings
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
-from langgraph.prebuilt import ToolNode, tools_condition
-from langchain.chat_models import init_chat_model
-from langchain_ollama.chat_models import ChatOllama
-from langchain_groq import ChatGroq
+from langgraph.prebuilt import ToolNode
 from langchain_core.messages.utils import count_tokens_approximately
 from langchain_core.messages import HumanMessage,SystemMessage,AIMessage,ToolMessage,RemoveMessage,AnyMessage
-from langchain.prompts import ChatPromptTemplate
-from langmem.short_term import SummarizationNode, RunningSummary
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain.schema import Document
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableLambda
+from langchain_core.documents import Document
 
 from pydantic import BaseModel,Field
 
-from static_objects import game,generate_task_prompt
-from game_functions import add_or_change_character,add_or_change_item_to_character_inventory,delete_item_from_character_inventory,define_story,roll_dice,add_money,reduce_money
-
+from static_objects import generate_task_prompt
+from sessions import current_session
+from embedding_cache import CachedEmbeddings
+from fake_llm import fake_chat_model, fake_embeddings, fake_enabled
+from instrumentation import annotate, timed
+from prompt_assembler import PromptAssembler
+from prefix_cache import PrefixTracker
+from lexical_index import terms as lexical_terms
+from game_functions import check_odds,tool_batch,add_or_change_character,add_or_change_item_to_character_inventory,delete_item_from_character_inventory,define_story,roll_dice,check_probability,add_money,reduce_money
+
+import asyncio
+import contextvars
 import os
-import numpy as np
 
 class State(TypedDict):
         messages: Annotated[list, add_messages]
@@ -32,6 +34,8 @@ class State(TypedDict):
         summary : str
         context: str
         summarized_messages: Annotated[list,add_messages]
+        # Round and summary bookkeeping of LoopGraph, checkpointed so a restarted server goes on from it
+        counters: dict
 
 class ResponseFormatter(BaseModel):
     """Always use this tool to structure your response to the user."""
@@ -48,15 +52,53 @@ class ResponseFormatter(BaseModel):
         description="Summary of the action that required tools if there are any, within a sentence. (Other than this tool)",
     )
 
-embedding_model = HuggingFaceEmbeddings(
-    model_name="sentence-transformers/all-MiniLM-L6-v2"
-)
+# Everything below that loads a model, reads the index or opens a client is created on first use,
+# so importing this module stays cheap.
+
+@lru_cache(maxsize=None)
+def get_embedding_model():
+    if (fake := fake_embeddings()) is not None:
+        return CachedEmbeddings(fake, cache_path=None)
+
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    # MiniLM embeds queries and documents the same way, so both share one cache
+    return CachedEmbeddings(HuggingFaceEmbeddings(
+        model_name="sentence-transformers/all-MiniLM-L6-v2"
+    ))
+
+def get_vector_store(session = None):
+    from rag_store import PersistentRAGStore
+
+    session = session or current_session()
+
+    if session.rag_store is None:
+        # "auto" promotes the exact index to a compressed IVF index once the campaign is long, see rag_store.py
+        session.rag_store = PersistentRAGStore(
+            session.rag_folder, get_embedding_model(), index_type=os.getenv("FRPG_RAG_INDEX", "auto")
+        )
 
-documents = [Document(page_content=" ",metadata = {"round no":0})]
+    return session.rag_store
 
-vector_store = FAISS.from_documents(documents, embedding_model)
+def get_checkpointer(session = None):
+    from sqlite_checkpointer import SqliteCheckpointer
 
-to_remove = []
+    session = session or current_session()
+
+    if session.checkpointer is None:
+        session.checkpointer = SqliteCheckpointer(session.checkpoint_path)
+
+    return session.checkpointer
+
+def get_archive(session = None):
+    from round_archive import RoundArchive
+
+    session = session or current_session()
+
+    if session.archive is None:
+        session.archive = RoundArchive(session.checkpoint_path)
+
+    return session.archive
 
 tools = [
     add_or_change_character,
@@ -64,29 +106,59 @@ tools = [
     delete_item_from_character_inventory,
     add_money,
     reduce_money,
+    roll_dice,
+    check_probability,
     ResponseFormatter
 ]
 
-tooler_llm = ChatGroq(
-    groq_api_key=os.getenv("GROQ_API_KEY"),
-    model="qwen/qwen3-32b",  # veya Groq'un desteklediği başka bir model
-    reasoning_effort="default",
-    reasoning_format="hidden"
-)
+@lru_cache(maxsize=None)
+def get_summary_executor():
+    # Shared by every session, running summaries only wait on the summarizer LLM
+    from concurrent.futures import ThreadPoolExecutor
+
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="summarizer")
+
+@lru_cache(maxsize=None)
+def get_tooler_llm():
+    if (fake := fake_chat_model()) is not None:
+        return fake
+
+    from langchain_groq import ChatGroq
+
+    return ChatGroq(
+        groq_api_key=os.getenv("GROQ_API_KEY"),
+        model="qwen/qwen3-32b",  # veya Groq'un desteklediği başka bir model
+        reasoning_effort="default",
+        reasoning_format="hidden"
+    )
 
 # llm = init_chat_model("google_genai:gemini-2.0-flash")
 
-llm = ChatGroq(
-    groq_api_key=os.getenv("GROQ_API_KEY"),
-    model="meta-llama/llama-4-scout-17b-16e-instruct",  # veya Groq'un desteklediği başka bir model
-)
+@lru_cache(maxsize=None)
+def get_llm():
+    if (fake := fake_chat_model()) is not None:
+        return fake
 
-summarizer_llm = ChatGroq(
-    groq_api_key=os.getenv("GROQ_API_KEY"),
-    model="gemma2-9b-it",  # veya Groq'un desteklediği başka bir model
-)
+    from langchain_groq import ChatGroq
+
+    return ChatGroq(
+        groq_api_key=os.getenv("GROQ_API_KEY"),
+        model="meta-llama/llama-4-scout-17b-16e-instruct",  # veya Groq'un desteklediği başka bir model
+    )
 
-summarizer_llm = summarizer_llm.bind(max_tokens = 1024)
+@lru_cache(maxsize=None)
+def get_summarizer_llm():
+    summarizer_llm = fake_chat_model()
+
+    if summarizer_llm is None:
+        from langchain_groq import ChatGroq
+
+        summarizer_llm = ChatGroq(
+            groq_api_key=os.getenv("GROQ_API_KEY"),
+            model="gemma2-9b-it",  # veya Groq'un desteklediği başka bir model
+        )
+
+    return summarizer_llm.bind(max_tokens = 1024)
 
 last_x_rounds = 3
 
@@ -103,17 +175,19 @@ f"""
 Always use ResponseFormatter tool to format you responses.
 """)
 
-llm_with_tools = tooler_llm.bind_tools(tools,parallel_tool_calls=True)
-
-last_actions = []
-last_actions.append("No action yet!")
+@lru_cache(maxsize=None)
+def get_llm_with_tools():
+    return get_tooler_llm().bind_tools(tools,parallel_tool_calls=True)
 
-def tool_controller(state: State):
-    print("tool_controller stage")
+def tool_controller_messages(state: State):
+    session = current_session()
+    # Same encoding the GM prompt of this turn used, the tools have not run yet
+    characters,character_changes = session.character_state.snapshot_text,session.character_state.delta_text
     # Only take the last 4 messages, or fewer if there aren't enough
     recent_messages = state["messages"][-9:]
 
-    recent_messages.append(f"""Instructions for Tool Use and Output Formatting:
+    # A message rather than a template string, the character JSON is full of braces
+    recent_messages.append(HumanMessage(f"""Instructions for Tool Use and Output Formatting:
 
 Only evaluate the last round or last action.
 
@@ -123,9 +197,9 @@ Do not use any tools if the action is not from the last round.
 
 Avoid duplicate processing:
 
-These actions have already been processed: {last_actions}
+These tool calls were already applied in the previous rounds: {session.applied_effects.applied_before(session.round) or "none"}
 
-Do not repeat any action in this list.
+Do not repeat them unless the last round clearly does the same thing again.
 
 Decide if any tool is necessary:
 
@@ -141,6 +215,8 @@ Use add_or_change_item_to_character_inventory() or delete_item_from_character_in
 
 Use add_or_change_character() only if a character permanently joins the party. Explain the reason.
 
+Use roll_dice() with the rule's dice expression (e.g. "2d10 + agility + 3") and the character's name if a check of the last round was not rolled yet, and check_probability() to state the odds of a check against its DR instead of guessing them.
+
 When a transaction is mentioned but no price is explicitly stated, try to infer the price using contextual reasoning. However, do not assume that a transaction has occurred unless it is clearly confirmed.
 
 After any transaction, always update both characters’ inventory and money.
@@ -151,21 +227,35 @@ Always use ResponseFormatter, especially when tools are used.
 
 Follow structured output rules.
 
-Use the character and inventory data provided earlier.
+Use this character and inventory data (snapshot, then the changes since the snapshot):
+
+{characters}
+
+Changes: {character_changes}
 
 Final instruction:
 
 Explain every step you take in your reasoning, even if you take no action.
 
-""")
+"""))
 
     chat_prompt = ChatPromptTemplate.from_messages([
             *recent_messages,
         ])
     #print(chat_prompt.format_messages())
-    message = llm_with_tools.invoke(chat_prompt.format_messages())
+    return chat_prompt.format_messages()
+
+def tool_controller(state: State):
+    message = get_llm_with_tools().invoke(tool_controller_messages(state))
+
+    current_session().to_remove.append(message.id)
+
+    return {"messages": [message]}
+
+async def atool_controller(state: State):
+    message = await get_llm_with_tools().ainvoke(tool_controller_messages(state))
 
-    to_remove.append(message.id)
+    current_session().to_remove.append(message.id)
 
     return {"messages": [message]}
     
@@ -186,21 +276,43 @@ def filter_out_rule_messages(state:State) -> Annotated[list, "Filtered messages
 
     return _dict 
 
-def retrieve_rag_result(prompt,last_round):
+def retrieve_rag_result(prompt,last_round,session = None,budget = 600,min_score = 0.5):
+    """
+    Hybrid retrieval (vectors and BM25, see PersistentRAGStore.hybrid_search) with recency by round.
+    Chunks are taken best first until budget tokens are used; chunks scoring below min_score times the
+    best one are left out, so a turn with one clear match sends one chunk.
+    """
 
-    # prompt_embedding = embedding_model.embed_query(prompt)
-    # last_round_embedding = embedding_model.embed_query(last_round)
-    
-    # embedding = (np.array(prompt_embedding)+np.array(last_round_embedding))/2
+    session = session or current_session()
+
+    # One query for the input and the previous round together, as before the cache. Both are new text
+    # every turn, so the cache only answers when the same text comes again (a repeated or retried turn).
+    embedding_model = get_embedding_model()
+
+    with timed("rag_ms"):
+        embedding = embedding_model.embed_query(prompt+(last_round or ""))
+
+        # Names the player types count double the ones in the previous narration
+        query = lexical_terms(prompt)
+        query.update(lexical_terms(last_round or "",0.5))
+
+        ranked = get_vector_store(session).hybrid_search(embedding,query,current_round=session.round)
 
-    # results = vector_store.similarity_search_by_vector(embedding, k=3)
+        results = []
+        used = 0
+        for doc, score in ranked:
+            tokens = count_tokens_approximately([HumanMessage(doc.page_content)])
+            if score < min_score*ranked[0][1] or used+tokens > budget:
+                break
+            results.append(doc)
+            used += tokens
 
-    results = vector_store.similarity_search(prompt+last_round,3)
+    annotate(embedding_cache_hit_rate=embedding_model.stats()["hit_rate"],rag_chunks=len(results),rag_tokens=used)
 
     return results
 
 def tool_stage(state:State):
-    print("tool stage")
+    current_session().applied_effects.start_batch(tool_batch())
     tool_node = ToolNode(tools=tools)
     return tool_node
 
@@ -223,7 +335,7 @@ def route_tools(
 
 def structure(state:State):
     
-    global last_actions
+    session = current_session()
 
     if messages := state.get("messages", []):
             for i in range(len(messages)-1,0,-1):
@@ -235,22 +347,33 @@ def structure(state:State):
     else:
         raise ValueError("No message found in input")
     
+    annotate(tool_calls=[tool_call["name"] for tool_call in message.tool_calls])
+
     for tool_call in message.tool_calls:
-        print(tool_call["name"])
         if tool_call["name"]=="ResponseFormatter":
             
             args = tool_call["args"]
 
             pydantic_object = ResponseFormatter.model_validate(args)
-            print("bool:",pydantic_object.tool_used_other_than_responseformatter,"reason:",pydantic_object.reason,"summary:",pydantic_object.summary)
+            annotate(tools_used=pydantic_object.tool_used_other_than_responseformatter,summary=pydantic_object.summary)
 
-            last_actions.insert(0,pydantic_object.summary)
-            last_actions = last_actions[:2]
-            print("out of structure")
+            end_turn(session)
             return {"reason":pydantic_object.reason,"summary":pydantic_object.summary}
     else:
+        end_turn(session)
         return {"reason":"No reason!","summary":"No summary!"}
 
+def end_turn(session):
+    # Every tool of the turn has run, make its changes durable
+    if session.journal is not None:
+        session.journal.end_turn(session.game)
+
+def narration_text(message, metadata):
+    """Text of a streamed message chunk if it belongs to the GM's narration, else None."""
+    if metadata.get("langgraph_node") != "looper" or not isinstance(message, AIMessage):
+        return None
+    return message.content if isinstance(message.content, str) and message.content else None
+
 def format_message(message):
     if isinstance(message,HumanMessage):
         role = "Human"
@@ -264,38 +387,69 @@ def format_message(message):
 
 class LoopGraph:
      
-    def __init__(self,max_seen_rounds = 6):
-        
-        self.config = {"configurable": {"thread_id": "2"}}
+    def __init__(self,max_seen_rounds = 6,session = None,max_summary_lag = 2,prompt_budgets = None,checkpointer = None,live_rounds = None,summary_tokens = 2000,rag_tokens = 600):
 
-        self.round_counter = 0
+        self.session = session or current_session()
+
+        self.config = self.session.loop_config
 
         self.last_summarized = 0
 
+        # Messages already in the RAG store, ahead of last_summarized when a summarizer call failed
+        self.last_indexed = 0
+
         self.max_seen_rounds = max_seen_rounds
 
-        self.splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(chunk_size=500, chunk_overlap=100)
+        # Rounds kept in the graph state, older ones are archived. Enough for the GM's history window.
+        self.live_rounds = live_rounds or 2*max_seen_rounds
+
+        self.max_summary_lag = max_summary_lag
+
+        # New history (approximate tokens) that makes one summarizer call worth it
+        self.summary_tokens = summary_tokens
+
+        self.summary_calls = 0
+
+        # Token budget of the retrieved chunks, below the prompt's "rag" budget so none gets cut
+        self.rag_tokens = rag_tokens
+
+        self.prompt_budgets = prompt_budgets
+
+        self.prefix_tracker = PrefixTracker()
+
+        self.pending_summary = None
+
+        self.pending_start = 0
+
+        self.pending_round = 0
+
+        self._splitter = None
 
         graph_builder = StateGraph(State)
         
 
-        graph_builder.add_node("filter",filter_out_rule_messages)
+        graph_builder.add_node("window",self.window_messages)
 
-        graph_builder.add_node("looper",self.looper)
+        # Nodes that call an LLM get an async variant, used when the graph runs with ainvoke/astream
+        graph_builder.add_node("looper",RunnableLambda(self.looper,afunc=self.alooper))
 
-        graph_builder.add_node("tool_controller",tool_controller)
+        graph_builder.add_node("tool_controller",RunnableLambda(tool_controller,afunc=atool_controller))
 
         graph_builder.add_node("tools",tool_stage)
 
         graph_builder.add_node("structure",structure)
 
-        graph_builder.add_node("prepare_summarize_messages",self.prepare_summarize_messages)
+        graph_builder.add_node("merge_summary",RunnableLambda(self.merge_summary,afunc=self.amerge_summary))
+
+        graph_builder.add_node("schedule_summary",RunnableLambda(self.schedule_summary,afunc=self.aschedule_summary))
 
-        graph_builder.add_edge(START, "filter")
+        graph_builder.add_edge(START, "window")
+
+        graph_builder.add_edge("window","merge_summary")
         
-        graph_builder.add_conditional_edges("filter",self.summarize_condition,{"summarize":"prepare_summarize_messages","continue":"looper"})
+        graph_builder.add_conditional_edges("merge_summary",self.summarize_condition,{"summarize":"schedule_summary","continue":"looper"})
 
-        graph_builder.add_edge("prepare_summarize_messages","looper")
+        graph_builder.add_edge("schedule_summary","looper")
 
         graph_builder.add_edge("looper","tool_controller")
 
@@ -305,61 +459,357 @@ class LoopGraph:
 
         graph_builder.add_edge("structure",END)
 
-        graph = graph_builder.compile(checkpointer=MemorySaver())
+        # Checkpoints go to the session's SQLite file instead of RAM, old ones are pruned
+        graph = graph_builder.compile(checkpointer=checkpointer or get_checkpointer(self.session))
 
         self.graph = graph
 
+        if self.session.round == 0 and (counters := graph.get_state(self.config).values.get("counters")):
+            self.round_counter = counters["round"]
+            self.last_summarized = counters["last_summarized"]
+            self.last_indexed = counters["last_indexed"]
+            self.summary_calls = counters["summary_calls"]
+
+
+    @property
+    def splitter(self):
+        # tiktoken downloads/loads its encoding on creation, so the splitter is only built once it is needed
+        if self._splitter is None:
+            from langchain_text_splitters import RecursiveCharacterTextSplitter
+            if fake_enabled():
+                # Offline runs can't download the encoding, ~4 characters per token gives the same chunks
+                self._splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=400)
+            else:
+                self._splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(chunk_size=500, chunk_overlap=100)
+        return self._splitter
+
+    def render_png(self, path):
+        """Draws the graph with mermaid (needs network access) and writes it to path."""
+        png_data = self.graph.get_graph().draw_mermaid_png()
+
+        with open(path, "wb") as f:
+            f.write(png_data)
+
+    @property
+    def round_counter(self):
+        # Lives on the session, the tools derive their idempotency keys from it
+        return self.session.round
+
+    @round_counter.setter
+    def round_counter(self, value):
+        self.session.round = value
+
+    def counters(self):
+        """The bookkeeping to checkpoint. A running summary job dies with the process, so it doesn't count yet."""
+        return {
+            "round": self.round_counter,
+            "last_summarized": self.pending_start if self.pending_summary is not None else self.last_summarized,
+            "last_indexed": self.last_indexed,
+            "summary_calls": self.summary_calls,
+        }
+
+    def _user_input(self, content):
+        # The round number marks where a round starts, see window_messages
+        return {"messages": [HumanMessage(content, additional_kwargs={"round": self.round_counter})]}
+
+    def window_messages(self,state:State):
+        """
+        Drops the tool traffic like filter_out_rule_messages and moves every round before the last
+        live_rounds ones from the graph state to the session's RoundArchive. The state, and with it the
+        work of every node and of the checkpointer per turn, stays the same size however long the game is.
+        """
+
+        removed = filter_out_rule_messages(state)["messages"]
+        removed_ids = {message.id for message in removed}
+        messages = [message for message in state["messages"] if message.id not in removed_ids]
+
+        # Rounds start with the player's input; messages before the first one belong to round 0
+        starts = [i for i, message in enumerate(messages) if isinstance(message, HumanMessage)]
+        if len(starts) <= self.live_rounds:
+            annotate(rounds=1)
+            return {"messages": removed, "counters": self.counters()}
+
+        annotate(rounds=1)
+
+        cut = starts[-self.live_rounds]
+        archived = []
+        round_no = 0
+        for i, message in enumerate(messages[:cut]):
+            if isinstance(message, HumanMessage):
+                # Untagged inputs (older saves) are numbered back from the current round
+                round_no = message.additional_kwargs.get("round", self.round_counter - (len(starts) - starts.index(i)) + 1)
+            archived.append((round_no, message))
+
+        get_archive(self.session).append(archived)
+
+        return {"messages": removed + [RemoveMessage(id=message.id) for _, message in archived], "counters": self.counters()}
+
+    def history(self,state:State,start,stop):
+        """Messages start to stop - 1 of the whole game, archived or live (live message i is number archive.count + i)."""
+
+        archive = get_archive(self.session)
+        archived = archive.slice(start, min(stop, archive.count)) if start < archive.count else []
+        live = state["messages"][max(start - archive.count, 0):max(stop - archive.count, 0)]
+        return archived + live
+
+    def round_messages(self, round_no):
+        """All messages of one round, e.g. for the UI or for explaining an earlier decision."""
+
+        archived = get_archive(self.session).round(round_no)
+        if archived:
+            return archived
+
+        live = []
+        current = None
+        for message in self.graph.get_state(self.config).values.get("messages", []):
+            if isinstance(message, HumanMessage):
+                current = message.additional_kwargs.get("round")
+            if current == round_no:
+                live.append(message)
+        return live
+
+    def invoke(self, content):
+        """Plays one turn with the player's input and returns the final state."""
+        self.round_counter+=1
+        return self.graph.invoke(self._user_input(content), self.config)
+
+    def stream(self, content, stream_mode = "values"):
+        self.round_counter+=1
+        yield from self.graph.stream(self._user_input(content), self.config, stream_mode=stream_mode)
+
+    async def ainvoke(self, content):
+        self.round_counter+=1
+        return await self.graph.ainvoke(self._user_input(content), self.config)
+
+    async def astream(self, content, stream_mode = "values"):
+        self.round_counter+=1
+        async for event in self.graph.astream(self._user_input(content), self.config, stream_mode=stream_mode):
+            yield event
+
+    # The narration is the only part of a turn the player reads. Streaming it token by token shows the
+    # start of the answer after the GM model's time to first token; the tool controller and the
+    # bookkeeping after it keep running while the generator is drained.
+
+    def stream_narration(self, content):
+        """Plays one turn and yields the GM's narration as it is generated, text chunk by text chunk."""
+        for message, metadata in self.stream(content, stream_mode="messages"):
+            if text := narration_text(message, metadata):
+                yield text
+
+    async def astream_narration(self, content):
+        async for message, metadata in self.astream(content, stream_mode="messages"):
+            if text := narration_text(message, metadata):
+                yield text
+
+    def unsummarized_rounds(self,state:State):
+        """
+        The finished rounds after last_summarized as dicts with the round number, the messages worth
+        summarizing, their approximate tokens and size, the number of history messages the round spans.
+        Tool traffic is skipped: ToolMessages and the tool controller's calls (AI messages without text).
+        """
+
+        # last_summarized counts messages of the whole game, older ones are read back from the archive.
+        # The last message is the input of the running round.
+        end = get_archive(self.session).count + len(state["messages"]) - 1
+
+        rounds = []
+        for position, message in enumerate(self.history(state,self.last_summarized,end),self.last_summarized):
+            if isinstance(message,HumanMessage) or not rounds:
+                round_no = message.additional_kwargs.get("round") if isinstance(message,HumanMessage) else None
+                rounds.append({"round":round_no,"messages":[],"tokens":0,"size":0,"start":position})
+
+            rounds[-1]["size"]+=1
+            if format_message(message) and message.content:
+                rounds[-1]["messages"].append(message)
+
+        for k, summary_round in enumerate(rounds):
+            # Untagged rounds (older saves) are numbered back from the running one
+            if summary_round["round"] is None:
+                summary_round["round"] = self.round_counter - (len(rounds) - k)
+            summary_round["tokens"] = count_tokens_approximately(summary_round["messages"])
+
+        return rounds
+
+    def rounds_to_summarize(self,state:State):
+        """
+        Whole rounds for the next summarizer call, or [] while it isn't worth one: a call is due once
+        summary_tokens of new history piled up, or when max_seen_rounds rounds wait, before the oldest of
+        them leaves the GM's window of recent messages unsummarized.
+        """
+
+        rounds = self.unsummarized_rounds(state)
+
+        if sum(summary_round["tokens"] for summary_round in rounds) < self.summary_tokens and len(rounds) < self.max_seen_rounds:
+            return []
+
+        # After a long wait (e.g. a slow summarizer) only about summary_tokens go into one call, the rest waits
+        selected, tokens = [], 0
+        for summary_round in rounds:
+            if selected and tokens >= self.summary_tokens:
+                break
+            selected.append(summary_round)
+            tokens += summary_round["tokens"]
+
+        return selected
+
+    def index_messages(self,rounds):
+
+        store = get_vector_store(self.session)
+
+        docs = []
+        ids = []
+        for round_no, messages in rounds:
+
+            rag_text = "\n".join(format_message(message) for message in messages)
+
+            if rag_text:
+                for k, chunk in enumerate(self.splitter.split_text(rag_text)):
+                    # A round indexed before a restart, whose last_indexed wasn't checkpointed yet, is skipped
+                    if f"round-{round_no}-{k}" not in store.docs:
+                        docs.append(Document(page_content=chunk,metadata = {"round no":round_no}))
+                        ids.append(f"round-{round_no}-{k}")
+
+        if docs:
+            store.add_documents(docs,ids=ids)
+
+    def summary_prompt(self,context,rounds):
+
+        history = "\n\n".join(
+            f"Round {round_no}:\n" + "\n".join(format_message(message) for message in messages)
+            for round_no, messages in rounds
+        )
 
-    def prepare_summarize_messages(self,state:State):
-        print("summarization stage")
+        prompt = f"""You are maintaining a running summary of a fantasy role-playing game session.
 
-        messages = state["messages"]
-        context = "Not Provided Yet!"
-        
-        if "context" in state:
-            context = state["context"]
+        Update the existing summary by incorporating the events from the latest rounds.
 
-        messages_to_summarize = []
-        
-        i = self.last_summarized
-        
-        while i<self.last_summarized+2:
-            if not isinstance(messages[i],ToolMessage):
-                messages_to_summarize.append(messages[i])
-                i+=1
-            
-        self.last_summarized = i
+        Here is the previous summary:
+        {context}
 
-        rag_text = ""
-        for text in messages_to_summarize:
+        Here are the most recent rounds:
+        {history}
 
-            formatted = format_message(text)
-            
-            if formatted:
+        Please provide an updated summary that preserves all relevant details and remains consistent in tone and style. Don't include information about inventories and characters"""
 
-                rag_text+=formatted
+        return prompt
 
-        split_texts = self.splitter.split_text(rag_text)
-        
-        docs = [Document(page_content=chunk,metadata = {"round no":self.round_counter}) for chunk in split_texts]
+    def index_new_rounds(self,new_rounds,end):
+        self.index_messages(new_rounds)
+        self.last_indexed = max(self.last_indexed,end)
 
-        vector_store.add_documents(docs)
-        # vector_store.save_local("./data/index_langgraph")
-        prompt = f"""You are maintaining a running summary of a fantasy role-playing game session.
+    def summarize(self,context,rounds,new_rounds,end):
+        """
+        Background job: indexes new_rounds (the rounds not in the RAG store yet) and returns the summary
+        updated with rounds. end is the message index after the last round.
+        """
 
-        Update the existing summary by incorporating the events from the latest round.
+        self.index_new_rounds(new_rounds,end)
 
-        Here is the previous summary:
-        {context}
+        message = get_summarizer_llm().invoke(self.summary_prompt(context,rounds))
+        return message.content
 
-        Here is the most recent round:
-        {messages_to_summarize}
+    async def asummarize(self,context,rounds,new_rounds,end):
 
-        Please provide an updated summary that preserves all relevant details and remains consistent in tone and style. Don't include information about inventories and characters"""
+        # Embedding and indexing are CPU bound, keep them off the event loop
+        await asyncio.to_thread(self.index_new_rounds,new_rounds,end)
+
+        message = await get_summarizer_llm().ainvoke(self.summary_prompt(context,rounds))
+        return message.content
+
+    # The summary is produced off the critical path: schedule_summary starts it and returns right away,
+    # merge_summary folds the finished result into state["context"] on a later turn. If the running summary
+    # is max_summary_lag turns old, merge_summary waits for it, so the context the GM sees is never more
+    # than max_summary_lag turns behind the scheduled summaries.
+
+    def _start_summary(self,state:State):
+        """
+        Returns the arguments of the next summary job, or None while the previous one is still running
+        or not enough history is waiting (see rounds_to_summarize).
+        """
+
+        if self.pending_summary is not None:
+            # The next job picks up the rounds of this turn as well
+            return None
+
+        rounds = self.rounds_to_summarize(state)
+        if not rounds:
+            return None
+
+        context = state.get("context","Not Provided Yet!")
+
+        self.pending_start = self.last_summarized
+        self.pending_round = self.round_counter
+
+        self.last_summarized += sum(summary_round["size"] for summary_round in rounds)
+        self.summary_calls += 1
+
+        annotate(summary_calls=1,summarized_rounds=len(rounds),summarized_tokens=sum(summary_round["tokens"] for summary_round in rounds))
 
-        message = summarizer_llm.invoke(prompt)
-        return {"context":message.content,"summarized_messages":message.content}
+        # A retry after a failed summarizer call doesn't index the rounds a second time
+        new_rounds = [(summary_round["round"],summary_round["messages"]) for summary_round in rounds if summary_round["start"] >= self.last_indexed]
 
+        return context,[(summary_round["round"],summary_round["messages"]) for summary_round in rounds],new_rounds,self.last_summarized
+
+    def schedule_summary(self,state:State):
+        if job := self._start_summary(state):
+            self.pending_summary = get_summary_executor().submit(contextvars.copy_context().run,self.summarize,*job)
+            return {"counters":self.counters()}
+
+        return {}
+
+    async def aschedule_summary(self,state:State):
+        if job := self._start_summary(state):
+            self.pending_summary = asyncio.create_task(self.asummarize(*job))
+            return {"counters":self.counters()}
+
+        return {}
+
+    def _summary_is_due(self):
+        return self.pending_summary.done() or self.round_counter-self.pending_round >= self.max_summary_lag
+
+    def _finish_summary(self,collect):
+
+        try:
+            context = collect()
+        except (Exception,asyncio.CancelledError) as error:
+            # The messages go back into the queue and are summarized with the next job
+            annotate(errors=1,error=f"summarization failed: {error}")
+            self.last_summarized = self.pending_start
+            self.pending_summary = None
+            return {"counters":self.counters()}
+
+        self.pending_summary = None
+        return {"context":context,"summarized_messages":context,"counters":self.counters()}
+
+    def merge_summary(self,state:State):
+
+        if self.pending_summary is None or not self._summary_is_due():
+            return {}
+
+        if isinstance(self.pending_summary,asyncio.Future) and not self.pending_summary.done():
+            # Started by an async turn, its event loop can't be waited on from here. It stays pending
+            # and is merged by a later turn once it is done.
+            return {}
+
+        return self._finish_summary(self.pending_summary.result)
+
+    async def amerge_summary(self,state:State):
+
+        if self.pending_summary is None or not self._summary_is_due():
+            return {}
+
+        pending = self.pending_summary
+        if not isinstance(pending,asyncio.Future):
+            # Scheduled by a sync run, wait for the thread without blocking the loop
+            pending = asyncio.wrap_future(pending)
+        elif pending.get_loop() is not asyncio.get_running_loop() and not pending.done():
+            # A task of another event loop can't be awaited here, same as in a sync turn
+            return {}
+
+        # wait() doesn't raise the job's error, _finish_summary handles it
+        await asyncio.wait([pending])
+
+        return self._finish_summary(pending.result)
 
     def summarize_condition(self,state:State):
         if self.round_counter >= self.max_seen_rounds:
@@ -368,8 +818,21 @@ class LoopGraph:
         else:
             return "continue"
 
-    def looper(self,state: State):
-        print("chatbot stage")
+    def history_window(self,state:State):
+        """
+        The messages before the current input that the GM sees, at most the last 4*max_seen_rounds. The start
+        only moves in steps of half that size, so between two steps the history of consecutive prompts only
+        grows at its end and everything up to it stays the same.
+        """
+
+        size = 4*self.max_seen_rounds
+        step = max(size//2,1)
+
+        end = get_archive(self.session).count + len(state["messages"]) - 1
+        start = max(0, -(-(end - size)//step)*step)
+        return self.history(state,start,end)
+
+    def looper_messages(self,state: State):
 
         task = state["messages"][-1]
 
@@ -381,40 +844,75 @@ class LoopGraph:
         prompt = state["messages"][-1].content
 
         last_round = ""
-        print(context)
         if len(state["messages"])>2:
             last_round = state["messages"][-2].content
 
-        result = retrieve_rag_result(prompt,last_round)    
+        result = retrieve_rag_result(prompt,last_round,self.session,budget=self.rag_tokens)
         
         #print(context,result)
 
-        human_msg_2 = HumanMessage(f"The main story of my game is {game.story}. The rules are {game.rules}. A brief history of the previous events in my game is {context}. The most relevant rounds to this last round according to retrieval augmented generation is :{result} The current characters and their current inventories stats and other details are : {game.characters} I want you to continue the game from this. Evaluate if the user's action makes sense, if it does not, answer accordingly. (Such as trying to swim in the sun or entering a building from a closed window.) If a roll is necessary, do automatically. Here are the last rounds played:")
-        
-        last_rounds = state["messages"][-4*self.max_seen_rounds:]
-        
-        task_prompt = generate_task_prompt()
+        game = self.session.game
+
+        # Every section gets its own token budget, sections over budget are compacted deterministically
+        prompt_parts = PromptAssembler(self.prompt_budgets)
+
+        prompt_parts.add("system",system_message.content)
+        prompt_parts.add("task",generate_task_prompt(game,include_story=False))
+        prompt_parts.add("story",game.story)
+        prompt_parts.add("rules",game.rules)
+        prompt_parts.add("summary",context)
+        prompt_parts.add("rag",[doc.page_content for doc in result],kind="items")
+        characters,character_changes = self.session.character_state.update(game)
+        prompt_parts.add("characters",characters)
+        prompt_parts.add("character_changes",character_changes)
+        prompt_parts.add("dice",check_odds(self.session))
+        # The current input is the last message, it is sent separately below
+        prompt_parts.add("history",self.history_window(state),kind="messages")
+        prompt_parts.add("input",[task],kind="messages")
+
+        # Per-section counts on the looper's span, and the size before compaction of the sections that were cut
+        annotate(prompt_sections={name: section["sent"] for name, section in prompt_parts.report.items()},
+                 prompt_compacted={name: section["raw"] for name, section in prompt_parts.report.items() if section["sent"] < section["raw"]},
+                 prompt_section_tokens=prompt_parts.total_tokens)
+
+        # Turn-invariant content comes first and always in the same order, so consecutive prompts share a
+        # byte-identical prefix that provider-side prompt caching or a local KV cache can reuse. The history
+        # window only grows at its end between its steps (see history_window); the per-turn content goes last.
+        static_msg = HumanMessage(f"The main story of my game is {prompt_parts.get('story')}. The rules are {prompt_parts.get('rules')}. The characters, their stats and inventories at the start of this part of the game were (one JSON per character): {prompt_parts.get('characters')} {prompt_parts.get('task')} Evaluate if the user's action makes sense, if it does not, answer accordingly. (Such as trying to swim in the sun or entering a building from a closed window.) If a roll is necessary, use the check roll and odds given with my input instead of making them up. Here are the last rounds played:")
+
+        human_msg_2 = HumanMessage(f"A brief history of the previous events in my game is {prompt_parts.get('summary')}. The most relevant rounds to this last round according to retrieval augmented generation is :{prompt_parts.get('rag')} Changes to the characters since then: {prompt_parts.get('character_changes')} Dice of this round: {prompt_parts.get('dice')} I want you to continue the game from this. My input for this round is the next message.")
 
         chat_prompt = ChatPromptTemplate.from_messages([
-                system_message,
-                task_prompt,
+                SystemMessage(prompt_parts.get("system")),
+                static_msg,
+                *prompt_parts.get("history"),
                 human_msg_2,
-                *last_rounds,
-                task,
+                *prompt_parts.get("input"),
             ])
 
         formatted_messages = chat_prompt.format_messages()
 
+        shared = self.prefix_tracker.track(formatted_messages)
+        annotate(prefix_shared_ratio=shared["shared_ratio"],prefix_shared_tokens=shared["shared_tokens"])
 
-        message = llm.invoke(formatted_messages)
+        return formatted_messages
+
+    def looper(self,state: State):
+        message = get_llm().invoke(self.looper_messages(state))
 
         return {"messages": [message]}
-    
-png_data = LoopGraph().graph.get_graph().draw_mermaid_png()
 
-# PNG'yi dosyaya yaz:
-with open("graph_png/loop_graph_v8.png", "wb") as f:
-    f.write(png_data)
+    async def alooper(self,state: State):
+        # RAG retrieval embeds the prompt, keep it off the event loop
+        formatted_messages = await asyncio.to_thread(self.looper_messages,state)
+
+        message = await get_llm().ainvoke(formatted_messages)
+
+        return {"messages": [message]}
+    
+if __name__ == "__main__":
+    # PNG'yi dosyaya yaz:
+    LoopGraph().render_png("graph_png/loop_graph_v8.png")
 
 #pseudocode:
 
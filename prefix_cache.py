@@ -0,0 +1,61 @@
+import hashlib
+import os
+
+from prompt_assembler import chars_per_token
+
+
+def message_block(message):
+    """Canonical text of a message as the provider sees it: role and content."""
+    content = message.content if isinstance(message.content, str) else repr(message.content)
+    return f"<{message.type}>{content}"
+
+
+class PrefixTracker:
+    """
+    Measures how much of every prompt is a byte-identical repeat of the previous prompt's beginning,
+    which is the part provider-side prompt caching and local KV caches can reuse.
+
+    Every message boundary gets a chained hash, so the shared message prefix is found by comparing hashes;
+    only the first differing message is compared character by character.
+    """
+
+    def __init__(self):
+        self.previous_hashes = []
+        self.previous_blocks = []
+
+        self.last = {}
+
+    def track(self, messages):
+
+        blocks = [message_block(message) for message in messages]
+
+        hashes = []
+        digest = hashlib.sha256()
+        for block in blocks:
+            digest.update(block.encode("utf-8"))
+            hashes.append(digest.copy().hexdigest())
+
+        shared_messages = 0
+        for current, previous in zip(hashes, self.previous_hashes):
+            if current != previous:
+                break
+            shared_messages += 1
+
+        shared = sum(len(block) for block in blocks[:shared_messages])
+        if shared_messages < min(len(blocks), len(self.previous_blocks)):
+            shared += len(os.path.commonprefix([blocks[shared_messages], self.previous_blocks[shared_messages]]))
+
+        total = sum(len(block) for block in blocks)
+
+        self.previous_hashes = hashes
+        self.previous_blocks = blocks
+
+        self.last = {
+            "shared_messages": shared_messages,
+            "messages": len(blocks),
+            "shared_tokens": shared // chars_per_token,
+            "total_tokens": total // chars_per_token,
+            "shared_ratio": shared / total if total else 0.0,
+        }
+
+        return self.last
@@ -0,0 +1,122 @@
+from langchain_core.messages import BaseMessage, HumanMessage
+from langchain_core.messages.utils import count_tokens_approximately
+
+# Token budget of every section of the GM prompt, around 8k tokens in total
+default_budgets = {
+    "system": 250,
+    "task": 450,
+    "story": 800,
+    "rules": 1200,
+    "summary": 600,
+    "rag": 900,
+    "characters": 1500,
+    "character_changes": 400,
+    "dice": 250,
+    "history": 2500,
+    "input": 500,
+}
+
+# Characters per token used by count_tokens_approximately, used to turn a token budget into a cut position
+chars_per_token = 4
+
+cut_marker = " [...] "
+
+
+def count_tokens(content):
+    """Approximate token count of a string, a message or a list of messages."""
+    if isinstance(content, str):
+        return count_tokens_approximately([HumanMessage(content)])
+    if isinstance(content, BaseMessage):
+        return count_tokens_approximately([content])
+    return count_tokens_approximately(content)
+
+
+def compact_text(text, budget):
+    """Keeps the beginning and the end of text (2/3 and 1/3 of the budget) and cuts out the middle."""
+    if count_tokens(text) <= budget:
+        return text
+
+    chars = max(budget * chars_per_token - len(cut_marker) - 16, 0)
+    head = chars * 2 // 3
+    tail = chars - head
+
+    return text[:head] + cut_marker + (text[-tail:] if tail else "")
+
+
+def compact_items(items, budget, separator = "\n"):
+    """Keeps the first items (highest ranked first) that fit in the budget, cutting the last kept one if needed."""
+    kept = []
+    for item in items:
+        candidate = separator.join([*kept, item])
+        if count_tokens(candidate) <= budget:
+            kept.append(item)
+            continue
+
+        used = count_tokens(separator.join(kept)) if kept else 0
+        if budget - used > 32:
+            kept.append(compact_text(item, budget - used))
+        break
+
+    return separator.join(kept)
+
+
+def compact_messages(messages, budget):
+    """Drops the oldest messages until the rest fits in the budget. The newest message is always kept."""
+    kept = list(messages)
+    while len(kept) > 1 and count_tokens(kept) > budget:
+        kept.pop(0)
+
+    if kept and count_tokens(kept) > budget:
+        newest = kept[-1]
+        kept[-1] = newest.model_copy(update={"content": compact_text(newest.content, budget)})
+
+    return kept
+
+
+class PromptAssembler:
+    """
+    Collects the sections of a prompt, fits every section into its own token budget and reports the
+    token counts before and after compaction. Compaction is deterministic, the same input always gives
+    the same prompt.
+
+    Section kinds:
+        text      - a string, the middle is cut out when it is too long
+        items     - a list of strings in rank order, the lowest ranked ones are dropped first
+        messages  - a list of messages in chronological order, the oldest ones are dropped first
+    """
+
+    def __init__(self, budgets = None):
+        self.budgets = {**default_budgets, **(budgets or {})}
+        self.sections = {}
+        self.report = {}
+
+    def add(self, name, content, kind = "text"):
+
+        budget = self.budgets.get(name)
+        raw_tokens = count_tokens(content) if content else 0
+
+        if budget is not None and raw_tokens > budget:
+            if kind == "messages":
+                content = compact_messages(content, budget)
+            elif kind == "items":
+                content = compact_items(content, budget)
+            else:
+                content = compact_text(content, budget)
+        elif kind == "items":
+            content = "\n".join(content)
+
+        self.sections[name] = content
+        self.report[name] = {
+            "raw": raw_tokens,
+            "sent": count_tokens(content) if content else 0,
+            "budget": budget,
+        }
+
+        return content
+
+    def get(self, name):
+        return self.sections[name]
+
+    @property
+    def total_tokens(self):
+        return sum(section["sent"] for section in self.report.values())
@@ -0,0 +1,386 @@
+import base64
+import json
+import math
+import os
+import pickle
+import threading
+import uuid
+
+import faiss
+import numpy as np
+
+from langchain_core.documents import Document
+
+from lexical_index import LexicalIndex, terms
+from save_journal import read_journal
+
+
+# faiss.index_factory descriptions of the snapshot index types, nlist and m are chosen per build.
+# sq8 stores every dimension in one byte (1/4 of flat), pq 8 dimensions per byte (1/32), the IVF types
+# only scan nprobe of their nlist clusters per query.
+index_types = {
+    "flat": "Flat",
+    "sq8": "SQ8",
+    "ivf": "IVF{nlist},Flat",
+    "ivf_sq8": "IVF{nlist},SQ8",
+    "pq": "IVF{nlist},PQ{m}",
+}
+
+# IVF centroids and PQ codebooks (256 codes per sub-vector) need this many vectors to train
+min_train_vectors = 256
+
+# Larger training sets barely change the centroids but make training slow
+max_train_vectors = 20000
+
+
+def index_type_of(index):
+    """The index_types name of a FAISS index."""
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "pq"
+    if isinstance(index, faiss.IndexIVFScalarQuantizer):
+        return "ivf_sq8"
+    if isinstance(index, faiss.IndexIVFFlat):
+        return "ivf"
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        return "sq8"
+    return "flat"
+
+
+def build_index(vectors, index_type):
+    """A new index of index_type holding vectors, trained on (a sample of) them if the type needs it."""
+
+    count, dimension = vectors.shape
+    nlist = max(1, int(math.sqrt(count)))
+    m = max(divisor for divisor in range(1, dimension // 8 + 1) if dimension % divisor == 0)
+
+    index = faiss.index_factory(dimension, index_types[index_type].format(nlist=nlist, m=m))
+
+    if isinstance(index, faiss.IndexIVFPQ):
+        # Polysemous codes only help Hamming-filtered search, which is unused, and cost most of the training
+        index.do_polysemous_training = False
+
+    if not index.is_trained:
+        sample = vectors
+        if count > max_train_vectors:
+            sample = vectors[np.random.default_rng(0).choice(count, max_train_vectors, replace=False)]
+        index.train(sample)
+
+    index.add(vectors)
+    return index
+
+
+def normalize(scores):
+    # Min-max scaling to [0, 1], a single candidate (or all equal) counts as a full match
+    if not scores:
+        return {}
+    low, high = min(scores.values()), max(scores.values())
+    if high == low:
+        return {doc_id: 1.0 for doc_id in scores}
+    return {doc_id: (score - low) / (high - low) for doc_id, score in scores.items()}
+
+
+class PersistentRAGStore:
+    """
+    Disk backed vector store for the game's RAG memory.
+
+    The folder keeps the same layout as FAISS.save_local (index.faiss + index.pkl) so it can still be
+    opened with FAISS.load_local. On top of that snapshot every add_documents call is appended to
+    journal.jsonl (embeddings included) and fsynced, so nothing has to be re-embedded on restart.
+
+    The snapshot index is memory-mapped and therefore read-only, new vectors go to a small in-memory
+    delta index. Both are searched and merged, and compact() folds the delta into a new snapshot.
+
+    Next to the vectors every document is kept in a BM25 LexicalIndex, rebuilt from the documents on
+    load, and hybrid_search fuses both rankings.
+
+    index_type picks the snapshot index (see index_types). "auto" keeps an exact flat index until the
+    store holds promote_at vectors and then switches to promote_to, a compressed IVF index whose memory
+    and query time grow much slower with a long campaign. The switch happens on a compaction.
+    """
+
+    index_file = "index.faiss"
+    docstore_file = "index.pkl"
+    journal_file = "journal.jsonl"
+
+    def __init__(self, folder_path, embeddings, compact_every=256, index_type="auto", promote_at=4096, promote_to="ivf_sq8", nprobe=16):
+
+        if index_type != "auto" and index_type not in index_types:
+            raise ValueError(f"Unknown index type: {index_type}")
+
+        self.folder_path = folder_path
+        self.embeddings = embeddings
+        self.compact_every = compact_every
+
+        self.index_type = index_type
+        self.promote_at = promote_at
+        self.promote_to = promote_to
+        self.nprobe = nprobe
+
+        self.base_index = None
+        self.delta_index = None
+
+        self.docs = {}
+        self.base_ids = []
+        self.delta_ids = []
+        self.delta_vectors = []
+
+        self.journal_entries = 0
+
+        self.lexical_index = LexicalIndex()
+
+        # Summaries index documents from a background thread while the GM turn searches
+        self.lock = threading.RLock()
+
+        os.makedirs(folder_path, exist_ok=True)
+        self._load()
+
+    def _path(self, name):
+        return os.path.join(self.folder_path, name)
+
+    @property
+    def dimension(self):
+        for index in (self.base_index, self.delta_index):
+            if index is not None:
+                return index.d
+        return None
+
+    def __len__(self):
+        return len(self.base_ids) + len(self.delta_ids)
+
+    def _load(self):
+
+        if os.path.exists(self._path(self.index_file)) and os.path.exists(self._path(self.docstore_file)):
+
+            self.base_index = self._read_snapshot()
+
+            with open(self._path(self.docstore_file), "rb") as file:
+                docstore, index_to_docstore_id = pickle.load(file)
+
+            # index.pkl is replaced before index.faiss, so after a crash in between it can only be ahead
+            # of the index. The extra ids are still in the journal and get replayed below.
+            self.base_ids = [index_to_docstore_id[i] for i in range(self.base_index.ntotal)]
+            self.docs = {doc_id: docstore.search(doc_id) for doc_id in self.base_ids}
+
+            for doc_id in self.base_ids:
+                self.lexical_index.add(doc_id, self.docs[doc_id].page_content)
+
+        self._replay_journal()
+
+    def _replay_journal(self):
+
+        for record in read_journal(self._path(self.journal_file)):
+            self.journal_entries += 1
+
+            if record["id"] in self.docs:
+                continue
+
+            vector = np.frombuffer(base64.b64decode(record["vector"]), dtype="float32")
+            doc = Document(page_content=record["text"], metadata=record["metadata"])
+            self._add_to_delta([record["id"]], [doc], vector.reshape(1, -1))
+
+    def _read_snapshot(self):
+
+        try:
+            index = faiss.read_index(self._path(self.index_file), faiss.IO_FLAG_MMAP_IFC)
+        except RuntimeError:
+            # Index types without mmap support are read into memory instead
+            index = faiss.read_index(self._path(self.index_file))
+
+        if (ivf := faiss.try_extract_index_ivf(index)) is not None:
+            ivf.nprobe = self.nprobe
+
+        return index
+
+    def target_index_type(self, count):
+        """The snapshot index type for a store of count vectors."""
+
+        if self.index_type == "auto":
+            index_type = self.promote_to if count >= self.promote_at else "flat"
+        else:
+            index_type = self.index_type
+
+        if index_type in ("ivf", "ivf_sq8", "pq") and count < min_train_vectors:
+            return "flat"
+        return index_type
+
+    def _add_to_delta(self, ids, docs, vectors):
+
+        if self.delta_index is None:
+            self.delta_index = faiss.IndexFlatL2(vectors.shape[1])
+
+        self.delta_index.add(vectors)
+        self.delta_vectors.append(vectors)
+
+        for doc_id, doc in zip(ids, docs):
+            self.docs[doc_id] = doc
+            self.delta_ids.append(doc_id)
+            self.lexical_index.add(doc_id, doc.page_content)
+
+    def add_documents(self, documents, ids=None):
+
+        if not documents:
+            return []
+
+        ids = ids or [str(uuid.uuid4()) for _ in documents]
+        texts = [doc.page_content for doc in documents]
+
+        vectors = np.asarray(self.embeddings.embed_documents(texts), dtype="float32")
+
+        with self.lock:
+            self._append(ids, documents, vectors)
+
+        return ids
+
+    def _append(self, ids, documents, vectors):
+
+        with open(self._path(self.journal_file), "a", encoding="utf-8") as file:
+            for doc_id, doc, vector in zip(ids, documents, vectors):
+                record = {
+                    "id": doc_id,
+                    "text": doc.page_content,
+                    "metadata": doc.metadata,
+                    "vector": base64.b64encode(vector.tobytes()).decode("ascii"),
+                }
+                file.write(json.dumps(record) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+        self._add_to_delta(ids, documents, vectors)
+        self.journal_entries += len(documents)
+
+        if self.journal_entries >= self.compact_every:
+            self.compact()
+
+    def _vector_candidates(self, embedding, k):
+        # (distance, doc id) of the k nearest vectors over the snapshot and the delta, nearest first
+
+        query = np.asarray(embedding, dtype="float32").reshape(1, -1)
+
+        candidates = []
+        for index, ids in ((self.base_index, self.base_ids), (self.delta_index, self.delta_ids)):
+            if index is None or index.ntotal == 0:
+                continue
+            distances, positions = index.search(query, min(k, index.ntotal))
+            for distance, position in zip(distances[0], positions[0]):
+                if position != -1:
+                    candidates.append((float(distance), ids[position]))
+
+        candidates.sort(key=lambda candidate: candidate[0])
+        return candidates[:k]
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4):
+        with self.lock:
+            return [(self.docs[doc_id], distance) for distance, doc_id in self._vector_candidates(embedding, k)]
+
+    def similarity_search_by_vector(self, embedding, k=4):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k)]
+
+    def similarity_search(self, query, k=4):
+        return self.similarity_search_by_vector(self.embeddings.embed_query(query), k)
+
+    def hybrid_search(self, embedding, query, k=20, vector_weight=0.5, current_round=None, half_life=30):
+        """
+        Fuses the k nearest vectors and the k best BM25 matches of query (a text or term weights) into
+        one ranking of (doc, score), best first.
+
+        Both scores are min-max normalized over their candidates and mixed with vector_weight, a document
+        found by only one side gets 0 from the other. With current_round set, chunks lose relevance with
+        the age of their "round no": after half_life rounds they keep 3/4 of their score, never less than half.
+        """
+
+        if isinstance(query, str):
+            query = terms(query)
+
+        with self.lock:
+            # Smaller distances are better, negated so that both sides are "higher is better"
+            vector_scores = {doc_id: -distance for distance, doc_id in self._vector_candidates(embedding, k)}
+            lexical_scores = dict(self.lexical_index.search(query, k))
+
+            fused = {}
+            for weight, scores in ((vector_weight, vector_scores), (1 - vector_weight, lexical_scores)):
+                for doc_id, score in normalize(scores).items():
+                    fused[doc_id] = fused.get(doc_id, 0.0) + weight * score
+
+            results = []
+            for doc_id, score in fused.items():
+                doc = self.docs[doc_id]
+                round_no = doc.metadata.get("round no")
+                if current_round is not None and isinstance(round_no, (int, float)):
+                    score *= 0.5 + 0.5 * 0.5 ** (max(current_round - round_no, 0) / half_life)
+                results.append((doc, score))
+
+        results.sort(key=lambda result: result[1], reverse=True)
+        return results
+
+    def _all_vectors(self):
+
+        parts = []
+        if self.base_index is not None and self.base_index.ntotal:
+            base = self.base_index
+            if (ivf := faiss.try_extract_index_ivf(base)) is not None:
+                # IVF indexes reconstruct by id only with a direct map, built on an in-memory copy
+                base = faiss.read_index(self._path(self.index_file))
+                faiss.try_extract_index_ivf(base).make_direct_map()
+            # Exact for flat indexes, the decoded approximation for quantized ones
+            parts.append(base.reconstruct_n(0, base.ntotal))
+        parts.extend(self.delta_vectors)
+
+        return np.vstack(parts)
+
+    def compact(self):
+        """
+        Folds the journal into a new snapshot. Files are written next to the live ones, fsynced and then
+        swapped in with os.replace, so a crash leaves either the old or the new snapshot plus the journal.
+        """
+
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+
+        if not self.delta_ids:
+            return
+
+        from langchain_community.docstore.in_memory import InMemoryDocstore
+
+        ids = self.base_ids + self.delta_ids
+        index_type = self.target_index_type(len(ids))
+
+        # IVF indexes are retrained once the store outgrew their cluster count, see build_index
+        ivf = faiss.try_extract_index_ivf(self.base_index) if self.base_index is not None else None
+        outgrown = ivf is not None and math.sqrt(len(ids)) >= 2 * ivf.nlist
+
+        if self.base_index is None or index_type_of(self.base_index) != index_type or outgrown:
+            index = build_index(self._all_vectors(), index_type)
+        else:
+            # Same type: the delta is added to a copy of the snapshot, nothing is re-encoded or retrained
+            index = faiss.read_index(self._path(self.index_file))
+            index.add(np.vstack(self.delta_vectors))
+
+        docstore = InMemoryDocstore({doc_id: self.docs[doc_id] for doc_id in ids})
+        index_to_docstore_id = dict(enumerate(ids))
+
+        index_tmp = self._path(self.index_file + ".tmp")
+        docstore_tmp = self._path(self.docstore_file + ".tmp")
+
+        faiss.write_index(index, index_tmp)
+        with open(docstore_tmp, "wb") as file:
+            pickle.dump((docstore, index_to_docstore_id), file)
+
+        for path in (index_tmp, docstore_tmp):
+            with open(path, "rb") as file:
+                os.fsync(file.fileno())
+
+        os.replace(docstore_tmp, self._path(self.docstore_file))
+        os.replace(index_tmp, self._path(self.index_file))
+
+        with open(self._path(self.journal_file), "w", encoding="utf-8") as file:
+            file.flush()
+            os.fsync(file.fileno())
+
+        self.base_index = self._read_snapshot()
+        self.base_ids = ids
+        self.delta_index = None
+        self.delta_ids = []
+        self.delta_vectors = []
+        self.journal_entries = 0
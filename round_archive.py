@@ -0,0 +1,73 @@
+import json
+import os
+import sqlite3
+import threading
+
+from langchain_core.messages import message_to_dict, messages_from_dict
+
+
+class RoundArchive:
+    """
+    On-disk store of the messages that left the live window of the loop graph, indexed by round.
+
+    Messages keep their position in the campaign: seq counts every message ever archived, so message n
+    of the whole history is archive seq n while n < count, and live message n - count afterwards (see
+    LoopGraph.history). The archive table lives in the session's checkpoint database.
+    """
+
+    def __init__(self, path):
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS archived_messages "
+            "(seq INTEGER PRIMARY KEY, id TEXT UNIQUE, round INTEGER, message TEXT)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS archived_messages_round ON archived_messages (round)")
+        self.connection.commit()
+
+        self.lock = threading.Lock()
+        self.count = self.connection.execute("SELECT COUNT(*) FROM archived_messages").fetchone()[0]
+
+    def append(self, messages):
+        """Archives (round, message) pairs in order. A message that is already archived (same id) is skipped."""
+
+        with self.lock:
+            for round_no, message in messages:
+                cursor = self.connection.execute(
+                    "INSERT OR IGNORE INTO archived_messages (seq, id, round, message) VALUES (?, ?, ?, ?)",
+                    (self.count, message.id, round_no, json.dumps(message_to_dict(message), ensure_ascii=False)),
+                )
+                self.count += cursor.rowcount
+            self.connection.commit()
+
+    def _load(self, rows):
+        return messages_from_dict([json.loads(row[0]) for row in rows])
+
+    def slice(self, start, stop):
+        """Archived messages start to stop - 1 of the campaign."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT message FROM archived_messages WHERE seq >= ? AND seq < ? ORDER BY seq", (start, stop)
+            ).fetchall()
+        return self._load(rows)
+
+    def round(self, round_no):
+        """The archived messages of one round, in order."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT message FROM archived_messages WHERE round = ? ORDER BY seq", (round_no,)
+            ).fetchall()
+        return self._load(rows)
+
+    @property
+    def last_round(self):
+        with self.lock:
+            return self.connection.execute("SELECT MAX(round) FROM archived_messages").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
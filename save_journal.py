@@ -0,0 +1,178 @@
+import json
+import os
+import threading
+
+from character_model import characters_from_dicts, characters_to_dicts
+from static_objects import new_game
+
+
+def read_journal(path):
+    """
+    The records of a JSON lines journal in order, nothing if there is none. A torn last line from a crash
+    mid-append ends the records and is cut off once they are read, otherwise the next records would be
+    appended behind it.
+    """
+    if not os.path.exists(path):
+        return
+
+    intact = 0
+    with open(path, "rb") as file:
+        for line in file:
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError("incomplete record")
+                record = json.loads(line)
+            except ValueError:
+                break
+            intact += len(line)
+            yield record
+
+    if intact != os.path.getsize(path):
+        os.truncate(path, intact)
+
+
+class GameJournal:
+    """
+    Incremental save of one session's game.
+
+    Instead of pickling the whole GameContext, every state changing tool call is appended to journal.jsonl
+    as one small record (tool name + arguments), so saving a turn costs as much as the turn changed. Every
+    snapshot_every records the world is folded into snapshot.json and the journal starts over. Loading
+    reads the snapshot and replays the records after it through the same tool functions.
+
+    Records are flushed as they are written and fsynced at the end of every turn (end_turn), so a crash
+    loses at most the turn that was running.
+    """
+
+    snapshot_file = "snapshot.json"
+    journal_file = "journal.jsonl"
+
+    def __init__(self, folder_path, snapshot_every = 200):
+
+        self.folder_path = folder_path
+        self.snapshot_every = snapshot_every
+
+        self.seq = 0  # number of the last record written
+        self.snapshot_seq = 0  # number of the last record folded into the snapshot
+
+        self.file = None
+
+        # Tools of parallel tool calls run on ToolNode's worker threads
+        self.lock = threading.Lock()
+
+        os.makedirs(folder_path, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.folder_path, name)
+
+    def _open(self):
+        if self.file is None:
+            self.file = open(self._path(self.journal_file), "a", encoding="utf-8")
+        return self.file
+
+    def record(self, op, args):
+        """Appends one tool call. Called by game_functions.journaled after the tool succeeded."""
+
+        with self.lock:
+            self.seq += 1
+            file = self._open()
+            file.write(json.dumps({"seq": self.seq, "op": op, "args": args}, ensure_ascii=False) + "\n")
+            file.flush()
+
+    def end_turn(self, game):
+        """Makes the records of the finished turn durable and takes a snapshot when the journal got long."""
+
+        with self.lock:
+            if self.file is not None:
+                os.fsync(self.file.fileno())
+
+            if self.seq - self.snapshot_seq >= self.snapshot_every:
+                self._snapshot(game)
+
+    def snapshot(self, game):
+        with self.lock:
+            self._snapshot(game)
+
+    def _snapshot(self, game):
+        """
+        Writes the whole world next to the live snapshot, fsyncs it and swaps it in with os.replace. The
+        journal is truncated only afterwards; records the snapshot already contains are recognized by their
+        seq and skipped on load, so a crash in between is harmless.
+        """
+
+        state = {
+            "seq": self.seq,
+            "story": game.story,
+            "rules": game.rules,
+            "main_character": getattr(game, "main_character", None),
+            "characters": characters_to_dicts(game.characters),
+        }
+
+        snapshot_tmp = self._path(self.snapshot_file + ".tmp")
+        with open(snapshot_tmp, "w", encoding="utf-8") as file:
+            json.dump(state, file, ensure_ascii=False)
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(snapshot_tmp, self._path(self.snapshot_file))
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        with open(self._path(self.journal_file), "w", encoding="utf-8") as file:
+            file.flush()
+            os.fsync(file.fileno())
+
+        self.snapshot_seq = self.seq
+
+    def load(self, session):
+        """Rebuilds session.game from the snapshot and the journal. Returns the number of replayed records."""
+
+        from game_functions import replayable_tools
+        from sessions import use_session
+
+        game = session.game
+        new_game(game)
+
+        self.seq = self.snapshot_seq = 0
+
+        if os.path.exists(self._path(self.snapshot_file)):
+            with open(self._path(self.snapshot_file), "r", encoding="utf-8") as file:
+                state = json.load(file)
+
+            game.story = state["story"]
+            game.rules = state["rules"]
+            game.characters = characters_from_dicts(state["characters"])
+            if state.get("main_character") is not None:
+                game.main_character = state["main_character"]
+
+            self.seq = self.snapshot_seq = state["seq"]
+
+        replayed = 0
+        with use_session(session):
+            for record in read_journal(self._path(self.journal_file)):
+                if record["seq"] <= self.seq:
+                    continue
+
+                # The undecorated functions, so replaying does not journal the calls again
+                replayable_tools[record["op"]](**record["args"])
+                self.seq = record["seq"]
+                replayed += 1
+
+        return replayed
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def open_game(folder_path, session, snapshot_every = 200):
+    """Loads the save in folder_path (an empty game if there is none yet) into session and keeps journaling to it."""
+
+    journal = GameJournal(folder_path, snapshot_every)
+    journal.load(session)
+    session.journal = journal
+    return journal
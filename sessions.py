@@ -0,0 +1,155 @@
+import contextvars
+import threading
+import uuid
+from contextlib import contextmanager
+
+from langchain_core.runnables.config import ensure_config
+
+import static_objects
+from character_state import CharacterStateEncoder
+from dice import DiceRoller
+from idempotency import DedupStore
+from instrumentation import get_span_recorder
+from static_objects import GameContext
+
+
+class GameSession:
+    """
+    Everything that belongs to one campaign: its game state, RAG memory, tool bookkeeping and the
+    LangGraph thread ids used by its creation and loop graphs.
+    """
+
+    def __init__(self, session_id, game = None, rag_folder = None, dice_seed = None, checkpoint_path = None):
+
+        self.session_id = session_id
+        self.game = game if game is not None else GameContext()
+
+        self.rag_folder = rag_folder or f"./data/sessions/{session_id}/index"
+        self.rag_store = None  # created on first use, see loop_graph.get_vector_store
+
+        # Durable checkpoints of the loop graph, see sqlite_checkpointer.py and loop_graph.get_checkpointer
+        self.checkpoint_path = checkpoint_path or f"./data/sessions/{session_id}/checkpoints.sqlite"
+        self.checkpointer = None
+        self.archive = None  # rounds that left the live window, same database, see round_archive.py
+
+        # Incremental save of the game, see save_journal.open_game. None means the session is not saved.
+        self.journal = None
+
+        # Snapshot + changes encoding of the characters shared by the GM and tool controller prompts
+        self.character_state = CharacterStateEncoder()
+
+        # Round number of the loop and the effects already applied in the recent rounds, see idempotency.py
+        self.round = 0
+        self.applied_effects = DedupStore()
+
+        # Duel simulation report of the created characters, see FullGraph.check_balance
+        self.balance_report = None
+
+        # Seeded per session so a campaign rolls the same dice again, see dice.py
+        self.dice = DiceRoller(dice_seed) if dice_seed is not None else DiceRoller.for_session(session_id)
+        self.check_roll = None  # (round, text) of the GM prompt's check roll, see game_functions.check_odds
+
+        self.to_remove = []
+
+        self.loop_thread_id = f"{session_id}-loop"
+        self.full_thread_id = f"{session_id}-full"
+
+    def close(self):
+        """Closes the save journal and the checkpoint database, the session can't play on afterwards."""
+        for resource in (self.journal, self.archive, self.checkpointer):
+            if resource is not None:
+                resource.close()
+
+        self.journal = self.archive = self.checkpointer = None
+
+    # Every node run of both graphs is recorded as a span, see instrumentation.py
+
+    @property
+    def loop_config(self):
+        return {"configurable": {"thread_id": self.loop_thread_id, "session_id": self.session_id},
+                "callbacks": [get_span_recorder()], "metadata": {"graph": "loop"}}
+
+    @property
+    def full_config(self):
+        return {"configurable": {"thread_id": self.full_thread_id, "session_id": self.session_id}, "recursion_limit":25,
+                "callbacks": [get_span_recorder()], "metadata": {"graph": "creation"}}
+
+
+class SessionRegistry:
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def create(self, session_id = None, **kwargs):
+
+        session_id = session_id or uuid.uuid4().hex
+
+        with self.lock:
+            if session_id in self.sessions:
+                raise KeyError(f"Session already exists: {session_id}")
+
+            session = GameSession(session_id, **kwargs)
+            self.sessions[session_id] = session
+
+        return session
+
+    def get(self, session_id):
+        with self.lock:
+            if session_id not in self.sessions:
+                raise KeyError(f"Session couldn't be found: {session_id}")
+            return self.sessions[session_id]
+
+    def get_or_create(self, session_id, **kwargs):
+        with self.lock:
+            if session_id in self.sessions:
+                return self.sessions[session_id]
+
+            session = GameSession(session_id, **kwargs)
+            self.sessions[session_id] = session
+            return session
+
+    def remove(self, session_id):
+        with self.lock:
+            return self.sessions.pop(session_id, None)
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self.sessions
+
+
+registry = SessionRegistry()
+
+# The single-player setup keeps working on the module level game and the original index folder
+default_session = registry.create("default", game=static_objects.game, rag_folder="./data/index_langgraph")
+
+_active_session = contextvars.ContextVar("active_session", default=None)
+
+
+@contextmanager
+def use_session(session):
+    """Makes session the active one for the code (and LangChain runnables) executed inside the block."""
+    token = _active_session.set(session)
+    try:
+        yield session
+    finally:
+        _active_session.reset(token)
+
+
+def current_session():
+    """
+    Resolves the session of the running call. An explicit use_session block wins, otherwise the
+    session_id in the RunnableConfig of the graph run is used (LangChain propagates it to every node and
+    tool, also across its worker threads). Falls back to the default session.
+    """
+    session = _active_session.get()
+    if session is not None:
+        return session
+
+    session_id = ensure_config().get("configurable", {}).get("session_id")
+    if session_id is not None:
+        return registry.get(session_id)
+
+    return default_session
@@ -0,0 +1,362 @@
+"""
+Durable LangGraph checkpointer for the game loop, in one SQLite file (WAL mode).
+
+MemorySaver keeps every checkpoint of every turn in RAM, and each of them the whole, ever growing message
+list. Here a channel value is stored once per channel version (as LangGraph's own savers do), and a list
+value, e.g. messages, only as a manifest of content hashes: every message body is written once to the
+items table no matter how many checkpoints contain it.
+
+Old checkpoints are pruned by a retention policy: the newest keep_last checkpoints of a thread are kept,
+plus the last checkpoint of every keep_every_rounds-th round (a round starts with every new input), so a
+long campaign keeps a sparse history to go back to. Channel versions and message bodies no remaining
+checkpoint refers to are deleted with them.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import threading
+
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+
+schema = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    thread_id TEXT, checkpoint_ns TEXT, checkpoint_id TEXT, parent_id TEXT, round INTEGER,
+    type TEXT, checkpoint BLOB, metadata BLOB, versions TEXT,
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+);
+CREATE TABLE IF NOT EXISTS channels (
+    thread_id TEXT, checkpoint_ns TEXT, channel TEXT, version TEXT, kind TEXT, type TEXT, value BLOB,
+    PRIMARY KEY (thread_id, checkpoint_ns, channel, version)
+);
+CREATE TABLE IF NOT EXISTS items (
+    hash BLOB PRIMARY KEY, type TEXT, value BLOB
+);
+CREATE TABLE IF NOT EXISTS writes (
+    thread_id TEXT, checkpoint_ns TEXT, checkpoint_id TEXT, task_id TEXT, idx INTEGER, channel TEXT,
+    type TEXT, value BLOB, task_path TEXT,
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+);
+"""
+
+hash_size = 16
+
+
+class SqliteCheckpointer(BaseCheckpointSaver):
+
+    def __init__(self, path, keep_last = 20, keep_every_rounds = 10, prune_every = 50, serde = None):
+        super().__init__(serde=serde)
+
+        self.path = path
+        self.keep_last = keep_last
+        self.keep_every_rounds = keep_every_rounds
+        self.prune_every = prune_every
+
+        self.puts = 0
+        self.rounds = {}  # (thread id, namespace) -> round of its newest checkpoint
+
+        # (thread id, namespace, channel) -> {id(item): (item, digest)} of the last list written. A new
+        # version of a list mostly holds the same message objects, those are not serialized again.
+        self.digests = {}
+
+        # The graph writes from its worker threads, one connection serialized by a lock
+        self.lock = threading.RLock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # WAL keeps the database consistent on a crash, NORMAL only risks the last transactions
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(schema)
+        self.connection.commit()
+
+    # Values
+
+    def _dump_value(self, value, cache_key):
+        """(kind, type, blob) of a channel value; lists become a manifest of item hashes."""
+
+        if isinstance(value, list):
+            known = self.digests.get(cache_key, {})
+            current = {}
+            digests = []
+            rows = []
+            for item in value:
+                # The item is kept next to its digest, so its id can't be reused by another object
+                if id(item) in known and known[id(item)][0] is item:
+                    digest = known[id(item)][1]
+                else:
+                    kind, data = self.serde.dumps_typed(item)
+                    digest = hashlib.blake2b(kind.encode("utf-8") + b"\0" + data, digest_size=hash_size).digest()
+                    rows.append((digest, kind, data))
+                current[id(item)] = (item, digest)
+                digests.append(digest)
+            self.digests[cache_key] = current
+            self.connection.executemany("INSERT OR IGNORE INTO items (hash, type, value) VALUES (?, ?, ?)", rows)
+            return "list", None, b"".join(digests)
+
+        kind, data = self.serde.dumps_typed(value)
+        return "value", kind, data
+
+    def _load_value(self, kind, type_, blob):
+
+        if kind == "list":
+            digests = [blob[i:i + hash_size] for i in range(0, len(blob), hash_size)]
+            items = {}
+            unique = list(set(digests))
+            for start in range(0, len(unique), 500):
+                chunk = unique[start:start + 500]
+                rows = self.connection.execute(
+                    f"SELECT hash, type, value FROM items WHERE hash IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                items.update({digest: (item_type, value) for digest, item_type, value in rows})
+            return [self.serde.loads_typed(items[digest]) for digest in digests]
+
+        return self.serde.loads_typed((type_, blob))
+
+    def _load_channels(self, thread_id, checkpoint_ns, versions):
+        values = {}
+        for channel, version in versions.items():
+            row = self.connection.execute(
+                "SELECT kind, type, value FROM channels WHERE thread_id=? AND checkpoint_ns=? AND channel=? AND version=?",
+                (thread_id, checkpoint_ns, channel, str(version)),
+            ).fetchone()
+            if row is not None and row[0] != "empty":
+                values[channel] = self._load_value(*row)
+        return values
+
+    # BaseCheckpointSaver
+
+    def _tuple(self, thread_id, checkpoint_ns, row):
+        checkpoint_id, parent_id, type_, checkpoint, metadata = row
+
+        checkpoint = self.serde.loads_typed((type_, checkpoint))
+        writes = self.connection.execute(
+            "SELECT task_id, channel, type, value FROM writes WHERE thread_id=? AND checkpoint_ns=? AND checkpoint_id=? ORDER BY task_id, idx",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        ).fetchall()
+
+        def config_of(id_):
+            return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": id_}}
+
+        return CheckpointTuple(
+            config=config_of(checkpoint_id),
+            checkpoint={**checkpoint, "channel_values": self._load_channels(thread_id, checkpoint_ns, checkpoint["channel_versions"])},
+            metadata=json.loads(metadata),
+            pending_writes=[(task_id, channel, self.serde.loads_typed((kind, value))) for task_id, channel, kind, value in writes],
+            parent_config=config_of(parent_id) if parent_id else None,
+        )
+
+    def get_tuple(self, config):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        columns = "checkpoint_id, parent_id, type, checkpoint, metadata"
+
+        with self.lock:
+            if checkpoint_id := get_checkpoint_id(config):
+                row = self.connection.execute(
+                    f"SELECT {columns} FROM checkpoints WHERE thread_id=? AND checkpoint_ns=? AND checkpoint_id=?",
+                    (thread_id, checkpoint_ns, checkpoint_id),
+                ).fetchone()
+            else:
+                row = self.connection.execute(
+                    f"SELECT {columns} FROM checkpoints WHERE thread_id=? AND checkpoint_ns=? ORDER BY checkpoint_id DESC LIMIT 1",
+                    (thread_id, checkpoint_ns),
+                ).fetchone()
+
+            return self._tuple(thread_id, checkpoint_ns, row) if row is not None else None
+
+    def list(self, config, *, filter = None, before = None, limit = None):
+        query = "SELECT thread_id, checkpoint_ns, checkpoint_id, parent_id, type, checkpoint, metadata FROM checkpoints"
+        conditions, parameters = [], []
+
+        if config is not None:
+            conditions.append("thread_id=?")
+            parameters.append(config["configurable"]["thread_id"])
+            if (checkpoint_ns := config["configurable"].get("checkpoint_ns")) is not None:
+                conditions.append("checkpoint_ns=?")
+                parameters.append(checkpoint_ns)
+            if checkpoint_id := get_checkpoint_id(config):
+                conditions.append("checkpoint_id=?")
+                parameters.append(checkpoint_id)
+        if before is not None and (before_id := get_checkpoint_id(before)):
+            conditions.append("checkpoint_id<?")
+            parameters.append(before_id)
+
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY checkpoint_id DESC"
+
+        with self.lock:
+            rows = self.connection.execute(query, parameters).fetchall()
+
+        count = 0
+        for thread_id, checkpoint_ns, *row in rows:
+            if filter and not all(json.loads(row[4]).get(key) == value for key, value in filter.items()):
+                continue
+            with self.lock:
+                checkpoint_tuple = self._tuple(thread_id, checkpoint_ns, row)
+            yield checkpoint_tuple
+            count += 1
+            if limit is not None and count >= limit:
+                return
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+
+        checkpoint = checkpoint.copy()
+        values = checkpoint.pop("channel_values")
+        metadata = get_checkpoint_metadata(config, metadata)
+        type_, data = self.serde.dumps_typed(checkpoint)
+
+        with self.lock:
+            key = (thread_id, checkpoint_ns)
+            if key not in self.rounds:
+                self.rounds[key] = self.connection.execute(
+                    "SELECT COALESCE(MAX(round), 0) FROM checkpoints WHERE thread_id=? AND checkpoint_ns=?", key
+                ).fetchone()[0]
+            if metadata.get("source") == "input":
+                self.rounds[key] += 1
+
+            for channel, version in new_versions.items():
+                kind, value_type, blob = self._dump_value(values[channel], (*key, channel)) if channel in values else ("empty", None, b"")
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO channels VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (thread_id, checkpoint_ns, channel, str(version), kind, value_type, blob),
+                )
+
+            self.connection.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    thread_id, checkpoint_ns, checkpoint["id"], config["configurable"].get("checkpoint_id"),
+                    self.rounds[key], type_, data, json.dumps(metadata, default=str),
+                    json.dumps({channel: str(version) for channel, version in checkpoint["channel_versions"].items()}),
+                ),
+            )
+            self.connection.commit()
+
+            self.puts += 1
+            if self.prune_every and self.puts % self.prune_every == 0:
+                self.prune(thread_id, checkpoint_ns)
+
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"]}}
+
+    def put_writes(self, config, writes, task_id, task_path = ""):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            kind, data = self.serde.dumps_typed(value)
+            rows.append((thread_id, checkpoint_ns, checkpoint_id, task_id, WRITES_IDX_MAP.get(channel, idx), channel, kind, data, task_path))
+
+        # Special writes (errors, interrupts) are replaced, regular ones are only written once
+        verb = "INSERT OR REPLACE" if all(channel in WRITES_IDX_MAP for channel, _ in writes) else "INSERT OR IGNORE"
+        with self.lock:
+            self.connection.executemany(f"{verb} INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.connection.commit()
+
+    def delete_thread(self, thread_id):
+        with self.lock:
+            for table in ("checkpoints", "channels", "writes"):
+                self.connection.execute(f"DELETE FROM {table} WHERE thread_id=?", (thread_id,))
+            self.rounds = {key: value for key, value in self.rounds.items() if key[0] != thread_id}
+            self.digests = {key: value for key, value in self.digests.items() if key[0] != thread_id}
+            self._collect_items()
+            self.connection.commit()
+
+    def get_next_version(self, current, channel):
+        # Same format as MemorySaver: a sortable counter and a random part
+        current = 0 if current is None else current if isinstance(current, int) else int(current.split(".")[0])
+        return f"{current + 1:032}.{random.random():016}"
+
+    async def aget_tuple(self, config):
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter = None, before = None, limit = None):
+        for checkpoint_tuple in await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit))):
+            yield checkpoint_tuple
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path = ""):
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id):
+        return await asyncio.to_thread(self.delete_thread, thread_id)
+
+    # Retention
+
+    def prune(self, thread_id, checkpoint_ns = ""):
+        """Applies the retention policy to one thread and deletes what the removed checkpoints alone used."""
+
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT checkpoint_id, round FROM checkpoints WHERE thread_id=? AND checkpoint_ns=? ORDER BY checkpoint_id DESC",
+                (thread_id, checkpoint_ns),
+            ).fetchall()
+
+            keep = {checkpoint_id for checkpoint_id, _ in rows[:self.keep_last]}
+            seen_rounds = set()
+            for checkpoint_id, round_no in rows:
+                # Rows are newest first, the first one of a round is its last checkpoint
+                if round_no not in seen_rounds and self.keep_every_rounds and round_no % self.keep_every_rounds == 0:
+                    keep.add(checkpoint_id)
+                seen_rounds.add(round_no)
+
+            removed = [(checkpoint_id,) for checkpoint_id, _ in rows if checkpoint_id not in keep]
+            if not removed:
+                return 0
+
+            for table in ("checkpoints", "writes"):
+                self.connection.executemany(
+                    f"DELETE FROM {table} WHERE thread_id=? AND checkpoint_ns=? AND checkpoint_id=?",
+                    [(thread_id, checkpoint_ns, checkpoint_id) for (checkpoint_id,) in removed],
+                )
+
+            # Channel versions that no remaining checkpoint of the thread points to
+            used = set()
+            for (versions,) in self.connection.execute(
+                "SELECT versions FROM checkpoints WHERE thread_id=? AND checkpoint_ns=?", (thread_id, checkpoint_ns)
+            ):
+                used.update(json.loads(versions).items())
+            stale = [
+                (thread_id, checkpoint_ns, channel, version)
+                for channel, version in self.connection.execute(
+                    "SELECT channel, version FROM channels WHERE thread_id=? AND checkpoint_ns=?", (thread_id, checkpoint_ns)
+                ).fetchall()
+                if (channel, version) not in used
+            ]
+            self.connection.executemany(
+                "DELETE FROM channels WHERE thread_id=? AND checkpoint_ns=? AND channel=? AND version=?", stale
+            )
+
+            self._collect_items()
+            self.connection.commit()
+            return len(removed)
+
+    def _collect_items(self):
+        """Deletes the message bodies no list manifest refers to anymore."""
+
+        used = set()
+        for (blob,) in self.connection.execute("SELECT value FROM channels WHERE kind='list'"):
+            used.update(blob[i:i + hash_size] for i in range(0, len(blob), hash_size))
+
+        stale = [(digest,) for (digest,) in self.connection.execute("SELECT hash FROM items").fetchall() if digest not in used]
+        self.connection.executemany("DELETE FROM items WHERE hash=?", stale)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
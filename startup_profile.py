@@ -0,0 +1,76 @@
+"""
+Startup timing report for the game modules.
+
+Runs a fresh interpreter with `python -X importtime`, so nothing is cached from the current process, and
+breaks the import cost down per module and per top-level package.
+
+    python startup_profile.py                   # profiles frpg's game modules
+    python startup_profile.py loop_graph -n 30  # one module, 30 slowest imports
+"""
+
+import argparse
+import subprocess
+import sys
+from collections import defaultdict
+
+game_modules = ["static_objects", "game_functions", "creation_graph", "loop_graph"]
+
+
+def profile_imports(modules):
+    """
+    Returns (total seconds, rows) where every row is (module, self seconds, cumulative seconds).
+    """
+    code = "; ".join(f"import {module}" for module in modules)
+
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {modules} failed:\n{result.stderr}")
+
+    rows = []
+    for line in result.stderr.splitlines():
+        # import time:       self [us] |  cumulative | imported package
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6))
+
+    total = sum(row[1] for row in rows)
+    return total, rows
+
+
+def report(modules, top = 15):
+
+    total, rows = profile_imports(modules)
+
+    lines = [f"Import time of {', '.join(modules)}: {total:.3f} s", ""]
+
+    lines.append(f"{'module':<40}{'cumulative (s)':>16}")
+    for module in modules:
+        cumulative = next((row[2] for row in rows if row[0] == module), 0.0)
+        lines.append(f"{module:<40}{cumulative:>16.3f}")
+
+    packages = defaultdict(float)
+    for name, self_time, _ in rows:
+        packages[name.split(".")[0]] += self_time
+
+    lines += ["", f"{'top-level package':<40}{'self (s)':>16}"]
+    for name, self_time in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+        lines.append(f"{name:<40}{self_time:>16.3f}")
+
+    lines += ["", f"{'slowest single imports':<40}{'self (s)':>16}"]
+    for name, self_time, _ in sorted(rows, key=lambda row: -row[1])[:top]:
+        lines.append(f"{name:<40}{self_time:>16.3f}")
+
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Break down the import cost of the game modules.")
+    parser.add_argument("modules", nargs="*", default=game_modules)
+    parser.add_argument("-n", "--top", type=int, default=15)
+    args = parser.parse_args()
+
+    print(report(args.modules, args.top))
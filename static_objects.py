@@ -1,16 +1,58 @@
 from typing import List
 from langchain_core.messages import HumanMessage, AIMessage,SystemMessage,BaseMessage,BaseMessageChunk,AIMessageChunk
-from langchain.prompts import ChatPromptTemplate
 from langchain_core.messages import ToolMessage
 import json
 
 import pickle
+import threading
+
+from character_model import characters_from_dicts, characters_to_dicts
+
+# Held while a lazily sourced game is read or a game is replaced, other threads wait for the whole game
+load_lock = threading.RLock()
 
 class GameContext:
-    def __init__(self):
-        self.characters = {}
-        self.rules = ""
-        self.story = ""
+    def __init__(self, source = None):
+        """
+        source: optional path of a pickled GameContext. When given, the save is only read the first time
+        one of the game's attributes is accessed instead of at import time.
+        """
+        if source is None:
+            self.characters = {}
+            self.rules = ""
+            self.story = ""
+        else:
+            self._source = source
+
+    def __getattr__(self, name):
+        # Only called for missing attributes, i.e. before a lazily sourced game is loaded
+        with load_lock:
+            source = self.__dict__.get("_source")
+            if source is not None:
+                with open(source, 'rb') as file:
+                    saved = pickle.load(file)
+
+                loaded = dict(saved.__dict__, characters=characters_from_dicts(saved.characters))
+                self.__dict__.update(loaded)
+                # Only now, a thread that finds no _source must find the loaded game
+                del self.__dict__["_source"]
+
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def touch(self, name):
+        """Marks a character as changed, so that the GM prompt only has to carry what changed."""
+        versions = self.__dict__.setdefault("versions", {})
+        versions[name] = versions.get(name, 0) + 1
+
+    def version_of(self, name):
+        return self.__dict__.get("versions", {}).get(name, 0)
+
+    def characters_as_dicts(self):
+        """The characters in their plain dict shape, e.g. for JSON."""
+        return characters_to_dicts(self.characters)
     
     def value(self, new_value):
         old_value = self._value
@@ -18,27 +60,31 @@ class GameContext:
         for callback in self._listeners:
             callback(old_value, new_value)
             
-# game = GameContext()
+game = GameContext('game_1.pkl')
 
-with open('game_1.pkl', 'rb') as file:
-    game = pickle.load(file)
 
+def new_game(game_context = None):
+    game_context = game if game_context is None else game_context
 
-def new_game():
-    global game
-    game.characters = {}
-    game.story = ""
-    game.rules = ""
+    with load_lock:
+        game_context.__dict__.pop("_source", None)
+        game_context.__dict__.pop("versions", None)
+        game_context.characters = {}
+        game_context.story = ""
+        game_context.rules = ""
 
-def load_game(game_pkl):
-    global game
+def load_game(game_pkl, game_context = None):
+    game_context = game if game_context is None else game_context
 
     with open(game_pkl, 'rb') as file:
         game_2 = pickle.load(file)
 
-    game.characters = game_2.characters
-    game.story = game_2.story
-    game.rules = game_2.rules
+    with load_lock:
+        game_context.__dict__.pop("_source", None)
+        game_context.__dict__.pop("versions", None)
+        game_context.characters = characters_from_dicts(game_2.characters)
+        game_context.story = game_2.story
+        game_context.rules = game_2.rules
 
 theme = "medieval_dynasty"
 
@@ -163,18 +209,22 @@ class BasicToolNode:
             )
         return {"messages": outputs}
 
-def generate_task_prompt():
+def generate_task_prompt(game_context = None, include_story = True):
+    """include_story: set to False when the story is already part of the same prompt."""
+    game_context = game if game_context is None else game_context
+
+    story = f"The story should go like this, start from the start, you can manipulate the story if needed:{game_context.story}. " if include_story else "The story should go like the main story of the game, start from the start, you can manipulate the story if needed."
 
-    main_character =  list(game.characters.keys())[-1]
+    main_character =  list(game_context.characters.keys())[-1]
 
     task_prompt = f"""My character is {main_character}, other characters are NPCs. 
         You will play the rounds of NPCs and won't give the decisions to me for them.  Only play the npc characters. Don't play the PLAYER characters, 
         I will make every decision about me, don't decide what I will do or say. 
         After I say my input, play the rounds for each npc in order. 
-        The round order for me and other characters is in this order: {list(game.characters.keys())}, please obey this order. 
+        The round order for me and other characters is in this order: {list(game_context.characters.keys())}, please obey this order. 
         Based on the provided details, first tell our current situation, explain the story and continue the game in round order by playing the NPCs. 
         
-        The story should go like this, start from the start, you can manipulate the story if needed:{game.story}. 
+        {story}
 
         Don't talk too long, don't talk or describe unnecessarily. Ask for confirmation before any important action from me.
 
@@ -0,0 +1,107 @@
+import json
+import os
+from collections import deque
+
+
+class RoundLog:
+    """
+    Transcript of a campaign for the UI, one entry per round: a list of (role, text) messages.
+
+    The client only renders the last pages, so a rerun costs the same at round 500 as at round 5. With a
+    path every round is appended to a JSONL file as it is added and only the last keep_rounds rounds stay in
+    memory; older pages are read back from the file by the byte offset of their first round.
+    """
+
+    def __init__(self, path = None, page_size = 10, keep_rounds = 50):
+
+        self.path = path
+        self.page_size = page_size
+        self.keep_rounds = max(keep_rounds, page_size)
+
+        # Without a file nothing can be read back, everything stays in memory
+        self.recent = deque(maxlen=self.keep_rounds if path else None)
+        self.offsets = []  # byte offset of every round in the file
+        self.count = 0
+
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            if os.path.exists(path):
+                self._index()
+
+    def _index(self):
+        offset = 0
+        with open(self.path, "rb") as file:
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                self.offsets.append(offset)
+                self.recent.append(json.loads(line))
+                offset += len(line)
+        self.count = len(self.offsets)
+
+    def add_round(self, messages):
+        """Appends one round, messages being (role, text) pairs. Returns its index."""
+
+        messages = [list(message) for message in messages]
+
+        if self.path:
+            with open(self.path, "ab") as file:
+                self.offsets.append(file.tell())
+                file.write((json.dumps(messages, ensure_ascii=False) + "\n").encode("utf-8"))
+
+        self.recent.append(messages)
+        self.count += 1
+        return self.count - 1
+
+    @property
+    def pages(self):
+        return -(-self.count // self.page_size)
+
+    def rounds(self, start, stop):
+        """Rounds start to stop - 1, from memory when they are still there, otherwise from the file."""
+
+        start, stop = max(start, 0), min(stop, self.count)
+        if start >= stop:
+            return []
+
+        first_in_memory = self.count - len(self.recent)
+        if start >= first_in_memory:
+            return [self.recent[i - first_in_memory] for i in range(start, stop)]
+
+        rounds = []
+        with open(self.path, "rb") as file:
+            file.seek(self.offsets[start])
+            for _ in range(start, stop):
+                rounds.append(json.loads(file.readline()))
+        return rounds
+
+    def last_pages(self, pages):
+        """The rounds of the newest `pages` pages, oldest first."""
+        return self.rounds(self.count - pages * self.page_size, self.count)
+
+
+class CharacterViews:
+    """
+    Sidebar view of the characters. A character is converted for display again only when its version
+    (GameContext.touch) changed, or when it was replaced by a new object, e.g. after new_game.
+    """
+
+    def __init__(self):
+        self.views = {}  # name -> (character object id, version, dict)
+
+    def update(self, game):
+        """Returns [(name, dict, changed)] for every character, changed meaning re-converted in this call."""
+
+        result = []
+        for name, character in game.characters.items():
+            key = (id(character), game.version_of(name))
+            view = self.views.get(name)
+            changed = view is None or view[:2] != key
+            if changed:
+                view = self.views[name] = (*key, character.to_dict())
+            result.append((name, view[2], changed))
+
+        for name in set(self.views) - set(game.characters):
+            del self.views[name]
+
+        return result
@@ -0,0 +1,74 @@
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class PoolFull(RuntimeError):
+    """Raised by SessionWorkerPool.submit when max_pending jobs are already waiting."""
+
+
+class SessionWorkerPool:
+    """
+    Bounded pool of worker threads that runs the jobs of one session strictly in submission order.
+
+    Every session has its own FIFO queue and at most one of its jobs runs at a time, so a turn never
+    overlaps the creation or the previous turn of the same campaign (the graphs and the game state of a
+    session are not thread safe). Different sessions run in parallel on max_workers threads. After each
+    job a session goes to the back of the executor's queue, a long campaign can't starve the others.
+    """
+
+    def __init__(self, max_workers = 8, max_pending = 256):
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="session-worker")
+
+        self.queues = {}  # session id -> deque of (future, fn, args, kwargs), present while it has work
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def submit(self, session_id, fn, *args, **kwargs):
+        """Queues fn(*args, **kwargs) behind the session's earlier jobs and returns its Future."""
+
+        future = Future()
+        with self.lock:
+            if self.pending >= self.max_pending:
+                raise PoolFull(f"{self.pending} jobs are already waiting")
+
+            queue = self.queues.get(session_id)
+            idle = queue is None
+            if idle:
+                queue = self.queues[session_id] = deque()
+            queue.append((future, fn, args, kwargs))
+            self.pending += 1
+
+        if idle:
+            self.executor.submit(self._run_next, session_id)
+        return future
+
+    def _run_next(self, session_id):
+
+        with self.lock:
+            future, fn, args, kwargs = self.queues[session_id].popleft()
+
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as error:
+                    future.set_exception(error)
+        finally:
+            with self.lock:
+                self.pending -= 1
+                more = bool(self.queues[session_id])
+                if not more:
+                    del self.queues[session_id]
+
+            if more:
+                self.executor.submit(self._run_next, session_id)
+
+    def queued(self, session_id):
+        """Jobs of the session that did not start yet."""
+        with self.lock:
+            return len(self.queues.get(session_id, ()))
+
+    def shutdown(self, wait = True):
+        self.executor.shutdown(wait=wait)